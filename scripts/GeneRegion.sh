@@ -51,7 +51,8 @@ version "$VERSION"
   -o, --output            Output directory
 
   \e[4mOptional arguments\e[0m:
-  -t, --threads           Number of threads for the analysis (Default: 2)
+  -t, --threads           Number of threads for the analysis (Default: 2). The baits search uses
+                          them as blastn threads, blat always runs as one process
 
   -f, --filter-string     UCEs whose name beggins with this string will be discarted (Default: "_")
 
@@ -59,7 +60,13 @@ version "$VERSION"
                           be performed with this flag
 						  
   --only-by-genic-region  Concatenate UCEs only by genic region. Concatenation by gene will not 
-                          be performed with this flag"
+                          be performed with this flag
+
+  --annotation-index      Directory to keep an index of the annotation (with its introns) in, so
+                          that later runs with the same gff, e.g. with other baits, skip parsing it
+
+  --search-cache          Directory to keep the baits search results (and blast db) in, so that
+                          later runs with the same baits and reference genome skip the search"
 exit 2
 }
 
@@ -94,7 +101,7 @@ FILTER="_"
 
 # Option strings for arg parser
 SHORT=hb:r:g:p:o:f:t:
-LONG=help,baits:,version:,reference:,gff:,phyluce-nexus:,output:,filter-string:,threads:,only-by-gene,only-by-genic-region
+LONG=help,baits:,version:,reference:,gff:,phyluce-nexus:,output:,filter-string:,threads:,only-by-gene,only-by-genic-region,annotation-index:,search-cache:
 
 
 # Read options
@@ -148,6 +155,14 @@ while true ; do
 		ONLY_BY_REGION="True"
 		shift
 		;;
+		--annotation-index )
+		ANNOTATION_INDEX="$2"
+		shift 2
+		;;
+		--search-cache )
+		SEARCH_CACHE="$2"
+		shift 2
+		;;
 		-- )
 		shift
 		break
@@ -187,6 +202,8 @@ THREADS: $THREADS
 ONLY_BY_GENE? $ONLY_BY_GENE
 ONLY_BY_GENIC_REGION? $ONLY_BY_REGION
 FILTER_STRING $FILTER
+ANNOTATION INDEX: ${ANNOTATION_INDEX:-none}
+SEARCH CACHE: ${SEARCH_CACHE:-none}
 -------------------------------------------------------------------------"
 
 #=============================================================
@@ -226,13 +243,28 @@ mkdir -p "${LOGDIR}"
 GENOME=$(basename "${REFERENCE_GENOME}")
 UCE_KIT_SUMMARY="${OUTPUT}/uce_kit_output/${GENOME}.uce_kit_summary"
 
+# reuse the annotation index built by earlier runs with the same gff
+ANNOTATION_INDEX_ARGS=""
+if [ -n "${ANNOTATION_INDEX}" ]; then
+	mkdir -p "${ANNOTATION_INDEX}"
+	ANNOTATION_INDEX_ARGS="-index $( realpath ${ANNOTATION_INDEX} )"
+fi
+
+# reuse the baits search of earlier runs with the same baits and reference genome
+SEARCH_CACHE_ARGS=""
+if [ -n "${SEARCH_CACHE}" ]; then
+	mkdir -p "${SEARCH_CACHE}"
+	SEARCH_CACHE_ARGS="-cache $( realpath ${SEARCH_CACHE} )"
+fi
+
+# only the summary is used below, so uce_kit.py runs its steps in one process without writing the files between them
 if [[ ! -f "${UCE_KIT_SUMMARY}" ]]; then
 	log "Running uce_kit.py..."
 	$CONDA_PREFIX/bin/python "${HOME_DIR}"/uce_kit/uce_kit.py run_pipeline \
 		"${BAITS_FILE}" \
 		"${REFERENCE_GENOME}" \
 		"${GFF}" "${OUTPUT}"/uce_kit_output \
-		-lines -merge -filt "$FILTER" > "${LOGDIR}"/uce_kit.log 2>&1
+		${ANNOTATION_INDEX_ARGS} ${SEARCH_CACHE_ARGS} -threads "${THREADS}" -stream -lines -merge -filt "$FILTER" > "${LOGDIR}"/uce_kit.log 2>&1
 	DONEmsg
 	else
 		warn "Script uce_kit.py already run. Skipping..."
@@ -1,27 +1,88 @@
 from utilities import *
 from functions_metrics import *
+from swsc_cache import parse_size
 import os
 from time import asctime
 import sys
+import argparse
 
 
-dataset_path = sys.argv[1]
-try:
-	output_path = sys.argv[2]
-except:
-	output_path = os.path.dirname(dataset_path)
+def main():
+	parser = argparse.ArgumentParser(description = 'Sliding-window site characteristics (entropy) of UCEs')
+	parser.add_argument('dataset_path', help = 'nexus alignment with UCE charsets')
+	parser.add_argument('output_path', nargs = '?', help = 'output directory (default: directory of dataset_path)')
+	parser.add_argument('--metrics', nargs = '+', choices = ['entropy', 'gc', 'multi'], default = ['entropy'],
+	                    help = 'sitewise metrics to find the best windows with, each one with its own '
+	                           'partitionfinder file. The charsets and UCE outputs use the first one '
+	                           '(default: entropy)')
+	parser.add_argument('--biopython-nexus', action = 'store_true',
+	                    help = 'read the nexus with Biopython instead of the faster built-in reader')
+	parser.add_argument('--workers', type = int, default = 1,
+	                    help = 'number of processes to spread the UCEs across (default: 1)')
+	parser.add_argument('--sitewise-format', choices = ['csv', 'npz'], default = 'csv',
+	                    help = 'format of the sitewise metrics output (default: csv). npz is a numpy '
+	                           'archive with the sites of all UCEs in one column per array, UCE i '
+	                           'being uce_offsets[i]:uce_offsets[i + 1] (see '
+	                           'functions_metrics.read_sitewise_npz)')
+	parser.add_argument('--no-sitewise-output', action = 'store_true',
+	                    help = 'only write the partitions, not the sitewise metrics')
+	parser.add_argument('--charsets', action = 'store_true',
+	                    help = 'also write the partitions as nexus charsets, an IQ-TREE partition file '
+	                           'and the alignment with the partitions as charsets')
+	parser.add_argument('--cache', metavar = 'DIR',
+	                    help = 'keep the results of each UCE in DIR and reuse them in later runs '
+	                           '(inspect or prune it with swsc_cache.py)')
+	parser.add_argument('--cache-size', metavar = 'SIZE',
+	                    help = 'largest size of the cache, e.g. 500M or 2G. The least recently used '
+	                           'UCEs are removed at the end of the run (default: no limit)')
+	parser.add_argument('--counts', metavar = 'FILE',
+	                    help = 'keep the base counts of the UCEs in FILE (.npz), so that a later run '
+	                           'on the dataset with more taxa only counts the new ones. The UCEs are '
+	                           'partitioned from the stored counts')
+	parser.add_argument('--trace', metavar = 'FILE',
+	                    help = 'write one JSON line per UCE to FILE, with its size, number of windows, '
+	                           'time spent in the metrics, scoring and output, and peak memory')
+	parser.add_argument('--loci', metavar = 'DIR',
+	                    help = 'write each partition of each UCE to DIR as a nexus (<uce>_left.nexus, ...)')
+	parser.add_argument('--partitioned-uces', metavar = 'DIR',
+	                    help = 'write each UCE to DIR as a phylip (<uce>.phylip) with its partitions '
+	                           'as charsets (<uce>.charsets)')
+	args = parser.parse_args()
 
-print ("\n")
-print ("analysing %s", dataset_path)
+	dataset_path = args.dataset_path
+	output_path = args.output_path
+	# all paths are relative to where SWSC-EN was called from
+	loci_dir = None if args.loci is None else os.path.abspath(args.loci)
+	partitioned_dir = None if args.partitioned_uces is None else os.path.abspath(args.partitioned_uces)
+	cache_dir = None if args.cache is None else os.path.abspath(args.cache)
+	cache_size = None if args.cache_size is None else parse_size(args.cache_size)
+	trace_path = None if args.trace is None else os.path.abspath(args.trace)
+	counts_path = None if args.counts is None else os.path.abspath(args.counts)
+	if output_path is None:
+		output_path = os.path.dirname(dataset_path) or '.'
 
-if not os.path.exists(output_path):
-    os.makedirs(output_path)
+	print ("\n")
+	print ("analysing %s", dataset_path)
 
-os.chdir(output_path)
+	if not os.path.exists(output_path):
+	    os.makedirs(output_path)
 
-name = os.path.basename(dataset_path).rstrip(".nex")
+	name = os.path.basename(dataset_path).rstrip(".nex")
 
-print(asctime())
-process_dataset_metrics(dataset_path, ['entropy'], minimum_window_size = 50, outfilename = '%s.csv' % (name))
+	sitewise_output = None if args.no_sitewise_output else args.sitewise_format
 
-print ("Done. Output is here %s", output_path)
+	print(asctime())
+	process_dataset_metrics(dataset_path, args.metrics, minimum_window_size = 50,
+	                        outfilename = '%s.%s' % (name, args.sitewise_format),
+	                        fast_nexus = not args.biopython_nexus, workers = args.workers,
+	                        sitewise_output = sitewise_output, charsets_output = args.charsets,
+	                        loci_dir = loci_dir, partitioned_dir = partitioned_dir,
+	                        cache_dir = cache_dir, cache_size = cache_size, trace_path = trace_path,
+	                        output_dir = output_path, counts_path = counts_path)
+
+	print ("Done. Output is here %s", output_path)
+
+
+# the guard keeps worker processes that import this file from running it
+if __name__ == '__main__':
+	main()
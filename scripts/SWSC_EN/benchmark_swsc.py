@@ -0,0 +1,267 @@
+''' Benchmarks of SWSC-EN on the loci in test_data/uce_nexus and on
+    synthetic alignments of growing length and number of taxa.
+
+    For each alignment it reports the time and peak memory (of the
+    Python and numpy allocations, from tracemalloc) of each stage:
+        parse:    reading the nexus (synthetic alignments are made in memory)
+        metrics:  base counts and sitewise metrics
+        windows:  enumerating the windows that leave no invariant block
+        scoring:  finding the best window of each metric, which enumerates
+                  the windows again as it scores them
+        output:   sitewise csv and partitionfinder blocks
+    and the time of process_uce as a whole. It then runs
+    process_dataset_metrics on the concatenated loci.
+
+    The best windows are compared with benchmark_baseline.json, so a
+    faster engine can be checked to choose the same windows. Run with
+    --update-baseline to write it again after a change that is meant
+    to change the windows.
+
+    usage: python benchmark_swsc.py [--loci uce-49 ...] [--lengths 500 ...]
+                                    [--taxa 50 ...] [--update-baseline]
+'''
+from functions_metrics import *
+from Bio.Nexus import Nexus
+import numpy as np
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+SWSC_DIR = os.path.dirname(os.path.abspath(__file__))
+UCE_NEXUS_DIR = os.path.join(SWSC_DIR, '..', '..', 'test_data', 'uce_nexus')
+BASELINE_FILE = os.path.join(SWSC_DIR, 'benchmark_baseline.json')
+
+STAGES = ['parse', 'metrics', 'windows', 'scoring', 'output']
+
+DEFAULT_LOCI = ['uce-49', 'uce-130', 'uce-1451', 'uce-11068']
+DEFAULT_LENGTHS = [500, 1000, 2000]
+DEFAULT_TAXA = [50, 200]
+DEFAULT_METRICS = ['entropy', 'gc', 'multi']
+MINIMUM_WINDOW_SIZE = 50
+
+
+def measure(function, *args):
+    ''' function: the stage to run, with args
+
+    returns ->  the result of function, the seconds it took and the
+                peak of the memory traced while it ran (bytes)
+    '''
+    tracemalloc.start()
+    start = perf_counter()
+    result = function(*args)
+    elapsed = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return (result, elapsed, peak)
+
+
+def synthetic_alignment(length, n_taxa, seed = 0):
+    ''' length: number of sites
+        n_taxa: number of sequences
+
+    returns an encoded alignment that looks like a UCE: a conserved core
+    with more and more variable flanks, and missing data at the ends
+    '''
+    rng = np.random.RandomState(seed + 7919 * length + n_taxa)
+
+    # chance of a mutation at each site, lowest in the middle
+    distance = np.abs(np.linspace(-1.0, 1.0, length))
+    mutation_rate = 0.01 + 0.4 * distance ** 2
+
+    reference = rng.randint(0, 4, length)
+    mutated = rng.random_sample((n_taxa, length)) < mutation_rate
+    aln = np.where(mutated, rng.randint(0, 4, (n_taxa, length)), reference).astype(np.uint8)
+
+    # ragged ends, as in the flanks of real UCEs
+    for row in range(n_taxa):
+        aln[row, : rng.randint(0, length // 10 + 1)] = UNDETERMINED
+        aln[row, length - rng.randint(0, length // 10 + 1) :] = UNDETERMINED
+
+    return (aln)
+
+
+def count_valid_windows(aln_length, sitevar):
+    # the enumeration that get_best_windows_cumsum does, without the scoring
+    variable_prefix = prefix_counts(np.asarray(sitevar) > 0)
+    n_valid = 0
+    for starts, stops in window_blocks(aln_length, MINIMUM_WINDOW_SIZE, WINDOW_BLOCK_SIZE):
+        n_valid += np.count_nonzero(valid_windows_mask(variable_prefix, starts, stops, MINIMUM_WINDOW_SIZE))
+
+    return (n_valid)
+
+
+def write_outputs(outdir, label, best_windows, metric_array, aln_length, counts, metrics):
+    # the sitewise csv and the partitionfinder blocks of one UCE
+    base_prefix = prefix_counts(counts)
+    outfile = open(os.path.join(outdir, '%s.csv' % (label)), 'w', buffering = SITEWISE_BUFFER_SIZE)
+    write_sitewise_csv(outfile, best_windows, metric_array, list(range(aln_length)), label, metrics)
+    outfile.close()
+
+    cfg = open(os.path.join(outdir, '%s.cfg' % (label)), 'w')
+    for best_window in best_windows:
+        cfg.write(pfinder_data_blocks(uce_blocks(best_window, label, 0, aln_length, base_prefix)))
+    cfg.close()
+
+
+def benchmark_alignment(label, aln, metrics, outdir, parse_stats = (0.0, 0)):
+    ''' label: name of the alignment in the report
+        aln: encoded alignment
+        metrics: a list with values of 'gc', 'entropy' or 'multi'
+        outdir: directory for the output stage
+        parse_stats: time and peak memory of reading aln
+
+    returns ->  a dict with the stages, the time of process_uce and
+                the best window of each metric
+    '''
+    aln_length = aln.shape[1]
+    stats = {'parse': parse_stats}
+
+    def metric_stage():
+        counts = base_count_matrix(aln)
+        return (counts, metrics_from_counts(counts, aln.shape[0], metrics), variable_sites_from_counts(counts))
+
+    (counts, metric_array, sitevar), elapsed, peak = measure(metric_stage)
+    stats['metrics'] = (elapsed, peak)
+
+    if count_windows(aln_length, MINIMUM_WINDOW_SIZE) > 1:
+        n_valid, elapsed, peak = measure(count_valid_windows, aln_length, sitevar)
+        stats['windows'] = (elapsed, peak)
+        best_windows, elapsed, peak = measure(get_best_windows_cumsum, metric_array, aln_length,
+                                              MINIMUM_WINDOW_SIZE, sitevar)
+        stats['scoring'] = (elapsed, peak)
+    else:
+        window = first_window(aln_length, MINIMUM_WINDOW_SIZE)
+        best_windows = [window for metric in metrics]
+        stats['windows'] = stats['scoring'] = (0.0, 0)
+
+    result, elapsed, peak = measure(write_outputs, outdir, label, best_windows, metric_array, aln_length, counts, metrics)
+    stats['output'] = (elapsed, peak)
+
+    # the windows that count are the ones of process_uce
+    (uce_windows, uce_metrics), elapsed, peak = measure(process_uce, aln, metrics, MINIMUM_WINDOW_SIZE)
+
+    return ({'label': label, 'sites': aln_length, 'taxa': aln.shape[0], 'stages': stats,
+             'process_uce': (elapsed, peak),
+             'windows': dict((metric, list(window)) for metric, window in zip(metrics, uce_windows))})
+
+
+def benchmark_dataset(loci, metrics, outdir):
+    ''' loci: nexus files of the loci
+        metrics: a list with values of 'gc', 'entropy' or 'multi'
+        outdir: directory for the concatenated nexus and the outputs
+
+    returns -> time and peak memory of process_dataset_metrics on the
+               loci concatenated as UCERegion does it
+    '''
+    nexi = [(os.path.basename(locus).replace('uce-', 'uce_'), Nexus.Nexus(locus)) for locus in loci]
+    dataset_path = os.path.join(outdir, 'dataset.nexus')
+    Nexus.combine(nexi).write_nexus_data(filename = dataset_path)
+
+    def run_dataset():
+        process_dataset_metrics(dataset_path, metrics, MINIMUM_WINDOW_SIZE, 'dataset.csv', output_dir = outdir)
+
+    result, elapsed, peak = measure(run_dataset)
+
+    return (elapsed, peak)
+
+
+def print_report(results):
+    header = '%-24s %6s %5s ' % ('alignment', 'sites', 'taxa')
+    header += ' '.join('%16s' % (stage) for stage in STAGES + ['process_uce'])
+    print(header)
+    print('%-24s %6s %5s ' % ('', '', '') + ' '.join('%16s' % ('ms / peak MB') for stage in STAGES + ['process_uce']))
+
+    for result in results:
+        line = '%-24s %6s %5s ' % (result['label'], result['sites'], result['taxa'])
+        cells = [result['stages'][stage] for stage in STAGES] + [result['process_uce']]
+        line += ' '.join('%9.1f / %5.1f' % (elapsed * 1000, peak / 1048576.0) for elapsed, peak in cells)
+        print(line)
+
+
+def compare_baseline(results, metrics):
+    ''' returns the number of alignments whose windows differ from the
+        stored baseline (alignments not in the baseline are reported) '''
+
+    if not os.path.exists(BASELINE_FILE):
+        print('\nNo baseline in %s, run with --update-baseline to write one' % (BASELINE_FILE))
+        return (0)
+
+    baseline = json.load(open(BASELINE_FILE))
+
+    differences = 0
+    print('\nbest windows against %s:' % (os.path.basename(BASELINE_FILE)))
+    for result in results:
+        expected = baseline.get(result['label'])
+        if expected is None:
+            print('  %-24s not in baseline' % (result['label']))
+            continue
+        changed = [metric for metric in metrics if metric in expected and expected[metric] != result['windows'][metric]]
+        if changed:
+            differences += 1
+            for metric in changed:
+                print('  %-24s %-8s %s, baseline %s' % (result['label'], metric, result['windows'][metric], expected[metric]))
+        else:
+            print('  %-24s same' % (result['label']))
+
+    return (differences)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmarks of SWSC-EN')
+    parser.add_argument('--loci', nargs = '*', default = DEFAULT_LOCI,
+                        help = 'loci of test_data/uce_nexus (default: %s)' % (' '.join(DEFAULT_LOCI)))
+    parser.add_argument('--lengths', nargs = '*', type = int, default = DEFAULT_LENGTHS,
+                        help = 'lengths of the synthetic alignments (default: %s)' % (' '.join(map(str, DEFAULT_LENGTHS))))
+    parser.add_argument('--taxa', nargs = '*', type = int, default = DEFAULT_TAXA,
+                        help = 'taxa of the synthetic alignments (default: %s)' % (' '.join(map(str, DEFAULT_TAXA))))
+    parser.add_argument('--metrics', nargs = '+', choices = DEFAULT_METRICS, default = DEFAULT_METRICS)
+    parser.add_argument('--update-baseline', action = 'store_true',
+                        help = 'store the best windows of this run as the baseline')
+    args = parser.parse_args()
+
+    outdir = tempfile.mkdtemp(prefix = 'swsc_benchmark_')
+    results = []
+
+    try:
+        loci = [os.path.join(UCE_NEXUS_DIR, '%s.nexus' % (locus)) for locus in args.loci]
+
+        for locus, path in zip(args.loci, loci):
+            (aln, taxa, charsets), elapsed, peak = measure(read_nexus, path)
+            results.append(benchmark_alignment(locus, aln, args.metrics, outdir, (elapsed, peak)))
+
+        for length in args.lengths:
+            for n_taxa in args.taxa:
+                aln = synthetic_alignment(length, n_taxa)
+                results.append(benchmark_alignment('synthetic-L%s-n%s' % (length, n_taxa), aln, args.metrics, outdir))
+
+        print_report(results)
+
+        if loci:
+            elapsed, peak = benchmark_dataset(loci, args.metrics, outdir)
+            print('\nprocess_dataset_metrics on %s loci: %.1f ms, peak %.1f MB' % (len(loci), elapsed * 1000, peak / 1048576.0))
+
+        if args.update_baseline:
+            baseline = json.load(open(BASELINE_FILE)) if os.path.exists(BASELINE_FILE) else {}
+            for result in results:
+                baseline.setdefault(result['label'], {}).update(result['windows'])
+            # one line per alignment, so changes are easy to read in a diff
+            lines = ['  %s: %s' % (json.dumps(label), json.dumps(baseline[label], sort_keys = True))
+                     for label in sorted(baseline)]
+            with open(BASELINE_FILE, 'w') as baseline_file:
+                baseline_file.write('{\n' + ',\n'.join(lines) + '\n}\n')
+            print('\nBaseline written to %s' % (BASELINE_FILE))
+        elif compare_baseline(results, args.metrics) > 0:
+            sys.exit(1)
+
+    finally:
+        shutil.rmtree(outdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
 from utilities import *
+from nexus_reader import read_nexus, read_nexus_biopython, copy_nexus_matrix
+from locus_writer import write_uce_loci, write_partitioned_uce
+from swsc_cache import cache_key, cache_load, cache_store, cache_prune
 from Bio.Nexus import Nexus
 from Bio import AlignIO, SeqIO, SeqUtils
 import Bio
@@ -6,14 +9,50 @@ import numpy as np
 import os, subprocess
 from math import factorial
 import itertools
+import multiprocessing
+import json
+from collections import OrderedDict
+from time import perf_counter
 from tqdm import tqdm
 #from functions_full_multi import *
 
 
-def process_dataset_metrics(dataset_path, metrics, minimum_window_size, outfilename):
+def process_dataset_metrics(dataset_path, metrics, minimum_window_size, outfilename, fast_nexus = True, workers = 1,
+                            sitewise_output = 'csv', charsets_output = False, loci_dir = None, partitioned_dir = None,
+                            cache_dir = None, cache_size = None, trace_path = None, output_dir = '.',
+                            counts_path = None):
     ''' dataset_path: path to a nexus alignment with UCE charsets
-        metrics: a list of 'gc', 'entropy' or 'multi'
-        outfilename: name for the csv file 
+        metrics: a list of 'gc', 'entropy' or 'multi'. Each metric gets its
+                 own best windows and partitionfinder file, the charsets
+                 and UCE outputs use the partitions of the first one
+        outfilename: name for the csv (or npz) file 
+        fast_nexus: read the nexus with nexus_reader.read_nexus, 
+                    otherwise with Biopython
+        workers: number of processes to spread the charsets across
+        sitewise_output: 'csv', 'npz' (see save_sitewise_npz) or None
+                         to write only the partitions
+        charsets_output: also write the partitions as a nexus sets block
+                         (.charsets), an IQ-TREE partition file (_iqtree.nex)
+                         and the alignment with them as charsets (.nexus)
+        loci_dir: directory to write each data block of each UCE to,
+                  as a nexus (see locus_writer.write_uce_loci)
+        partitioned_dir: directory to write each UCE to, as a phylip
+                         with its data blocks as charsets (see
+                         locus_writer.write_partitioned_uce)
+        cache_dir: directory to keep the best windows and metrics of each
+                   UCE in, so they are only computed for UCEs that are 
+                   not there yet (see swsc_cache)
+        cache_size: largest size of cache_dir in bytes. The least recently
+                    used UCEs are removed at the end of the run
+        trace_path: file to write one JSON line per charset to, with its 
+                    size, the number of windows, the seconds spent in the
+                    metrics, the scoring and the output, and the peak 
+                    resident memory of the process that scored it
+        output_dir: directory for the csv, partitionfinder and charsets 
+                    files (outfilename is relative to it)
+        counts_path: .npz file to keep the base counts of the UCEs in, so
+                     a later run with more taxa only counts the new ones
+                     (see incremental_counts.update_counts)
      
     returns -> csv files written to disk
     '''
@@ -23,164 +62,545 @@ def process_dataset_metrics(dataset_path, metrics, minimum_window_size, outfilen
     
     dataset_name = os.path.basename(dataset_path).rstrip(".nex")
 
-    outfile = open(outfilename, 'w')
-    outfile.write("name,uce_site,aln_site,window_start,window_stop,type,value,plot_mtx\n")
-    outfile.close()
+    for uce_dir in (output_dir, loci_dir, partitioned_dir):
+        if uce_dir is not None and uce_dir != '' and not os.path.exists(uce_dir):
+            os.makedirs(uce_dir)
+
+    # one buffered writer for the sitewise metrics of all UCEs
+    if sitewise_output == 'csv':
+        outfile = open(os.path.join(output_dir, outfilename), 'w', buffering = SITEWISE_BUFFER_SIZE)
+        outfile.write("name,uce_site,aln_site,window_start,window_stop,type,value,plot_mtx\n")
+        write_sitewise = write_sitewise_csv
+    elif sitewise_output == 'npz':
+        # the columns of all UCEs are kept and saved together at the end
+        outfile = sitewise_columns(metrics)
+        write_sitewise = write_sitewise_npz
+    elif sitewise_output is None:
+        outfile = None
+    else:
+        raise ValueError("sitewise_output must be 'csv', 'npz' or None, not %s" % (sitewise_output))
 
-    # write the start blocks of the partitionfinder files
+    # one buffered writer per partition output, open for the whole run.
+    # Each metric writes the data blocks of its best windows to its own
+    # partitionfinder file
+    pfinder_config_files = []
     for m in metrics:
-        pfinder_config_file = open('%s_%s_partition_finder.cfg' % (dataset_name, m), 'w')
+        pfinder_config_file = open(os.path.join(output_dir, '%s_%s_partition_finder.cfg' % (dataset_name, m)), 'w',
+                                   buffering = PARTITION_BUFFER_SIZE)
         pfinder_config_file.write(p_finder_start_block(dataset_name))
-        pfinder_config_file.close()
+        pfinder_config_files.append(pfinder_config_file)
+
+    charsets_files = []
+    if charsets_output:
+        charsets_file = open(os.path.join(output_dir, '%s_%s.charsets' % (dataset_name, metrics[0])), 'w',
+                             buffering = PARTITION_BUFFER_SIZE)
+        charsets_file.write(charsets_start_block())
+
+        iqtree_file = open(os.path.join(output_dir, '%s_%s_iqtree.nex' % (dataset_name, metrics[0])), 'w',
+                           buffering = PARTITION_BUFFER_SIZE)
+        iqtree_file.write('#nexus\n' + charsets_start_block())
+
+        # the alignment goes first, the charsets follow as they come
+        nexus_file = open(os.path.join(output_dir, '%s_%s.nexus' % (dataset_name, metrics[0])), 'w',
+                          buffering = PARTITION_BUFFER_SIZE)
+        copy_nexus_matrix(dataset_path, nexus_file)
+        nexus_file.write(charsets_start_block())
+
+        charsets_files = [(charsets_file, ''), (iqtree_file, '\t'), (nexus_file, '')]
+
+    # the characters are kept as they are in the file, for the UCE
+    # outputs, and each UCE is encoded when it is processed
+    if fast_nexus:
+        aln_bytes, taxa, charsets = read_nexus(dataset_path, encode = False)
+    else:
+        aln_bytes, taxa, charsets = read_nexus_biopython(dataset_path, encode = False)
+
+    tasks = [(name, min(charsets[name]), max(charsets[name]) + 1) for name in charsets]
+
+    stored_counts = {}
+    if counts_path is not None:
+        # imported here, as incremental_counts imports this module
+        from incremental_counts import update_counts
+        store = update_counts(counts_path, aln_bytes, taxa, charsets)
+        stored_counts = dict((name, store['uces'][name]['counts']) for name, start, stop in tasks)
+
+    # line buffered, so the trace is there up to the last UCE if the run is stopped
+    trace_file = None if trace_path is None else open(trace_path, 'w', buffering = 1)
+    trace = trace_file is not None
+
+    if workers > 1:
+        results = process_charsets_parallel(aln_bytes, tasks, metrics, minimum_window_size, workers, cache_dir, trace,
+                                            stored_counts)
+    else:
+        results = (process_charset(aln_bytes, task, metrics, minimum_window_size, cache_dir, trace,
+                                   stored_counts.get(task[0])) for task in tasks)
 
-    dat = Nexus.Nexus()
-    dat.read(dataset_path)
-    aln = AlignIO.read(open(dataset_path), "nexus")
+    # results come back in charset order, also from the workers
+    for (name, start, stop), (best_windows, metric_array, blocks, record) in tqdm(zip(tasks, results), total = len(tasks)):
 
-    for name in tqdm(dat.charsets):
+        output_start = perf_counter()
 
-        sites = dat.charsets[name]
-        start = min(sites)
-        stop = max(sites) + 1
-        # slice the alignment to get the UCE
-        uce_aln = aln[:, start:stop]
+        sites = charsets[name]
 
-        best_windows, metric_array = process_uce(uce_aln, metrics, minimum_window_size)
+        for pfinder_config_file, uce_blocks in zip(pfinder_config_files, blocks):
+            pfinder_config_file.write(pfinder_data_blocks(uce_blocks))
 
-        for i, best_window in enumerate(best_windows):
-            pfinder_config_file = open('%s_entropy_partition_finder.cfg' % (dataset_name), 'a')
-            pfinder_config_file.write(blocks_pfinder_config(best_window, name, start, stop, uce_aln)) 
+        # the charsets and the UCEs are written with the blocks of the first metric
+        if charsets_files:
+            new_charsets = [charset for charset_name, charset in blocks_to_charsets(blocks[0])]
+            for charsets_file, indent in charsets_files:
+                charsets_file.write(''.join(indent + charset for charset in new_charsets))
 
-        write_csvs(best_windows, metric_array, sites, name, outfilename)
+        if loci_dir is not None:
+            write_uce_loci(loci_dir, aln_bytes[:, start:stop], taxa, start, blocks[0])
+
+        if partitioned_dir is not None:
+            write_partitioned_uce(partitioned_dir, aln_bytes[:, start:stop], taxa, name, start, blocks[0])
+
+        if outfile is not None:
+            write_sitewise(outfile, best_windows, metric_array, sites, name, metrics)
+
+        if trace:
+            record['output_time'] = round(perf_counter() - output_start, 6)
+            trace_file.write(json.dumps(record) + '\n')
+
+    if sitewise_output == 'npz':
+        save_sitewise_npz(outfile, os.path.join(output_dir, outfilename))
+    elif outfile is not None:
+        outfile.close()
+
+    if trace:
+        trace_file.close()
 
     # write the end blocks of the partitionfinder files
-    for m in metrics:
-        pfinder_config_file = open('%s_%s_partition_finder.cfg' % (dataset_name, m), 'a')
+    for pfinder_config_file in pfinder_config_files:
         pfinder_config_file.write(p_finder_end_block(dataset_name))
         pfinder_config_file.close()
 
+    if cache_dir is not None and cache_size is not None:
+        cache_prune(cache_dir, cache_size)
+
+    for charsets_file, indent in charsets_files:
+        charsets_file.write(charsets_end_block())
+        charsets_file.close()
+
+
+def partition_alignment(alignment, taxa, charsets, metrics = ['entropy'], minimum_window_size = 50,
+                        workers = 1, encoded = False):
+    ''' alignment: 2D uint8 array (taxa x sites) with the characters of
+                   the alignment as bytes, as read_nexus(..., encode = False)
+                   gives it, or a list of aligned sequences (strings)
+        taxa: name of each row of alignment
+        charsets: dict of UCE charsets {name: [sites]}, sites counted 
+                  from 0 (as read_nexus gives them). Each UCE spans from
+                  its first to its last site
+        metrics: a list with values of 'gc', 'entropy' or 'multi'
+        minimum_window_size: smallest allowable window
+        workers: number of processes to spread the charsets across
+        encoded: alignment is already encoded (see ENCODING_TABLE)
+
+    finds the best windows of every UCE in memory, as process_dataset_metrics
+    does, without reading or writing files or changing the working
+    directory, so it can be called from threads or worker processes
+
+    returns ->  an ordered dict with, for each charset (in order), a dict of:
+                start, stop: sites of the UCE in the alignment
+                best_windows: {metric: (start, stop)}, within the UCE
+                metrics: {metric: 1D array with a value per site}
+                partitions: {metric: [(name, first site, last site)]}, 
+                            sites counted from 1 in the alignment, as in 
+                            the partitionfinder blocks
+    '''
+
+    aln_bytes = alignment_as_bytes(alignment, taxa, encoded)
+    check_metrics(metrics)
+    tasks = charset_tasks(charsets, aln_bytes.shape[1])
+
+    if workers > 1:
+        results = process_charsets_parallel(aln_bytes, tasks, metrics, minimum_window_size, workers)
+    else:
+        results = (process_charset(aln_bytes, task, metrics, minimum_window_size) for task in tasks)
+
+    partitions = OrderedDict()
+    for (name, start, stop), (best_windows, metric_array, blocks, record) in zip(tasks, results):
+        partitions[name] = {'start': start, 'stop': stop,
+                            'best_windows': dict(zip(metrics, best_windows)),
+                            'metrics': dict(zip(metrics, metric_array)),
+                            'partitions': dict(zip(metrics, blocks))}
+
+    return (partitions)
+
+
+def alignment_as_bytes(alignment, taxa, encoded = False):
+    ''' alignment, taxa, encoded: see partition_alignment
+
+    returns the alignment as a 2D uint8 array of characters
+    '''
+
+    if isinstance(alignment, np.ndarray):
+        aln_bytes = alignment
+        if encoded:
+            # back to characters, as process_charset encodes each UCE
+            aln_bytes = DECODING_TABLE[alignment]
+    else:
+        aln_bytes = sequences_bytes(list(alignment))
+
+    if aln_bytes.ndim != 2 or aln_bytes.dtype != np.uint8:
+        raise ValueError('The alignment must be a 2D uint8 array or a list of sequences')
+    if aln_bytes.shape[0] != len(taxa):
+        raise ValueError('The alignment has %s rows but there are %s taxa' % (aln_bytes.shape[0], len(taxa)))
+
+    return (aln_bytes)
+
+
+def check_metrics(metrics):
+    for metric in metrics:
+        if metric not in METRICS:
+            raise ValueError("Unknown metric %s, use one of %s" % (metric, ', '.join(sorted(METRICS))))
+
+
+def charset_tasks(charsets, n_sites):
+    ''' charsets: dict of UCE charsets {name: [sites]}
+        n_sites: number of sites in the alignment
 
-def write_csvs(best_windows, metric_array, aln_sites, name, outfilename):
+    returns a list of (name, start, stop) of each charset
+    '''
+
+    tasks = []
+    for name in charsets:
+        sites = charsets[name]
+        start, stop = min(sites), max(sites) + 1
+        if start < 0 or stop > n_sites:
+            raise ValueError('Charset %s is outside the alignment' % (name))
+        tasks.append((name, start, stop))
+
+    return (tasks)
+
+
+def process_charset(aln_bytes, task, metrics, minimum_window_size, cache_dir = None, trace = False, counts = None):
+    ''' aln_bytes: the alignment of the whole dataset, as bytes
+                   (see nexus_reader.read_nexus)
+        task: (name, start, stop) of the charset of a UCE
+        metrics: a list of 'gc', 'entropy' or 'multi'
+        cache_dir: result cache to look the UCE up in (and add it to)
+        trace: also return a record of the time and memory it took
+        counts: base counts of the UCE in all the taxa of aln_bytes, if
+                they are already known (see process_dataset_metrics)
+
+    returns ->  best_windows: the best window for each metric
+                metric_array: the metrics of the UCE
+                blocks: the data blocks of each best window (see uce_blocks)
+                record: dict for the trace (see process_dataset_metrics),
+                        None if trace is False
+    '''
+
+    name, start, stop = task
+
+    timings = {'metrics': 0.0, 'scoring': 0.0}
+    if trace:
+        reset_peak_rss()
+    counts_start = perf_counter()
+
+    # slice the alignment to count the UCE, unless its counts are known
+    n_taxa = aln_bytes.shape[0]
+    if counts is None:
+        uce_counts = base_count_matrix(ENCODING_TABLE[aln_bytes[:, start:stop]])
+    else:
+        uce_counts = counts
+    counts_time = perf_counter() - counts_start
+
+    cached = None
+    if cache_dir is not None:
+        key = cache_key(uce_counts, n_taxa, minimum_window_size, metrics)
+        cached = cache_load(cache_dir, key)
+
+    if cached is not None:
+        best_windows, metric_array = cached
+    else:
+        best_windows, metric_array = process_counts(uce_counts, n_taxa, metrics, minimum_window_size, timings)
+        if cache_dir is not None:
+            cache_store(cache_dir, key, best_windows, metric_array)
+
+    # the blocks of the best windows are checked from the
+    # cumulative base counts, without going back to the alignment
+    base_prefix = prefix_counts(uce_counts)
+
+    blocks = [uce_blocks(best_window, name, start, stop, base_prefix) for best_window in best_windows]
+
+    record = None
+    if trace:
+        record = {'name': name, 'start': start, 'stop': stop, 'sites': stop - start, 'taxa': n_taxa,
+                  'windows': count_windows(stop - start, minimum_window_size), 'cached': cached is not None,
+                  'metrics_time': round(counts_time + timings['metrics'], 6),
+                  'scoring_time': round(timings['scoring'], 6),
+                  'peak_rss': peak_rss(), 'pid': os.getpid()}
+
+    return (best_windows, metric_array, blocks, record)
+
+
+# alignment shared with the worker processes, see process_charsets_parallel
+shared_alignment = None
+
+
+def init_shared_alignment(shared_buffer, shape):
+    global shared_alignment
+    shared_alignment = np.frombuffer(shared_buffer, dtype = np.uint8).reshape(shape)
+
+
+def process_charset_shared(args):
+    task, metrics, minimum_window_size, cache_dir, trace, counts = args
+    return (process_charset(shared_alignment, task, metrics, minimum_window_size, cache_dir, trace, counts))
+
+
+def process_charsets_parallel(aln_bytes, tasks, metrics, minimum_window_size, workers, cache_dir = None, trace = False,
+                              stored_counts = {}):
+    ''' aln_bytes: the alignment of the whole dataset, as bytes
+        tasks: list of (name, start, stop) of each charset
+        workers: number of processes
+        stored_counts: dict of the base counts of the UCEs that are
+                       already known, sent to the workers with the tasks
+
+    yields the results of process_charset for each task, in the order
+    of tasks, while the workers take the charsets one at a time (so a
+    long UCE does not hold back the others)
+    '''
+
+    # the workers read the alignment from shared memory, only the
+    # charset coordinates and the results are pickled
+    shared_buffer = multiprocessing.RawArray('B', aln_bytes.size)
+    np.frombuffer(shared_buffer, dtype = np.uint8).reshape(aln_bytes.shape)[:] = aln_bytes
+
+    pool = multiprocessing.Pool(workers, initializer = init_shared_alignment,
+                                initargs = (shared_buffer, aln_bytes.shape))
+    try:
+        args = ((task, metrics, minimum_window_size, cache_dir, trace, stored_counts.get(task[0])) for task in tasks)
+        for result in pool.imap(process_charset_shared, args):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# write buffers for the sitewise metrics and the partitions (bytes)
+SITEWISE_BUFFER_SIZE = 1 << 20
+PARTITION_BUFFER_SIZE = 1 << 16
+
+
+def write_csvs(best_windows, metric_array, aln_sites, name, outfilename, metrics = ['entropy']):
     ''' best_windows: the best window for each metric
-        metrics: a list with values of 'gc', 'entropy' and 'multi'
+        metric_array: the metrics of the UCE, one row per metric
         aln_sites: site number in the alignment 
         name: UCE name
         outfilename: name for the csv file
+        metrics: a list with values of 'gc', 'entropy' and 'multi'
      
     returns -> csv files written to disk
     '''
 
+    outfile = open(outfilename, 'a')
+    write_sitewise_csv(outfile, best_windows, metric_array, aln_sites, name, metrics)
+    outfile.close()
+
+
+def write_sitewise_csv(outfile, best_windows, metric_array, aln_sites, name, metrics = ['entropy']):
+    ''' outfile: open csv file
+        best_windows: the best window for each metric
+        metric_array: the metrics of the UCE, one row per metric
+        aln_sites: site number in the alignment 
+        name: UCE name
+        metrics: a list with values of 'gc', 'entropy' and 'multi'
+     
+    returns -> one csv row per site of the UCE and metric written to outfile
+    '''
+
     N = len(aln_sites)
     middle = int(float(N) / 2.0)
-    uce_sites = np.array(range(N)) - middle
 
-    # make our long lists of things common to all metrics
-    uce_sites = [uce_sites] * 3
-    uce_sites_single_matrix = list(itertools.chain.from_iterable(uce_sites))
-    outfile = open(outfilename, 'a')
-    names = [name] * N * 3
-    aln_sites = [np.array(aln_sites)] * 3 
-    aln_sites_single_matrix = list(itertools.chain.from_iterable(aln_sites))
-
-    # have to separate this in three lists
-    window_start = []
-    window_stop = []
-    matrix_value = []
-    
-    for w in best_windows:
-        window_start.append([w[0]]*N)
-        window_stop.append([w[1]]*N)
-        
-        matrix_value.append(csv_col_to_plot_matrix(w, N))
+    prefix = '%s,' % (name)
+
+    # the rows of each metric, with its own best window
+    for metric, window, values in zip(metrics, best_windows, metric_array):
+        plot_mtx = csv_col_to_plot_matrix(window, N)
+        values = values.tolist()
+
+        window_cols = ',%s,%s,%s,' % (window[0], window[1], metric)
 
-    window_start_entropy = window_start[0]
-    #window_start_gc      = window_start[1]
-    #window_start_multi   = window_start[2]
+        rows = [prefix + str(i - middle) + ',' + str(aln_sites[i]) + window_cols + str(values[i]) + ',' + str(plot_mtx[i]) + '\n'
+                for i in range(N)]
 
-    window_stop_entropy = window_stop[0]
-    #window_stop_gc      = window_stop[1]
-    #window_stop_multi   = window_stop[2]
+        outfile.write(''.join(rows))
 
-    matrix_value_single_matrix = list(itertools.chain.from_iterable(matrix_value))
 
-    window_starts = np.concatenate([window_start_entropy])
-    window_stops = np.concatenate([window_stop_entropy])
+def sitewise_columns(metrics = ['entropy']):
+    ''' metrics: a list with values of 'gc', 'entropy' and 'multi'
+
+    returns -> empty columns for write_sitewise_npz to add UCEs to
+    '''
 
-    # build our types
-    entropy_type = ['entropy'] * N
+    return {'metrics': list(metrics), 'names': [], 'best_windows': [], 'aln_sites': [], 'values': []}
 
-    metric_type = np.concatenate([entropy_type])
 
-    metric_value = np.concatenate([metric_array[0]])
+def write_sitewise_npz(columns, best_windows, metric_array, aln_sites, name, metrics = ['entropy']):
+    ''' columns: columns made by sitewise_columns
+        best_windows: the best window for each metric
+        metric_array: the metrics of the UCE, one row per metric
+        aln_sites: site number in the alignment 
+        name: UCE name
+        metrics: a list with values of 'gc', 'entropy' and 'multi'
+     
+    returns -> the UCE added to columns, to be written by save_sitewise_npz
+    '''
 
-    all_info = [names, uce_sites_single_matrix, aln_sites_single_matrix, 
-                window_starts, window_stops, metric_type, metric_value, 
-                matrix_value_single_matrix]
+    columns['names'].append(name)
+    columns['best_windows'].append(np.array(best_windows, dtype = np.int64).reshape(-1, 2))
+    columns['aln_sites'].append(np.array(aln_sites, dtype = np.int64))
+    columns['values'].append(np.asarray(metric_array, dtype = np.float64).reshape(len(metrics), -1))
+
+
+def save_sitewise_npz(columns, filename):
+    ''' columns: columns filled by write_sitewise_npz
+        filename: name for the npz file
+
+    returns -> one npz file written to disk, with the arrays
+               metrics: the metric names
+               uce_names: the UCE names
+               uce_offsets: where the sites of each UCE start in aln_sites 
+                            and values, plus the total number of sites, so
+                            UCE i is uce_offsets[i]:uce_offsets[i + 1]
+               best_windows: the best window of each UCE for each metric,
+                             shape (UCEs, metrics, 2)
+               aln_sites: site number in the alignment of every UCE site
+               values: the metrics of every UCE site, one row per metric
+               Read them back with np.load or read_sitewise_npz
+    '''
 
-    all_info = zip(*all_info)
+    n_metrics = len(columns['metrics'])
+    lengths = [len(sites) for sites in columns['aln_sites']]
+    offsets = np.zeros(len(lengths) + 1, dtype = np.int64)
+    np.cumsum(lengths, out = offsets[1:])
 
-    for i in all_info:
-        line = [str(thing) for thing in i]
-        line = ','.join(line)
-        outfile.write(line)
-        outfile.write("\n")
+    if len(lengths) > 0:
+        best_windows = np.stack(columns['best_windows'])
+        aln_sites = np.concatenate(columns['aln_sites'])
+        values = np.concatenate(columns['values'], axis = 1)
+    else:
+        best_windows = np.zeros((0, n_metrics, 2), dtype = np.int64)
+        aln_sites = np.zeros(0, dtype = np.int64)
+        values = np.zeros((n_metrics, 0), dtype = np.float64)
+
+    # an open file keeps np.savez from adding .npz to the name
+    outfile = open(filename, 'wb')
+    np.savez(outfile, metrics = np.array(columns['metrics'], dtype = str),
+             uce_names = np.array(columns['names'], dtype = str), uce_offsets = offsets,
+             best_windows = best_windows, aln_sites = aln_sites, values = values)
     outfile.close()
 
 
-def process_uce(aln, metrics, minimum_window_size):
-    ''' aln: biopython generic alignment
+def read_sitewise_npz(filename):
+    ''' filename: file written by save_sitewise_npz
+
+    yields (name, metrics, best_windows, aln_sites, metric_array) for each UCE
+    '''
+
+    with np.load(filename) as npz:
+        metrics = [str(metric) for metric in npz['metrics']]
+        names = npz['uce_names']
+        offsets = npz['uce_offsets']
+        best_windows = npz['best_windows']
+        aln_sites = npz['aln_sites']
+        values = npz['values']
+
+    for i, name in enumerate(names):
+        start, stop = offsets[i], offsets[i + 1]
+        yield (str(name), metrics, [tuple(w) for w in best_windows[i].tolist()],
+               aln_sites[start:stop], values[:, start:stop])
+def process_uce(aln, metrics, minimum_window_size, counts = None, timings = None):
+    ''' aln: biopython generic alignment or an encoded alignment
         metrics: a list with values of 'gc', 'entropy' or 'multi'
+        counts: base counts of aln, if they are already known
+        timings: dict to add the seconds spent in the 'metrics' and
+                 the 'scoring' to
     
     
     returns ->  best_window: the best window for each metric
-                metrics: a list with values of 'entropy' 
+                metrics: array with the values of each metric per site,
+                         one row per metric (in the order of metrics)
     '''
         
-    windows = get_all_windows(aln, minimum_window_size)
-    
-    entropy = sitewise_entropies(aln)
-    
-    metrics = np.array([entropy])
+    aln = as_encoded(aln)
+
+    counts_start = perf_counter()
+
+    # every sitewise metric comes from the same base counts
+    if counts is None:
+        counts = base_count_matrix(aln)
+
+    if timings is not None:
+        timings['metrics'] = timings.get('metrics', 0.0) + perf_counter() - counts_start
+
+    return (process_counts(counts, aln.shape[0], metrics, minimum_window_size, timings))
+
+
+def process_counts(counts, n_taxa, metrics, minimum_window_size, timings = None):
+    ''' counts: 4xN array of base counts (A,C,G,T) by site of a UCE
+        n_taxa: number of sequences in the alignment
+        metrics: a list with values of 'gc', 'entropy' or 'multi'
+        timings: dict to add the seconds spent in the 'metrics' and
+                 the 'scoring' to
+
+    same as process_uce, from the base counts alone
+    '''
+
+    aln_length = counts.shape[1]
+    n_windows = count_windows(aln_length, minimum_window_size)
+
+    metrics_start = perf_counter()
+
+    metric_array = metrics_from_counts(counts, n_taxa, metrics)
 
     # get a list of variant/invariant sites for this uce
-    sitevar = invariant_sites(aln)
+    sitevar = variable_sites_from_counts(counts)
+
+    scoring_start = perf_counter()
 
     # sometimes we can't split a UCE, in which case there's one
     # window and it's the whole UCE
-    if(len(windows)>1):
-        best_window = get_best_windows(metrics, windows, aln.get_alignment_length(), sitevar)
+    if(n_windows>1):
+        best_window = get_best_windows_cumsum(metric_array, aln_length, minimum_window_size, sitevar)
     else:
-        best_window = [windows[0], windows[0], windows[0]]
+        window = first_window(aln_length, minimum_window_size)
+        best_window = [window for metric in metrics]
+
+    if timings is not None:
+        timings['metrics'] = timings.get('metrics', 0.0) + scoring_start - metrics_start
+        timings['scoring'] = timings.get('scoring', 0.0) + perf_counter() - scoring_start
     
-    return (best_window, metrics)
+    return (best_window, metric_array)
 
 def get_best_windows(metrics, windows, aln_length, sitevar):
     ''' an a n-dimensional numpy array, 
         each column is a site in the alignment
         each row is some metric appropriately normalised
+        windows: an iterable of windows, e.g. from get_all_windows
     
     returns ->  the best window for each metric
     '''
 
-    #1. Mak an empty array:
-    #   columns = number of things in windows
-    #   rows = number of rows in metrics
-    all_sses = np.empty((metrics.shape[0], len(windows) ))
-    all_sses[:] = np.NAN # safety first
+    # keep the lowest SSE and the windows that have it as we go,
+    # so the windows and their SSEs are never all in memory
+    entropy_min = np.inf
+    entropy_wins = []
 
-    # 2. Get SSE for each cell in array
-    for i, window in enumerate(windows):
+    for window in windows:
         # get SSE's for a given window
-        all_sses[:,i] = get_sses(metrics, window, sitevar)
+        entropy_sse = get_sses(metrics, window, sitevar)[0]
 
-    # 3. get index of minimum value for each metric
-    entropy_sses = all_sses[0]
-    entropy_mins = np.where(entropy_sses == entropy_sses.min())[0]  
- 
-    # choose the windows with the minimum variance in length of
-    #l-flank, core, r-flank
-    entropy_wins = [windows[i] for i in entropy_mins]
-    entropy = get_min_var_window(entropy_wins, aln_length)
+        if entropy_sse < entropy_min:
+            entropy_min = entropy_sse
+            entropy_wins = [window]
+        elif entropy_sse == entropy_min:
+            entropy_wins.append(window)
 
     # this is a catch for a corner case in which all windows
     # contained at least one block of invariant sites
@@ -188,14 +608,113 @@ def get_best_windows(metrics, windows, aln_length, sitevar):
     # we therefore can't split the UCE. To flag this, we 
     # return the window as [0, aln_length], and this is 
     # picked up later as a non-splittable UCE
-    if entropy_sses.min() == np.inf:
-        entropy = (0, aln_length)
+    if entropy_min == np.inf:
+        return ([(0, aln_length)])
+
+    # choose the windows with the minimum variance in length of
+    #l-flank, core, r-flank
+    entropy = get_min_var_window(entropy_wins, aln_length)
 
     best_windows = [entropy]
 
     return (best_windows)
 
 
+# number of windows scored at once by get_best_windows_cumsum. Each
+# block needs a few arrays of this many floats, whatever the UCE length
+WINDOW_BLOCK_SIZE = 1 << 18
+
+
+def get_best_windows_cumsum(metrics, aln_length, minimum_window_size, sitevar, block_size = WINDOW_BLOCK_SIZE):
+    ''' same as get_best_windows, but scores the windows from cumulative
+        sums of the metric (O(L^2) instead of O(L^3)), block_size windows
+        at a time (see window_blocks), keeping the lowest SSE of each 
+        metric and the windows close to it
+
+    returns ->  the best window for each metric
+    '''
+
+    variable_prefix = prefix_counts(np.asarray(sitevar) > 0)
+
+    # SSEs do not change when the metric is shifted, and centring it
+    # keeps the cumulative sums small (log-likelihoods are far from 0)
+    centred = [np.asarray(metric, dtype = np.float64) - np.mean(metric) for metric in metrics]
+    prefixes = [(prefix_counts(metric), prefix_counts(metric ** 2)) for metric in centred]
+
+    # the cumulative sums only approximate the SSEs that get_sse would
+    # give, so every window within tolerance of the lowest SSE is kept 
+    # and scored again with window_sse
+    tolerances = [1e-8 * (1.0 + np.sum(metric ** 2)) for metric in centred]
+    approx_mins = [np.inf for metric in metrics]
+    candidates = [[] for metric in metrics]
+
+    for starts, stops in window_blocks(aln_length, minimum_window_size, block_size):
+
+        # the windows that are long enough and leave no block with only
+        # invariant sites are the same for every metric
+        valid = valid_windows_mask(variable_prefix, starts, stops, minimum_window_size)
+        rows, cols = np.nonzero(valid)
+        if len(rows) == 0:
+            continue
+        block_starts = starts[rows]
+        block_stops = stops[cols]
+
+        for i, (csum, csum_sq) in enumerate(prefixes):
+            sses = windows_sse_from_prefix(csum, csum_sq, block_starts, block_stops)
+
+            block_min = sses.min()
+            if block_min < approx_mins[i]:
+                approx_mins[i] = block_min
+                # forget the windows that are no longer close to the lowest SSE
+                limit = block_min + tolerances[i]
+                candidates[i] = [(c_sses[c_sses <= limit], c_starts[c_sses <= limit], c_stops[c_sses <= limit])
+                                 for c_sses, c_starts, c_stops in candidates[i]]
+
+            near = sses <= approx_mins[i] + tolerances[i]
+            if near.any():
+                candidates[i].append((sses[near], block_starts[near], block_stops[near]))
+
+    if approx_mins[0] == np.inf:
+        # all windows contain at least one block of invariant sites,
+        # see get_best_windows
+        return ([(0, aln_length) for metric in metrics])
+
+    best_windows = []
+    for metric, metric_candidates in zip(metrics, candidates):
+        # the candidates are in the order of get_all_windows, so ties
+        # are broken exactly as get_best_windows would do it
+        wins = [(int(a), int(b)) for c_sses, c_starts, c_stops in metric_candidates
+                                 for a, b in zip(c_starts, c_stops)]
+        sses = np.array([window_sse(metric, w) for w in wins])
+        mins = np.where(sses == sses.min())[0]
+
+        # choose the windows with the minimum variance in length of
+        #l-flank, core, r-flank
+        wins = [wins[i] for i in mins]
+        best_windows.append(get_min_var_window(wins, aln_length))
+
+    return (best_windows)
+
+
+def windows_sse_from_prefix(csum, csum_sq, starts, stops):
+    ''' csum, csum_sq: cumulative sums of a metric and of its squares
+        starts, stops: 1D arrays with the windows
+
+    returns ->  1D array with the SSE of each window, the sum of the 
+                SSEs of its left flank, core and right flank
+    '''
+
+    length = len(csum) - 1
+
+    # the sum of metric[a:b] is csum[b] - csum[a]
+    def block_sse(a, b):
+        s = csum[b] - csum[a]
+        return (csum_sq[b] - csum_sq[a] - s * s / (b - a))
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return (block_sse(0, starts) + block_sse(starts, stops) + block_sse(stops, length))
+
+
 def get_sses(metrics, window, sitevar):
     ''' metrics is an array where each row is a metric
         and each column is a site window gives slice 
@@ -220,6 +739,14 @@ def get_sse(metric, window, sitevar):
     if(aln_l == True or aln_c == True or aln_r == True):
         return np.inf
 
+    return (window_sse(metric, window))
+
+
+def window_sse(metric, window):
+    ''' slice the 1D array metric, add up the SSES, without
+        checking for blocks of invariant sites
+    '''
+
     left  = sse(metric[ : window[0]])
     core  = sse(metric[window[0] : window[1]])
     right = sse(metric[window[1] : ])
@@ -240,49 +767,24 @@ def sse(metric):
     return (sse)
 
 def sitewise_gc(aln):
-    ''' aln: biopython generic alignment
+    ''' aln: biopython generic alignment or an encoded alignment
     
     returns ->  array with values of gc per site
     '''
     
-    gc = []
-    for i in range(aln.get_alignment_length()):
-        site_i = aln[:,i]
-        gc_i = SeqUtils.GC(site_i)
-        gc.append(gc_i)
-
-    gc = np.array(gc)
+    aln = as_encoded(aln)
+    gc = gc_from_counts(base_count_matrix(aln), aln.shape[0])
 
     return (gc)
 
 def sitewise_multi(uce_aln):
-    ''' aln: biopython generic alignment
+    ''' aln: biopython generic alignment or an encoded alignment
      
     returns ->  1D numpy array with multinomial values for each site
     '''
 
-    # preprocess stuff we need a lot
-    uce_counts  = sitewise_base_counts(uce_aln)
-    uce_sums = uce_counts.sum(axis = 0)
-
-    uce_n_obs_factorial = []
-    for s in uce_sums:
-        f = factorial(s)
-        uce_n_obs_factorial.append(f)
-
-
-    uce_factorials = factorial_matrix(uce_counts)
-
-    # sanity checks
-    m1 = np.min(uce_factorials)
-    m2 = np.min(uce_n_obs_factorial)
-    m3 = min([m1, m2])
-    if(m3<0):
-        raise ValueError('One of your factorials is <0, this is bad, quitting)')
-
-    sitewise_likelihoods = sitewise_multi_count(uce_counts, uce_factorials, uce_n_obs_factorial)
-
-    log_likelihoods = np.log(sitewise_likelihoods)
+    uce_counts = sitewise_base_counts(uce_aln)
+    log_likelihoods = multinomial_from_counts(uce_counts)
 
     return(log_likelihoods)
 
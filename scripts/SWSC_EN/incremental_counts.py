@@ -0,0 +1,229 @@
+''' Base counts of the UCEs of a dataset, kept so that SWSC-EN can be
+    run again when taxa are added without reading or counting the taxa
+    it has already seen.
+
+    Every metric, the invariant sites and the window search come from
+    the base counts of each UCE, and the counts of a set of taxa are the
+    sum of the counts of each taxon. So the counts of the new taxa are
+    added to the stored ones and the UCEs are partitioned from the
+    counts alone:
+
+        store = count_alignment(aln_bytes, taxa, charsets)
+        save_counts(store, 'dataset.counts.npz')
+        ...
+        store = load_counts('dataset.counts.npz')
+        changed = add_taxa(store, new_aln_bytes, new_taxa, new_charsets)
+        partitions = partition_counts(store, ['entropy'], 50, changed)
+
+    SWSCEN.py --counts keeps the store of a dataset that is run again
+    with more taxa, through update_counts.
+'''
+from functions_metrics import *
+import numpy as np
+import os
+import tempfile
+from collections import OrderedDict
+
+
+def count_alignment(alignment, taxa, charsets, encoded = False):
+    ''' alignment, taxa, charsets, encoded: see partition_alignment
+
+    returns ->  a counts store, a dict of:
+                taxa: the taxa counted so far
+                uces: ordered dict with, for each charset, a dict of
+                      start, stop: sites of the UCE in the alignment
+                      counts: 4xN array of base counts (A,C,G,T) by site
+    '''
+
+    store = {'taxa': [], 'uces': OrderedDict()}
+    add_taxa(store, alignment, taxa, charsets, encoded)
+
+    return (store)
+
+
+def add_taxa(store, alignment, taxa, charsets, encoded = False):
+    ''' store: counts store (see count_alignment), updated in place
+        alignment: the alignment of the new taxa only (see partition_alignment)
+        taxa: name of each row of alignment
+        charsets: dict of UCE charsets {name: [sites]} of alignment. The
+                  UCEs are matched by name, so the new taxa may come in
+                  their own concatenated alignment
+        encoded: alignment is already encoded (see ENCODING_TABLE)
+
+    UCEs not in the store are added with the counts of the new taxa.
+    A UCE with a different number of sites than the stored one was
+    aligned again, and its counts can't be updated
+
+    returns -> the names of the UCEs where the new taxa have any base,
+               the only ones whose partitions can change
+    '''
+
+    repeated = set(taxa).intersection(store['taxa'])
+    if repeated:
+        raise ValueError('Taxa already counted: %s' % (', '.join(sorted(repeated))))
+
+    aln_bytes = alignment_as_bytes(alignment, taxa, encoded)
+    tasks = charset_tasks(charsets, aln_bytes.shape[1])
+
+    for name, start, stop in tasks:
+        uce = store['uces'].get(name)
+        if uce is not None and uce['stop'] - uce['start'] != stop - start:
+            raise ValueError('UCE %s has %s sites, %s in the stored counts: count it again from the whole alignment'
+                             % (name, stop - start, uce['stop'] - uce['start']))
+
+    changed = []
+    for name, start, stop in tasks:
+        counts = base_count_matrix(ENCODING_TABLE[aln_bytes[:, start:stop]])
+
+        if name in store['uces']:
+            store['uces'][name]['counts'] += counts
+        else:
+            store['uces'][name] = {'start': start, 'stop': stop, 'counts': counts}
+
+        if counts.any():
+            changed.append(name)
+
+    store['taxa'].extend(taxa)
+
+    return (changed)
+
+
+def partition_counts(store, metrics = ['entropy'], minimum_window_size = 50, names = None):
+    ''' store: counts store (see count_alignment)
+        metrics: a list with values of 'gc', 'entropy' or 'multi'
+        minimum_window_size: smallest allowable window
+        names: UCEs to partition (default: all of them), e.g. the ones
+               add_taxa returns
+
+    returns ->  the partitions of the UCEs as partition_alignment gives
+                them, with the sites of the first alignment each UCE
+                was counted from
+    '''
+
+    check_metrics(metrics)
+
+    if names is None:
+        names = list(store['uces'])
+
+    n_taxa = len(store['taxa'])
+
+    partitions = OrderedDict()
+    for name in names:
+        uce = store['uces'][name]
+        start, stop, counts = uce['start'], uce['stop'], uce['counts']
+
+        best_windows, metric_array = process_counts(counts, n_taxa, metrics, minimum_window_size)
+
+        base_prefix = prefix_counts(counts)
+        blocks = [uce_blocks(best_window, name, start, stop, base_prefix) for best_window in best_windows]
+
+        partitions[name] = {'start': start, 'stop': stop,
+                            'best_windows': dict(zip(metrics, best_windows)),
+                            'metrics': dict(zip(metrics, metric_array)),
+                            'partitions': dict(zip(metrics, blocks))}
+
+    return (partitions)
+
+
+def save_counts(store, filename):
+    ''' store: counts store (see count_alignment)
+        filename: .npz file to write, through a temporary file so an
+                  interrupted run never leaves half a store
+    '''
+
+    names = list(store['uces'])
+    uces = [store['uces'][name] for name in names]
+
+    counts = [uce['counts'] for uce in uces]
+    if counts:
+        counts = np.concatenate(counts, axis = 1)
+    else:
+        counts = np.zeros((len(BASES), 0), dtype = np.int64)
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(suffix = '.tmp', dir = directory)
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            np.savez(tmp_file, taxa = np.array(store['taxa'], dtype = np.str_),
+                     names = np.array(names, dtype = np.str_),
+                     starts = np.array([uce['start'] for uce in uces], dtype = np.int64),
+                     stops = np.array([uce['stop'] for uce in uces], dtype = np.int64),
+                     counts = counts)
+        os.replace(tmp_path, filename)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def load_counts(filename):
+    ''' filename: .npz file written by save_counts
+
+    returns -> the counts store
+    '''
+
+    saved = np.load(filename)
+
+    store = {'taxa': saved['taxa'].tolist(), 'uces': OrderedDict()}
+
+    # the counts of the UCEs were saved one after the other
+    offset = 0
+    counts = saved['counts']
+    for name, start, stop in zip(saved['names'].tolist(), saved['starts'].tolist(), saved['stops'].tolist()):
+        store['uces'][name] = {'start': start, 'stop': stop,
+                               'counts': counts[:, offset : offset + stop - start].copy()}
+        offset += stop - start
+
+    saved.close()
+
+    return (store)
+
+
+def update_counts(filename, alignment, taxa, charsets, encoded = False):
+    ''' filename: .npz file of the counts store (see save_counts), made
+                  if it is not there yet
+        alignment: the whole alignment, with the taxa already in the
+                   store and the new ones (see partition_alignment)
+        taxa, charsets, encoded: see partition_alignment
+
+    Only the taxa that are not in the store are counted, for the UCEs
+    already in it. UCEs that are new, or have a different number of
+    sites than the stored ones, are counted from all the taxa, and the
+    ones no longer in charsets are dropped, so the store always has the
+    counts of every taxon of the alignment
+
+    returns -> the updated store, also saved to filename
+    '''
+
+    if os.path.exists(filename):
+        store = load_counts(filename)
+    else:
+        store = {'taxa': [], 'uces': OrderedDict()}
+
+    missing = set(store['taxa']).difference(taxa)
+    if missing:
+        raise ValueError('Taxa in %s but not in the alignment: %s' % (filename, ', '.join(sorted(missing))))
+
+    aln_bytes = alignment_as_bytes(alignment, taxa, encoded)
+    tasks = charset_tasks(charsets, aln_bytes.shape[1])
+
+    kept = OrderedDict()
+    for name, start, stop in tasks:
+        uce = store['uces'].get(name)
+        if uce is not None and uce['stop'] - uce['start'] == stop - start:
+            uce['start'], uce['stop'] = start, stop
+            kept[name] = uce
+    store['uces'] = kept
+
+    counted = set(store['taxa'])
+    new_rows = [i for i, taxon in enumerate(taxa) if taxon not in counted]
+    add_taxa(store, aln_bytes[new_rows], [taxa[i] for i in new_rows],
+             OrderedDict((name, charsets[name]) for name in kept))
+
+    for name, start, stop in tasks:
+        if name not in store['uces']:
+            counts = base_count_matrix(ENCODING_TABLE[aln_bytes[:, start:stop]])
+            store['uces'][name] = {'start': start, 'stop': stop, 'counts': counts}
+
+    save_counts(store, filename)
+
+    return (store)
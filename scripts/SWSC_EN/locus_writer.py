@@ -0,0 +1,101 @@
+from utilities import ENCODING_TABLE, UNDETERMINED, charsets_start_block, charsets_end_block
+import numpy as np
+import os
+import re
+
+
+def write_uce_loci(loci_dir, uce_bytes, taxa, start, blocks):
+    ''' loci_dir: output directory
+        uce_bytes: the UCE slice of the alignment, as bytes (taxa x sites)
+        taxa: taxa of the alignment
+        start: first site of the UCE in the alignment (from 0)
+        blocks: data blocks of the UCE from uce_blocks
+
+    returns -> one nexus per data block, <block name>.nexus, written to
+               loci_dir, as phyluce_align_split_concat_nexus_to_loci does
+    '''
+
+    rows = taxa_with_data(uce_bytes)
+
+    for name, first, last in blocks:
+        block_bytes = uce_bytes[rows, first - 1 - start : last - start]
+        write_nexus(os.path.join(loci_dir, '%s.nexus' % (name)), block_bytes, [taxa[row] for row in rows])
+
+
+def write_partitioned_uce(partitioned_dir, uce_bytes, taxa, name, start, blocks):
+    ''' partitioned_dir: output directory
+        uce_bytes: the UCE slice of the alignment, as bytes (taxa x sites)
+        taxa: taxa of the alignment
+        name: UCE name
+        start: first site of the UCE in the alignment (from 0)
+        blocks: data blocks of the UCE from uce_blocks
+
+    returns -> the UCE alignment (<name>.phylip) and its data blocks as
+               nexus charsets (<name>.charsets) written to partitioned_dir
+    '''
+
+    rows = taxa_with_data(uce_bytes)
+
+    write_phylip(os.path.join(partitioned_dir, '%s.phylip' % (name)), uce_bytes[rows], [taxa[row] for row in rows])
+
+    # the blocks cover the UCE, so their sites are shifted to start at 1
+    charsets_file = open(os.path.join(partitioned_dir, '%s.charsets' % (name)), 'w')
+    charsets_file.write('#NEXUS\n' + charsets_start_block())
+    for block_name, first, last in blocks:
+        charsets_file.write('charset %s = %s-%s;\n' % (block_name.replace('.nexus', ''), first - start, last - start))
+    charsets_file.write(charsets_end_block())
+    charsets_file.close()
+
+
+def taxa_with_data(uce_bytes):
+    ''' uce_bytes: the UCE slice of the alignment, as bytes (taxa x sites)
+
+    returns the rows of the taxa with any base in the UCE; the others
+    were only filled with missing data when the UCEs were concatenated
+    '''
+    return (np.nonzero((ENCODING_TABLE[uce_bytes] != UNDETERMINED).any(axis = 1))[0])
+
+
+def write_nexus(filename, aln_bytes, taxa):
+    ''' filename: nexus file to write
+        aln_bytes: alignment as bytes (taxa x sites)
+        taxa: name of each row of aln_bytes
+    '''
+
+    names = [nexus_name(taxon) for taxon in taxa]
+    width = max([len(name) for name in names] + [0]) + 2
+
+    nexus_file = open(filename, 'w')
+    nexus_file.write('#NEXUS\n' +
+                     'begin data;\n' +
+                     '\tdimensions ntax=%s nchar=%s;\n' % (aln_bytes.shape[0], aln_bytes.shape[1]) +
+                     '\tformat datatype=dna missing=? gap=-;\n' +
+                     'matrix\n')
+    for name, row in zip(names, aln_bytes):
+        nexus_file.write(name.ljust(width) + row.tobytes().decode('ascii') + '\n')
+    nexus_file.write(';\nend;\n')
+    nexus_file.close()
+
+
+def write_phylip(filename, aln_bytes, taxa):
+    ''' filename: phylip file to write
+        aln_bytes: alignment as bytes (taxa x sites)
+        taxa: name of each row of aln_bytes
+
+    writes a sequential relaxed phylip (names of any length)
+    '''
+
+    width = max([len(taxon) for taxon in taxa] + [0]) + 2
+
+    phylip_file = open(filename, 'w')
+    phylip_file.write(' %s %s\n' % (aln_bytes.shape[0], aln_bytes.shape[1]))
+    for taxon, row in zip(taxa, aln_bytes):
+        phylip_file.write(taxon.ljust(width) + row.tobytes().decode('ascii') + '\n')
+    phylip_file.close()
+
+
+def nexus_name(name):
+    # quote names with spaces or punctuation, as read by nexus_reader.unquote
+    if re.search(r"[\s()\[\]{}/\\,;:=*'\"`<>+-]", name):
+        return ("'%s'" % (name.replace("'", "''")))
+    return (name)
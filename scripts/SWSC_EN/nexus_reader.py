@@ -0,0 +1,214 @@
+from utilities import ENCODING_TABLE
+from Bio.Nexus import Nexus
+from Bio import AlignIO
+from collections import OrderedDict
+import numpy as np
+import re
+
+
+def read_nexus(dataset_path, encode = True):
+    ''' dataset_path: path to a nexus alignment with UCE charsets, as
+        written by phyluce (interleaved or not, charsets in 'begin sets;')
+        encode: encode the alignment, otherwise keep the characters of
+                the file as bytes (encode slices with ENCODING_TABLE[...])
+
+    reads the file once, line by line, writing each sequence straight
+    into the encoded alignment (see utilities.ENCODING_TABLE)
+
+    returns ->  encoded alignment (taxa x sites), list of taxa and
+                an ordered dict of charsets {name: [sites]}, with sites
+                counted from 0 as in Bio.Nexus
+    '''
+
+    ntax = nchar = None
+    encoded = None
+    taxa = []
+    taxon_row = {}
+    filled = []
+    charsets = OrderedDict()
+
+    block = None
+    in_matrix = False
+    statement = ''
+
+    nexus_file = open(dataset_path, 'r')
+
+    for line in nexus_file:
+
+        if in_matrix:
+            line = line.strip()
+            end_of_matrix = line.endswith(';')
+            line = line.rstrip(';').strip()
+
+            if line != '':
+                name, sequence = split_matrix_line(line)
+                if name not in taxon_row:
+                    if len(taxa) == ntax:
+                        raise Nexus.NexusError('More than ntax=%s taxa in %s' % (ntax, dataset_path))
+                    taxon_row[name] = len(taxa)
+                    taxa.append(name)
+                    filled.append(0)
+                row = taxon_row[name]
+
+                sequence = sequence.encode('ascii', 'replace')
+                start = filled[row]
+                stop = start + len(sequence)
+                if stop > nchar:
+                    raise Nexus.NexusError('Taxon %s has more than nchar=%s sites in %s' % (name, nchar, dataset_path))
+                sequence = np.frombuffer(sequence, dtype = np.uint8)
+                encoded[row, start:stop] = ENCODING_TABLE[sequence] if encode else sequence
+                filled[row] = stop
+
+            if end_of_matrix:
+                in_matrix = False
+            continue
+
+        line = strip_comments(line).strip()
+        if line == '' or line.lower() == '#nexus':
+            continue
+
+        # the matrix command is not followed by ';', its data is
+        if statement == '' and block in ('data', 'characters') and line.split()[0].lower() == 'matrix':
+            if ntax is None or nchar is None:
+                raise Nexus.NexusError('No ntax/nchar dimensions before the matrix in %s' % (dataset_path))
+            encoded = np.empty((ntax, nchar), dtype = np.uint8)
+            in_matrix = True
+            continue
+
+        # everything else is read as statements ending in ';'
+        statement = (statement + ' ' + line).strip()
+        if not statement.endswith(';'):
+            continue
+        statement, command = '', statement.rstrip(';').strip()
+        keyword = command.split()[0].lower()
+
+        if keyword == 'begin':
+            block = command.split()[1].lower()
+
+        elif keyword in ('end', 'endblock'):
+            block = None
+
+        elif block in ('data', 'characters'):
+
+            if keyword == 'dimensions':
+                ntax = nexus_option(command, 'ntax', int)
+                nchar = nexus_option(command, 'nchar', int)
+
+            elif keyword == 'format':
+                if nexus_option(command, 'matchchar', str) is not None:
+                    raise Nexus.NexusError('matchchar is not supported in %s' % (dataset_path))
+
+        elif block == 'sets' and keyword == 'charset':
+            name, sites = parse_charset(command, nchar)
+            charsets[name] = sites
+
+    nexus_file.close()
+
+    if encoded is None:
+        raise Nexus.NexusError('No matrix found in %s' % (dataset_path))
+
+    if len(taxa) != ntax or min(filled) != nchar or max(filled) != nchar:
+        raise Nexus.NexusError('Matrix in %s does not match ntax=%s nchar=%s' % (dataset_path, ntax, nchar))
+
+    return (encoded, taxa, charsets)
+
+
+def read_nexus_biopython(dataset_path, encode = True):
+    ''' dataset_path: path to a nexus alignment with UCE charsets
+
+    same as read_nexus, but parses the file twice with Biopython
+    (Nexus for the charsets, AlignIO for the matrix)
+    '''
+    from utilities import encode_alignment, alignment_bytes
+
+    dat = Nexus.Nexus()
+    dat.read(dataset_path)
+    aln = AlignIO.read(open(dataset_path), "nexus")
+
+    taxa = [record.id for record in aln]
+    charsets = OrderedDict((name, dat.charsets[name]) for name in dat.charsets)
+
+    if not encode:
+        return (alignment_bytes(aln), taxa, charsets)
+
+    return (encode_alignment(aln), taxa, charsets)
+
+
+def copy_nexus_matrix(dataset_path, outfile):
+    ''' dataset_path: path to a nexus alignment with UCE charsets
+        outfile: open file
+
+    writes every line of the nexus before its sets block to outfile
+    '''
+    nexus_file = open(dataset_path, 'r')
+
+    for line in nexus_file:
+        if line.strip().lower().startswith('begin sets;'):
+            break
+        outfile.write(line)
+
+    nexus_file.close()
+
+
+def strip_comments(line):
+    # remove [comments] within a line
+    return (re.sub(r'\[[^\]]*\]', '', line))
+
+
+def unquote(name):
+    # nexus names with punctuation are written between single quotes
+    if len(name) > 1 and name[0] == name[-1] == "'":
+        return (name[1:-1].replace("''", "'"))
+    return (name)
+
+
+def split_matrix_line(line):
+    ''' line: a line of the matrix, e.g. 'taxon_name  acgt-acgt'
+
+    returns the taxon name and the sequence in the line
+    '''
+    if line[0] == "'":
+        end = line.index("'", 1)
+        while line[end + 1 : end + 2] == "'": # escaped quote
+            end = line.index("'", end + 2)
+        name = unquote(line[: end + 1])
+        sequence = line[end + 1 :]
+    else:
+        fields = line.split(None, 1)
+        name = fields[0]
+        sequence = fields[1] if len(fields) > 1 else ''
+
+    return (name, ''.join(sequence.split()))
+
+
+def nexus_option(command, option, convert):
+    # value of option=value in a nexus command, None if it is not there
+    match = re.search(r'\b%s\s*=\s*(\S+)' % (option), command, re.IGNORECASE)
+    if match is None:
+        return (None)
+    return (convert(match.group(1)))
+
+
+def parse_charset(command, nchar):
+    ''' command: e.g. "charset 'uce_49.nexus' = 1-378"
+        nchar: number of sites in the alignment, for '.'
+
+    returns the charset name and its list of sites (counted from 0)
+    '''
+    name, spec = command.split(None, 1)[1].split('=', 1)
+    name = unquote(name.strip())
+
+    # allow spaces around '-' and '\'
+    spec = re.sub(r'\s*([-\\])\s*', r'\1', spec.strip())
+
+    sites = []
+    for item in spec.split():
+        match = re.match(r'^(\d+)(?:-(\d+|\.))?(?:\\(\d+))?$', item)
+        if match is None:
+            raise Nexus.NexusError('Cannot read charset %s: %s' % (name, spec))
+        first = int(match.group(1))
+        last = first if match.group(2) is None else (nchar if match.group(2) == '.' else int(match.group(2)))
+        step = 1 if match.group(3) is None else int(match.group(3))
+        sites.extend(range(first - 1, last, step))
+
+    return (name, sites)
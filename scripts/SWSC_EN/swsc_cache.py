@@ -0,0 +1,208 @@
+import numpy as np
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import zipfile
+import argparse
+from time import ctime
+
+# bump this when a change to the metrics or to the window search
+# changes the results, so older entries are never used
+CACHE_VERSION = 1
+
+CACHE_SUFFIX = '.npz'
+
+
+def cache_key(counts, n_taxa, minimum_window_size, metrics):
+    ''' counts: 4xN array of base counts (A,C,G,T) by site of a UCE
+        n_taxa: number of sequences in the alignment
+        minimum_window_size: smallest allowable window
+        metrics: a list with values of 'gc', 'entropy' or 'multi'
+
+    returns the hex digest that identifies the results of this UCE.
+    Every metric comes from the base counts, so taxa with no data
+    (added when the UCEs are concatenated) or a different order of
+    the taxa do not change the key. Only gc depends on the number
+    of taxa
+    '''
+
+    counts = np.ascontiguousarray(counts, dtype = np.int64)
+
+    key = hashlib.sha1()
+    key.update(('%s|%s|%s|%s|' % (CACHE_VERSION, minimum_window_size, ','.join(metrics),
+                                  n_taxa if 'gc' in metrics else '')).encode('ascii'))
+    key.update(('%s|' % (counts.shape[1])).encode('ascii'))
+    key.update(counts.tobytes())
+
+    return (key.hexdigest())
+
+
+def cache_path(cache_dir, key):
+    return (os.path.join(cache_dir, key + CACHE_SUFFIX))
+
+
+def cache_load(cache_dir, key):
+    ''' cache_dir: cache directory
+        key: from cache_key
+
+    returns ->  (best_windows, metric_array) of the UCE, or None if
+                it is not in the cache (or the entry can't be read)
+    '''
+
+    path = cache_path(cache_dir, key)
+
+    try:
+        entry = np.load(path)
+        best_windows = [tuple(w) for w in entry['best_windows'].tolist()]
+        metric_array = entry['metric_array']
+        entry.close()
+    except (IOError, OSError, ValueError, KeyError, zipfile.BadZipfile):
+        return (None)
+
+    # the access time is what cache_prune evicts by
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+    return (best_windows, metric_array)
+
+
+def cache_store(cache_dir, key, best_windows, metric_array):
+    ''' cache_dir: cache directory
+        key: from cache_key
+        best_windows: the best window for each metric
+        metric_array: the metrics of the UCE, one row per metric
+
+    returns -> the entry written to cache_dir. It is written to a
+               temporary file first, so processes that share the cache
+               never read half an entry
+    '''
+
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # another process made it first
+            if not os.path.isdir(cache_dir):
+                raise
+
+    fd, tmp_path = tempfile.mkstemp(suffix = '.tmp', dir = cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            np.savez(tmp_file, best_windows = np.array(best_windows, dtype = np.int64).reshape(-1, 2),
+                     metric_array = np.asarray(metric_array, dtype = np.float64))
+        os.replace(tmp_path, cache_path(cache_dir, key))
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def cache_entries(cache_dir):
+    ''' cache_dir: cache directory
+
+    returns a list of (last use, size in bytes, path) of the entries,
+    least recently used first
+    '''
+
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return (entries)
+
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(CACHE_SUFFIX):
+            path = os.path.join(cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # pruned by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    entries.sort()
+
+    return (entries)
+
+
+def cache_prune(cache_dir, max_size):
+    ''' cache_dir: cache directory
+        max_size: largest size of the cache in bytes
+
+    returns -> the number of entries removed, least recently used
+               first, until the cache fits in max_size
+    '''
+
+    entries = cache_entries(cache_dir)
+    total = sum(size for last_use, size, path in entries)
+
+    removed = 0
+    for last_use, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+
+    return (removed)
+
+
+def parse_size(size):
+    ''' size: a number of bytes, optionally followed by K, M, G or T
+
+    returns the size in bytes
+    '''
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError('Cannot read size %s, use e.g. 500M or 2G' % (size))
+
+    power = ' KMGT'.index(match.group(2).upper() or ' ')
+
+    return (int(float(match.group(1)) * 1024 ** power))
+
+
+def format_size(size):
+    for unit in ['B', 'K', 'M', 'G']:
+        if size < 1024:
+            return ('%.1f%s' % (size, unit))
+        size /= 1024.0
+    return ('%.1fT' % (size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Inspect or prune an SWSC-EN result cache')
+    subparsers = parser.add_subparsers(dest = 'command')
+
+    inspect_parser = subparsers.add_parser('inspect', help = 'number, size and age of the cached UCEs')
+    inspect_parser.add_argument('cache_dir')
+
+    prune_parser = subparsers.add_parser('prune', help = 'remove the least recently used UCEs')
+    prune_parser.add_argument('cache_dir')
+    prune_parser.add_argument('--max-size', default = '0',
+                              help = 'size to shrink the cache to, e.g. 500M or 2G (default: 0, empty it)')
+
+    args = parser.parse_args()
+
+    if args.command == 'inspect':
+        entries = cache_entries(args.cache_dir)
+        print('%s: %s UCEs, %s' % (args.cache_dir, len(entries), format_size(sum(e[1] for e in entries))))
+        if entries:
+            print('least recently used: %s' % (ctime(entries[0][0])))
+            print('most recently used:  %s' % (ctime(entries[-1][0])))
+
+    elif args.command == 'prune':
+        removed = cache_prune(args.cache_dir, parse_size(args.max_size))
+        entries = cache_entries(args.cache_dir)
+        print('removed %s UCEs, %s UCEs left (%s)' % (removed, len(entries), format_size(sum(e[1] for e in entries))))
+
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
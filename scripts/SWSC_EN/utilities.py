@@ -1,9 +1,9 @@
 import os
+import sys
 from pathlib2 import Path
 from Bio import AlignIO, SeqIO, SeqUtils
-from itertools import combinations
 import numpy as np
-from math import factorial
+from math import factorial, lgamma
 from Bio.Nexus import Nexus
 
 def check_taxa(matrices):
@@ -66,12 +66,42 @@ def output_conc_nex(mypath, outfilename, same_taxa=False):
     return None
 
 
-def blocks_pfinder_config(best_window, name, start, stop, uce_aln):
+def blocks_pfinder_config(best_window, name, start, stop, base_prefix):
+    ''' best_window: the best window of the UCE
+        name: UCE name
+        start, stop: UCE sites in the alignment
+        base_prefix: cumulative base counts of the UCE, see prefix_counts
+
+        returns str with the data blocks of this UCE for the pFinder config
+    '''
+
+    blocks = uce_blocks(best_window, name, start, stop, base_prefix)
+
+    return (pfinder_data_blocks(blocks))
+
+
+def pfinder_data_blocks(blocks):
+    ''' blocks: data blocks from uce_blocks, (name, first site, last site)
+
+        returns str with the data blocks for the pFinder config
+    '''
+    return (''.join('%s = %s-%s;\n' % block for block in blocks))
+
+
+def uce_blocks(best_window, name, start, stop, base_prefix):
+    ''' best_window: the best window of the UCE
+        name: UCE name
+        start, stop: UCE sites in the alignment
+        base_prefix: cumulative base counts of the UCE, see prefix_counts
+
+        returns a list of (block name, first site, last site) with the
+        left flank, core and right flank of the UCE, or only the whole
+        UCE (name_all), with sites counted from 1 in the alignment
+    '''
 
     # sometimes we couldn't split the window so it's all together
     if(best_window[1]-best_window[0] == stop-start):
-        whole_UCE = '%s_all = %s-%s;\n' % (name, start+1, stop)
-        return (whole_UCE)
+        return ([('%s_all' % (name), start+1, stop)])
 
     else:
         # left flank
@@ -87,46 +117,80 @@ def blocks_pfinder_config(best_window, name, start, stop, uce_aln):
         right_end = stop
 
     # do not output any undetermined blocks - if this happens, just output the whole UCE
-    if(any_undetermined_blocks(best_window, uce_aln)==True or any_blocks_without_all_sites(best_window, uce_aln)==True):
-        whole_UCE = '%s_all = %s-%s;\n' % (name, start+1, stop)
-        return (whole_UCE)
+    if(any_undetermined_blocks(best_window, base_prefix)==True or any_blocks_without_all_sites(best_window, base_prefix)==True):
+        return ([('%s_all' % (name), start+1, stop)])
     else:
-        core_UCE = '%s_core = %s-%s;\n' % (name, core_start, core_end)
-        left_UCE = '%s_left = %s-%s;\n' % (name, left_start, left_end)
-        right_UCE = '%s_right = %s-%s;\n' % (name, right_start, right_end)
+        return ([('%s_left' % (name), left_start, left_end),
+                 ('%s_core' % (name), core_start, core_end),
+                 ('%s_right' % (name), right_start, right_end)])
 
-        return (left_UCE + core_UCE + right_UCE)
 
+def prefix_counts(values):
+    ''' values: array with a value (or a column of values) per site
+
+        returns the cumulative sums over the sites with a leading zero,
+        so the sum over sites a:b is prefix[..., b] - prefix[..., a]
+    '''
+    values = np.asarray(values)
+    zero = np.zeros(values.shape[:-1] + (1,), dtype = values.dtype)
 
-def any_undetermined_blocks(best_window, uce_aln):
+    return (np.concatenate((zero, np.cumsum(values, axis = -1)), axis = -1))
+
+
+def block_counts(prefix, best_window):
+    ''' prefix: cumulative counts, see prefix_counts
+        best_window: (start, stop) of the core
+
+        returns the counts of the left, core and right blocks
+    '''
+    length = prefix.shape[-1] - 1
+
+    left = prefix[..., best_window[0]] - prefix[..., 0]
+    core = prefix[..., best_window[1]] - prefix[..., best_window[0]]
+    right = prefix[..., length] - prefix[..., best_window[1]]
+
+    return (left, core, right)
+
+
+def valid_windows_mask(variable_prefix, starts, stops, minimum_window_size):
+    ''' variable_prefix: cumulative count of variable sites, see prefix_counts
+        starts: 1D array of window starts
+        stops: 1D array of window stops
+
+        returns a 2D boolean array (starts x stops) that is True for
+        windows that are long enough and where no block has only 
+        invariant sites
+    '''
+    length = len(variable_prefix) - 1
+    a = np.asarray(starts)[:, np.newaxis]
+    b = np.asarray(stops)[np.newaxis, :]
+
+    left = variable_prefix[a] > 0
+    core = variable_prefix[b] - variable_prefix[a] > 0
+    right = variable_prefix[length] - variable_prefix[b] > 0
+
+    return (left & core & right & (b - a >= minimum_window_size))
+
+
+def any_undetermined_blocks(best_window, base_prefix):
     # Return TRUE if there are any blocks with only undeteremined characters
     # Defined as anything other than ACGT
 
-    left_aln = uce_aln[:, 0 : best_window[0]]
-    core_aln = uce_aln[:, best_window[0] : best_window[1]]
-    right_aln = uce_aln[:, best_window[1] : uce_aln.get_alignment_length()]
+    for counts in block_counts(base_prefix, best_window):
+        sum_count = np.sum(counts)
+        if(sum_count == 0): sum_count = 1
 
-    l_freq = bp_freqs_calc(left_aln)
-    c_freq = bp_freqs_calc(core_aln)
-    r_freq = bp_freqs_calc(right_aln)
+        if(np.isnan((counts / float(sum_count)).max())):
+            return(True)
 
-    if(np.isnan(l_freq.max()) or np.isnan(c_freq.max()) or np.isnan(r_freq.max())):
-        return(True)
-    else:
-        return(False)
+    return(False)
 
 
-def any_blocks_without_all_sites(best_window, uce_aln):
+def any_blocks_without_all_sites(best_window, base_prefix):
     # Return TRUE if there are any blocks with only undeteremined characters
     # Defined as anything other than ACGT
 
-    left_aln = uce_aln[:, 0 : best_window[0]]
-    core_aln = uce_aln[:, best_window[0] : best_window[1]]
-    right_aln = uce_aln[:, best_window[1] : uce_aln.get_alignment_length()]
-
-    l_counts = count_bases(left_aln)
-    c_counts = count_bases(core_aln)
-    r_counts = count_bases(right_aln)
+    l_counts, c_counts, r_counts = block_counts(base_prefix, best_window)
 
     if(np.min(l_counts)==0 or np.min(c_counts)==0 or np.min(c_counts)==0):
         return(True)
@@ -135,34 +199,97 @@ def any_blocks_without_all_sites(best_window, uce_aln):
 
 
 def get_all_windows(aln, minimum_window_size):
-    ''' aln: multiple sequence alignment
+    ''' aln: multiple sequence alignment (biopython or encoded)
         minimum_window_size: smallest allowable window 
         
-        return a list of all possible tuples [ (start : end) ]
+        return a generator of all possible tuples [ (start : end) ], 
+        in the order of itertools.combinations (see iter_windows)
     '''
 
-    length = aln.get_alignment_length()
+    if isinstance(aln, np.ndarray):
+        length = aln.shape[1]
+    else:
+        length = aln.get_alignment_length()
+
+    return (iter_windows(length, minimum_window_size))
 
-    keep_windows = []
 
-    if length < 3 * minimum_window_size:
+def iter_windows(length, minimum_window_size):
+    ''' length: alignment length
+        minimum_window_size: smallest allowable window
+
+        yields every window (start, stop) one at a time, so they are
+        never all in memory
+    '''
+
+    m = minimum_window_size
+
+    if length < 3 * m:
         # some things can't be split
-        return ([(0, length)])
+        yield (0, length)
+        return
+
+    for start in range(m, length - 2 * m + 1):
+        for stop in range(start + m, length - m + 1):
+            yield (start, stop)
+
+
+def window_blocks(length, minimum_window_size, block_size):
+    ''' length: alignment length
+        minimum_window_size: smallest allowable window
+        block_size: largest number of windows in a block
+
+        yields blocks of windows as index arrays (starts, stops): the
+        windows of the block are every start with every stop, and only
+        the ones where stop - start >= minimum_window_size are valid
+        (see valid_windows_mask). Blocks come in the order of
+        iter_windows, and never have more than block_size windows (or
+        one start, for very long alignments)
+    '''
+
+    m = minimum_window_size
+    last_start = length - 2 * m
+
+    start = m
+    while start <= last_start:
+        stops = np.arange(start + m, length - m + 1)
+        n_starts = max(1, block_size // len(stops))
+        starts = np.arange(start, min(start + n_starts, last_start + 1))
+
+        yield (starts, stops)
+
+        start += len(starts)
+
+
+def count_windows(length, minimum_window_size):
+    ''' length: alignment length
+        minimum_window_size: smallest allowable window
+
+        return the number of windows get_all_windows would return
+    '''
+
+    m = minimum_window_size
 
-    for window in combinations(range(length), 2):
-        start = window[0]
-        stop = window[1]
+    if length < 3 * m:
+        return (1)
 
-        if start < minimum_window_size:
-            continue
-        if (length - stop) < minimum_window_size:
-            continue
-        if (stop - start) < minimum_window_size:
-            continue
+    # for each start there are (length - m) - (start + m) + 1 stops
+    n = length - 3 * m + 1
 
-        keep_windows.append(window)
+    return (n * (n + 1) // 2)
 
-    return (keep_windows)
+
+def first_window(length, minimum_window_size):
+    ''' length: alignment length
+        minimum_window_size: smallest allowable window
+
+        return the first window get_all_windows would return
+    '''
+
+    if length < 3 * minimum_window_size:
+        return ((0, length))
+
+    return ((minimum_window_size, 2 * minimum_window_size))
 
 
 def output_paths(dataset_path):
@@ -183,6 +310,23 @@ def output_paths(dataset_path):
 
     return (output_path)
 
+def charsets_start_block():
+    return ('begin sets;\n')
+
+
+def charsets_end_block():
+    return ('end;\n')
+
+
+def blocks_to_charsets(blocks):
+    ''' blocks: data blocks from uce_blocks, (name, first site, last site)
+
+        returns a list of (name, nexus charset line) for each data block
+    '''
+
+    return ([(name, 'charset %s = %s-%s;\n' % (name, first, last)) for name, first, last in blocks])
+
+
 def p_finder_start_block(dataset_name, branchlengths = 'linked', models = 'GTR+G', model_selection = 'aicc'):
     begin_block = str('## ALIGNMENT FILE ##\n' + 
                       'alignment = %s.phy;\n\n' % (dataset_name) +  
@@ -218,23 +362,181 @@ def p_finder_end_block(dataset_name, search = 'rclusterf'):
 
     return (end_block)
 
+# the encoded alignment is a 2D uint8 array (taxa x sites), where
+# A, C, G and T (in any case) are 0, 1, 2 and 3, and anything else
+# (gaps, missing data, ambiguity codes) is UNDETERMINED
+BASES = 'ACGT'
+UNDETERMINED = 4
+
+ENCODING_TABLE = np.full(256, UNDETERMINED, dtype = np.uint8)
+for i, base in enumerate(BASES):
+    ENCODING_TABLE[ord(base)] = i
+    ENCODING_TABLE[ord(base.lower())] = i
+
+
+# characters to write the encoded values back as
+DECODING_TABLE = np.frombuffer((BASES + 'N').encode('ascii'), dtype = np.uint8)
+
+
+def encode_sequences(sequences):
+    ''' sequences: list of aligned sequences (strings of the same length)
+
+    returns a 2D uint8 array (taxa x sites), see ENCODING_TABLE
+    '''
+    return (ENCODING_TABLE[sequences_bytes(sequences)])
+
+
+def sequences_bytes(sequences):
+    ''' sequences: list of aligned sequences (strings of the same length)
+
+    returns a 2D uint8 array (taxa x sites) with the characters as bytes
+    '''
+    raw = ''.join(sequences).encode('ascii', 'replace')
+
+    return (np.frombuffer(raw, dtype = np.uint8).reshape(len(sequences), -1))
+
+
+def encode_alignment(aln):
+    ''' aln: biopython generic alignment
+
+    returns a 2D uint8 array (taxa x sites), see ENCODING_TABLE
+    '''
+    return (encode_sequences([str(record.seq) for record in aln]))
+
+
+def alignment_bytes(aln):
+    ''' aln: biopython generic alignment
+
+    returns a 2D uint8 array (taxa x sites) with the characters as bytes
+    '''
+    return (sequences_bytes([str(record.seq) for record in aln]))
+
+
+def as_encoded(aln):
+    ''' aln: biopython generic alignment or an encoded alignment
+
+    returns the encoded alignment
+    '''
+    if isinstance(aln, np.ndarray):
+        return (aln)
+    return (encode_alignment(aln))
+
+
+def base_count_matrix(encoded):
+    ''' encoded: encoded alignment (taxa x sites)
+
+    returns a 4xN integer array of base counts (A,C,G,T) by site
+    '''
+    counts = np.empty((len(BASES), encoded.shape[1]), dtype = np.int64)
+    for i in range(len(BASES)):
+        counts[i] = np.count_nonzero(encoded == i, axis = 0)
+
+    return (counts)
+
+
 def sitewise_base_counts(aln):
     '''
-    aln: biopython generic alignment
+    aln: biopython generic alignment or an encoded alignment
     
     returns a 4xN array of base counts (A,C,G,T) by site
     '''
-    n_sites = aln.get_alignment_length()
 
-    base_counts = np.zeros((4, n_sites))
+    return (base_count_matrix(as_encoded(aln)))
+
+
+def entropies_from_counts(counts):
+    ''' counts: 4xN array of base counts (A,C,G,T) by site
+
+    returns an array with values of entropies per site
+    '''
+    # sites share only a few distinct columns of counts, so entropy_calc
+    # runs once for each of them. This gives exactly the values of
+    # alignment_entropy (np.dot sums in whatever order BLAS likes)
+    columns, site_column = np.unique(counts.T, axis = 0, return_inverse = True)
+
+    sum_counts = columns.sum(axis = 1)
+    # fix so we get frequencies of zero when we don't count
+    # any A, C, T or G
+    sum_counts[sum_counts == 0] = 1
+    bp_freqs = columns / sum_counts[:, np.newaxis].astype(float)
+
+    column_entropies = np.array([entropy_calc(f) for f in bp_freqs])
+
+    return (column_entropies[np.ravel(site_column)])
+
+
+def gc_from_counts(counts, n_taxa):
+    ''' counts: 4xN array of base counts (A,C,G,T) by site
+        n_taxa: number of sequences in the alignment
+
+    returns an array with the GC percentage per site, gaps and
+    undetermined characters count towards the total
+    '''
+    return ((counts[1] + counts[2]) * 100.0 / n_taxa)
+
+
+def multinomial_from_counts(counts):
+    ''' counts: 4xN array of base counts (A,C,G,T) by site
+
+    returns an array with the log-likelihood of the base counts of each
+    site under a multinomial with the base frequencies of the whole
+    alignment. Factorials are taken in log space (lgamma), so they
+    cannot overflow
+    '''
+    counts = np.asarray(counts)
+
+    total = counts.sum()
+    if total == 0:
+        return (np.zeros(counts.shape[1]))
+
+    # log(k!) for every count we can see at a site, up to the
+    # number of bases at the site
+    site_totals = counts.sum(axis = 0)
+    log_factorials = np.array([lgamma(k + 1) for k in range(int(site_totals.max()) + 1)])
+
+    # a base that is never seen has a count of zero at every site,
+    # so its log frequency never counts
+    base_totals = counts.sum(axis = 1)
+    with np.errstate(divide = 'ignore'):
+        log_freqs = np.where(base_totals > 0, np.log(base_totals / float(total)), 0.0)
+
+    log_likelihoods = (log_factorials[site_totals] - log_factorials[counts].sum(axis = 0) +
+                       np.dot(log_freqs, counts))
 
-    for i in range(n_sites):
+    return (log_likelihoods)
 
-        site_i = aln[:,i:i+1]
-        counts_i = count_bases(site_i)
-        base_counts[:,i] = counts_i
 
-    return(base_counts)
+# the sitewise metrics that process_uce knows, each one
+# computed from the base counts and the number of taxa
+METRICS = {
+    'entropy': lambda counts, n_taxa: entropies_from_counts(counts),
+    'gc':      lambda counts, n_taxa: gc_from_counts(counts, n_taxa),
+    'multi':   lambda counts, n_taxa: multinomial_from_counts(counts),
+}
+
+
+def metrics_from_counts(counts, n_taxa, metrics):
+    ''' counts: 4xN array of base counts (A,C,G,T) by site
+        n_taxa: number of sequences in the alignment
+        metrics: a list with values of 'gc', 'entropy' or 'multi'
+
+    returns a 2D array with one row per metric (in the order of
+    metrics) and one column per site
+    '''
+    for metric in metrics:
+        if metric not in METRICS:
+            raise ValueError("Unknown metric %s, use one of %s" % (metric, ', '.join(sorted(METRICS))))
+
+    return (np.array([METRICS[metric](counts, n_taxa) for metric in metrics], dtype = np.float64).reshape(len(metrics), -1))
+
+
+def variable_sites_from_counts(counts):
+    ''' counts: 4xN array of base counts (A,C,G,T) by site
+
+    returns an array with 1 for variable sites and 0 for invariant ones
+    '''
+    return ((np.count_nonzero(counts, axis = 0) > 1).astype(float))
+
 
 def factorial_matrix(counts):
     '''
@@ -357,21 +659,12 @@ def entropy_calc(p):
     return np.dot(-p,np.log2(p)) # the function returns the entropy result
 
 def sitewise_entropies(aln):
-    ''' aln: biopython generic alignment
+    ''' aln: biopython generic alignment or an encoded alignment
     
     returns an array with values of entropies per site
     '''
 
-    entropies = []
-    for i in range(aln.get_alignment_length()):
-
-        site_i = aln[:,i:i+1]
-        ent_i = alignment_entropy(site_i)
-        entropies.append(ent_i)
-
-    entropies = np.array(entropies)
-
-    return (entropies)
+    return (entropies_from_counts(sitewise_base_counts(aln)))
 
 def all_invariant_sites(sitevar):
     # return TRUE if aln has all invariant sites
@@ -389,9 +682,7 @@ def invariant_sites(aln):
     # variable = 1
     # invariant = 0
 
-    entropies = sitewise_entropies(aln)
-    entropies[entropies > 0] = 1
-    return(entropies)
+    return(variable_sites_from_counts(sitewise_base_counts(aln)))
 
 
 
@@ -421,3 +712,31 @@ def export_nexus(aln, charset_name):
 
     concat = Nexus.combine(nexus_tuples)
     concat.write_nexus_data('%s_concat.nex' % (aln.rstrip(".nex")))
+
+
+def reset_peak_rss():
+    ''' resets the peak resident memory of this process, so peak_rss
+        gives the peak since now. Only Linux can do this; elsewhere
+        peak_rss stays the peak since the process started
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss():
+    ''' returns the peak resident memory of this process in bytes '''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return (int(line.split()[1]) * 1024)
+    except (IOError, OSError):
+        pass
+
+    import resource
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (peak if sys.platform == 'darwin' else peak * 1024)
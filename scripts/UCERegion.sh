@@ -29,7 +29,13 @@ version "$VERSION"
   -o, --output            Output directory
 
 \e[4mOptional arguments\e[0m:
-  -t, --threads           Number of threads for the analysis (Default: 2)"
+  -t, --threads           Number of threads for the analysis (Default: 2)
+
+  -c, --swsc-cache        Directory to keep the SWSC results of each UCE in, so that
+                          later runs only compute the UCEs that are not there yet
+
+  -n, --swsc-counts       Directory to keep the base counts of each subgroup in, so that
+                          a later run with more taxa only counts the new ones"
 
 exit 2
 }
@@ -62,8 +68,8 @@ THREADS=2
 SWSC_PATH="$HOME_DIR/SWSC_EN/SWSCEN.py"
 
 # Option strings for arg parser
-SHORT=hp:o:t:
-LONG=help,phyluce-nexus:,output:,threads:,version:
+SHORT=hp:o:t:c:n:
+LONG=help,phyluce-nexus:,output:,threads:,swsc-cache:,swsc-counts:,version:
 
 
 # Read options
@@ -93,6 +99,14 @@ while true ; do
 		OUTPUT="$2"
 		shift 2
 		;;
+		-c | --swsc-cache )
+		SWSC_CACHE="$2"
+		shift 2
+		;;
+		-n | --swsc-counts )
+		SWSC_COUNTS="$2"
+		shift 2
+		;;
 		-- )
 		shift
 		break
@@ -120,6 +134,8 @@ echo "=========================================================================
 NEXUS: ${NEXUS_DIR}
 OUTDIR: ${OUTPUT}
 THREADS: $THREADS
+SWSC CACHE: ${SWSC_CACHE:-none}
+SWSC COUNTS: ${SWSC_COUNTS:-none}
 -------------------------------------------------------------------------"
 
 #=============================================================
@@ -198,88 +214,54 @@ fi
 
 SWSC=${OUTPUT}/tmp/003-swsc/
 mkdir -p ${SWSC}
+SWSC_PARSE=${OUTPUT}/tmp/004-swsc-parse
+mkdir -p ${SWSC_PARSE}
+mkdir -p ${OUTPUT}/partitioned-uces/
+
+# reuse the results of UCEs seen in earlier runs
+SWSC_CACHE_ARGS=""
+if [ -n "${SWSC_CACHE}" ]; then
+	mkdir -p "${SWSC_CACHE}"
+	SWSC_CACHE_ARGS="--cache $( realpath ${SWSC_CACHE} )"
+fi
+
+# count only the taxa that are new since earlier runs
+if [ -n "${SWSC_COUNTS}" ]; then
+	mkdir -p "${SWSC_COUNTS}"
+	SWSC_COUNTS=$( realpath ${SWSC_COUNTS} )
+fi
 
 if [ -z "$(ls -A "${SWSC}")" ]; then
 	log "Running SWSC..."
-        # run SWSC in parallel
+        # run SWSC on one subgroup at a time, each one spreading
+        # its UCEs across $THREADS worker processes
         for sg in $(seq 1 $n_subgroups); do
                 # (1) fix uce names in .nexus files
                 sed -i 's/uce-/uce_/g' "${SUBGROUPS_CAT}/$sg/$sg.nexus"
 
-                # (2) run SWSC
-                $CONDA_PREFIX/bin/sem --will-cite --id $$ --max-procs "$THREADS" \
-                        $CONDA_PREFIX/bin/python $SWSC_PATH \
+                # (2) run SWSC. It writes the flanks and core of each UCE
+                # to ${SWSC_PARSE} (for the concatenated files) and each
+                # UCE with its flanks as charsets to partitioned-uces
+                $CONDA_PREFIX/bin/python $SWSC_PATH \
                         $( realpath ${SUBGROUPS_CAT}/${sg}/${sg}.nexus ) \
-                        $( realpath $SWSC ) > "${LOGDIR}"/swsc.log 2>&1
+                        $( realpath $SWSC ) --workers "$THREADS" --no-sitewise-output ${SWSC_CACHE_ARGS} \
+                        ${SWSC_COUNTS:+--counts "${SWSC_COUNTS}/${sg}.counts.npz"} \
+                        --loci "${SWSC_PARSE}/${sg}" \
+                        --partitioned-uces "${OUTPUT}/partitioned-uces" >> "${LOGDIR}"/swsc.log 2>&1
                 bash "${HOME_DIR}"/progress-bar.sh $sg "$n_subgroups"
         done
-        $CONDA_PREFIX/bin/sem --will-cite --id $$ --wait
         DONEmsg
+
+        N_WHOLE=$(grep -l "_all = " "${OUTPUT}"/partitioned-uces/*.charsets | wc -l)
+        if (( $N_WHOLE > 0 )); then
+                warn "No flanks found for ${N_WHOLE} UCEs. They were left as a whole"
+        fi
 else
 	warn "SWSC already run. Skipping"
 fi
 
 #=============================================================
 #====                       STEP 3:                       ====
-#====                   Parsing Results                   ====
-#=============================================================
-
-SWSC_PARSE=${OUTPUT}/tmp/004-swsc-parse
-mkdir -p ${SWSC_PARSE}
-
-# function to parse results
-SWSCParser(){
-	subgroup=$1
-	SWSC=$2
-	SUBGROUPS_CAT=$3
-	SWSC_PARSE=$4
-	OUTPUT=$5
-	# (1) extract flanks coordenates for this subgroup
-	   # 1st sed: adds 'charset' at the beggining of each line
-	   # 2nd sed: adds 'begin sets;' as first line
-	   # 3rd sed: adds 'end;' as last line
-	grep '_right\|_core\|_left\|_all' ${SWSC}/${subgroup}.nexus_entropy_partition_finder.cfg \
-		| sed 's/^/charset /g' \
-		| sed '1 i\begin sets\;' \
-		| sed -e '$aend;' > ${SWSC_PARSE}/${subgroup}.charsets
-
-	# (2) remove old charsets from nexus file of this subgroup
-	   # sed: delete all line after 'begin sets;'
-	cat ${SUBGROUPS_CAT}/${subgroup}/${subgroup}.nexus \
-		| sed '/begin sets;/,$d' > ${SWSC_PARSE}/${subgroup}.alignment
-
-	# (3) create the new nexus file with flanks as charsets
-	cat ${SWSC_PARSE}/${subgroup}.alignment \
-		${SWSC_PARSE}/${subgroup}.charsets \
-		> ${SWSC_PARSE}/${subgroup}.nexus
-
-	# (4) call phyluce to split the nexus using the charsets
-	$CONDA_PREFIX/bin/phyluce_align_split_concat_nexus_to_loci \
-		--nexus ${SWSC_PARSE}/${subgroup}.nexus \
-		--output ${SWSC_PARSE}/${subgroup}/ --log-path ${OUTPUT}/tmp/\
-		--output-format nexus
-}
-
-# Need to export this function to call it with Parallel
-export -f SWSCParser
-
-if [ -z "$(ls -A "${SWSC_PARSE}")" ]; then
-	log "Parsing results..."
-        for sg in $(seq 1 $n_subgroups); do
-		# calls function in parallel
-                $CONDA_PREFIX/bin/sem --will-cite --id $$ --max-procs "$THREADS" \
-                        SWSCParser $sg ${SWSC} ${SUBGROUPS_CAT} ${SWSC_PARSE} \
-						${OUTPUT}> "${LOGDIR}"/swsc_parser.log 2>&1
-                bash "${HOME_DIR}"/progress-bar.sh $sg "$n_subgroups"
-        done
-        $CONDA_PREFIX/bin/sem --will-cite --id $$ --wait
-        DONEmsg
-else
-	warn "SWSC results already parsed. Skipping"
-fi
-
-#=============================================================
-#====                       STEP 4:                       ====
 #====        Generating concat files and PF2 input        ====
 #=============================================================
 
@@ -358,94 +340,18 @@ fi
 
 
 #=============================================================
-#====                       STEP 5:                       ====
-#====                 Concatenating UCEs                  ====
-#=============================================================
-
-CAT_UCES=${OUTPUT}/tmp/006-concatenate-uces/
-mkdir -p ${CAT_UCES}
-mkdir -p ${OUTPUT}/partitioned-uces/
-
-if [ -z "$(ls -A "${CAT_UCES}")" ]; then
-	log "Concatenating UCEs..."
-	UCE_LIST=$(find ${SWSC_PARSE}/*/ -type f -name "*nexus" \
-		| sed 's/_right.nexus//g;s/_left.nexus//g;s/_core.nexus//g' \
-		| sort | uniq)
-    # create UCE dir
-    for uce in $UCE_LIST; do
-		uce_name=$(basename $uce)
-		# check if ends with _all.nexus
-		if [[ "$uce_name" == *_all.nexus ]]; then
-  			warn "No flanks found for ${uce_name/_all.nexus}. It will be left as a whole"
-			cp $uce ${OUTPUT}/partitioned-uces/${uce_name/_all}
-		else
-			mkdir -p ${CAT_UCES}/$uce_name
-			cp ${uce}_left.nexus \
-				${uce}_core.nexus \
-				${uce}_right.nexus \
-				${CAT_UCES}/$uce_name
-		fi
-    done
-	
-else
-	warn "UCEs already prepared for concatenation. Skipping"
-fi
-
-#=============================================================
-#====                       STEP 6:                       ====
-#====                 Concatenating UCEs                  ====
-#=============================================================
-
-
-mkdir -p "${CAT_UCES}"/NEXUS/
-if [ -z "$(ls -A "${CAT_UCES}/NEXUS/")" ]; then
-	# (2) concatenating with PHYLUCE in parallel
-	UCE_DIRS=$(find ${CAT_UCES} -mindepth 1 -type d)
-	N_UCES=$(find ${CAT_UCES} -mindepth 1 -type d | wc -l)
-	AUX=0
-
-	for uce in $UCE_DIRS; do
-		uce_name=$(basename $uce)
-		AUX=$(( AUX + 1 ))
-		# concatenate with phyluce in parallel
-		$CONDA_PREFIX/bin/sem --will-cite --id $$ --max-procs "$THREADS" \
-			$CONDA_PREFIX/bin/phyluce_align_concatenate_alignments \
-			--alignments "$uce" --phylip --log ${OUTPUT}/tmp/ \
-			--output "${CAT_UCES}"/NEXUS/"${uce_name}" > /dev/null 2>&1
-		bash "${HOME_DIR}"/progress-bar.sh $AUX "$N_UCES"
-	done
-	$CONDA_PREFIX/bin/sem --will-cite --id $$ --wait
-	DONEmsg
-	
-	log "Writing final files..."
-		# mv phylip to output dir
-	for uce in $(find "${CAT_UCES}"/NEXUS/ -name "*.phylip" -type f ); do
-	uce_name=$(basename $uce)
-		mv $uce ${OUTPUT}/partitioned-uces/${uce_name}
-	done
-	
-	# fix charsets and mv them to output dir
-	for uce in $(find "${CAT_UCES}"/NEXUS/ -name "*.charsets" -type f ); do
-		uce_name=$(basename $uce)
-		cat $uce \
-		| sed 's/charpartition combined =.*//;s/.nexus//g' \
-		| sed '1i #NEXUS' \
-		> ${OUTPUT}/partitioned-uces/${uce_name}
-	done
-	DONEmsg
-	
-else
-	warn "UCEs already concatenated. Skipping"
-fi
-
-#=============================================================
-#====                       STEP 7:                       ====
+#====                       STEP 4:                       ====
 #====                  Remove tmp files                   ====
 #=============================================================
 	log "Removing temp files..."
-if test -f "${OUTPUT}/tmp/phyluce_align_concatenate_alignments.log"; then
+# tmp holds the inputs and the skip-on-rerun state of the steps above, only remove it once the final outputs exist
+if test -d "${OUTPUT}/tmp/" \
+	&& test -f "${OUTPUT}/concatenated-uces/PF2-input.cfg" \
+	&& test -f "${OUTPUT}/concatenated-uces/concatenated-uces-swscen.charsets"; then
 	rm -rf ${OUTPUT}/tmp/
 	DONEmsg
+elif test -d "${OUTPUT}/tmp/"; then
+	warn "Final outputs not found. Keeping temporary files in ${OUTPUT}/tmp/"
 else
 	warn "Temporary files already removed. Skipping"
 fi
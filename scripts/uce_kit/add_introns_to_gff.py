@@ -7,13 +7,17 @@
 import sys
 
 def add_introns(infile, outfile, geneid_for_exon = False):
+    for gff_ln in intron_lines(infile, geneid_for_exon):
+        outfile.write(gff_ln)
+
+def intron_lines(infile, geneid_for_exon = False): # yield the lines of infile with the intron lines inserted
     def to_int(digits_str):  # do not throw a ValueError exception if input happens to not be a string of just digits
         return int(digits_str) if digits_str.isdigit() else 0
 
     cur_flds = []; geneid = ""
     for gff_ln in infile:
         if len(gff_ln) < 3 or gff_ln[0] == "#":  # output empty or comment lines
-            outfile.write(gff_ln)
+            yield gff_ln
             continue
         
         lst_flds = list(cur_flds)  # copy the last non-comment line fields
@@ -21,7 +25,7 @@ def add_introns(infile, outfile, geneid_for_exon = False):
         
         too_short = len(cur_flds) < 5 or len(lst_flds) < 5
         if too_short:
-            outfile.write(gff_ln)
+            yield gff_ln
             continue
         
         cur_type = cur_flds[2].lower()
@@ -33,7 +37,7 @@ def add_introns(infile, outfile, geneid_for_exon = False):
                 cur_flds[8] = geneid
                 gff_ln = "\t".join(cur_flds) + "\n"
                 
-            outfile.write(gff_ln)
+            yield gff_ln
             continue
         
         # last line and current line both are exon lines, this is where to insert the intron line        
@@ -42,7 +46,7 @@ def add_introns(infile, outfile, geneid_for_exon = False):
         
         if cur_beg==0 or cur_end==0 or lst_beg==0 or lst_end==0:
             # we expected positive integers but didn't get them
-            outfile.write(gff_ln)
+            yield gff_ln
             continue
         
         if lst_end < cur_beg:  # positive strand
@@ -53,13 +57,13 @@ def add_introns(infile, outfile, geneid_for_exon = False):
             int_end = lst_beg - 1
         
         intron = "\t".join([ lst_flds[0], "Insert","intron", str(int_beg),str(int_end), lst_flds[5],lst_flds[6],lst_flds[7], geneid ]) + "\n"
-        outfile.write(intron)  # output intron line
+        yield intron  # output intron line
         
         if geneid_for_exon and cur_type == "exon":
              cur_flds[8] = geneid
              gff_ln = "\t".join(cur_flds) + "\n"
 
-        outfile.write(gff_ln)  # output current exon line
+        yield gff_ln  # output current exon line
         
 def main(argv):
     gff_file = sys.stdin
@@ -0,0 +1,184 @@
+# coding: utf-8
+
+# binary index of a gff annotation, built once and memory mapped by later runs of uce_gff_lines.py
+# so the gff text, with any introns added, does not have to be parsed again for every set of uces.
+# the index file is named by a hash of the gff contents and of the options it was built with, so an
+# annotation that changes gets a new index. it holds:
+#   every usable gff line (see uce_gff_lines.gff_features), gff type excludes are applied when it is read
+#   the gff type of each line, and its summary type with any gene ID, e.g. gene(ID=gene126)
+#   the text of each line, to show with -lines
+#   per scaffold the start and end positions of the lines sorted by start, with the running maximum of
+#   the ends, so the lines in the scope of a uce position are found by binary search: the first line
+#   whose end (or the end of a line before it) reaches the position, up to the last line starting at it.
+#   region lines span the whole scaffold and would make every line reach every position, so they are
+#   kept apart, per scaffold, and checked one by one
+
+import os.path
+import hashlib, json, struct, tempfile
+import numpy as np
+from search_cache import file_digest
+
+INDEX_VERSION = 2  # bump when the index layout or what goes in it changes
+INDEX_MAGIC = b"UCEGFFINDEX\n"
+INDEX_SUFFIX = ".gffidx"
+WIDE_TYPES = ("region", "Region", "REGION")  # gff types kept out of the binary search, see above
+
+
+def index_key(gff_file, index_dir, add_introns, remove_version, begpos_ix, endpos_ix): # hash of gff contents and build options
+    key = hashlib.sha1()
+    key.update("{}|{}|{}|{}|{}|".format(INDEX_VERSION, add_introns, remove_version, begpos_ix, endpos_ix).encode("ascii"))
+    # the hash of the file as it is, compressed or not, remembered in index_dir so an unchanged gff isn't read again
+    key.update(file_digest(gff_file, index_dir).encode("ascii"))
+    return key.hexdigest()
+
+
+def index_path(index_dir, key):
+    return os.path.join(index_dir, key + INDEX_SUFFIX)
+
+
+class AnnotationIndex(object):
+    def __init__(self, fname):
+        with open(fname, "rb") as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError("{} is not an annotation index".format(fname))
+            header_len = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_len).decode("utf-8"))
+        if header["version"] != INDEX_VERSION:
+            raise ValueError("{} has index version {}, expected {}".format(fname, header["version"], INDEX_VERSION))
+
+        self.type_names = header["type_names"] # gff types, e.g. exon
+        self.summary_types = header["summary_types"] # as shown in the summary, e.g. gene(ID=gene126)
+        self.scaffolds = dict((scaf["name"], (scaf["start"], scaf["count"], scaf["wide_start"], scaf["wide_count"]))
+                              for scaf in header["scaffolds"])
+
+        # map the arrays in place, only the parts that are read are loaded
+        for name, (dtype, offset, count) in header["arrays"].items():
+            if count > 0:
+                setattr(self, name, np.memmap(fname, dtype = np.dtype(dtype), mode = "r", offset = offset, shape = (count,)))
+            else:
+                setattr(self, name, np.zeros(0, dtype = np.dtype(dtype)))
+
+    def __len__(self):
+        return len(self.line_type)
+
+    def excluded_types(self, exclude_list): # boolean per gff type name, True if lines of that type are excluded
+        return np.array([name in exclude_list for name in self.type_names] + [False], dtype = bool)
+
+    def features_at(self, scaf, positions, excluded = None):
+        # for each position, the indices (in gff order) of the lines of scaf with the position in their scope
+        if not scaf in self.scaffolds:
+            return [np.zeros(0, dtype = np.int64) for pos in positions]
+        start, count, wide_start, wide_count = self.scaffolds[scaf]
+        begs = self.begpos[start : start+count]; ends = self.endpos[start : start+count]
+        maxends = self.maxend[start : start+count]; lines = self.feature[start : start+count]
+        wide_begs = self.wide_begpos[wide_start : wide_start+wide_count]
+        wide_ends = self.wide_endpos[wide_start : wide_start+wide_count]
+        wide_lines = self.wide_feature[wide_start : wide_start+wide_count]
+
+        # search with the dtype of the positions in the index, so the mapped arrays are not converted
+        positions = np.asarray(positions, dtype = np.int64)
+        search_pos = np.minimum(positions, np.iinfo(begs.dtype).max).astype(begs.dtype)
+        firsts = np.searchsorted(maxends, search_pos, "left") # no line before this ends at or after pos
+        lasts = np.searchsorted(begs, search_pos, "right") # nor does any line from here start at or before it
+
+        features = []
+        for pos, first, last in zip(positions, firsts, lasts):
+            in_scope = lines[first:last][ends[first:last] >= pos]
+            if wide_count > 0:
+                in_scope = np.concatenate((in_scope, wide_lines[(wide_begs <= pos) & (wide_ends >= pos)]))
+            if excluded is not None and len(in_scope) > 0:
+                in_scope = in_scope[~excluded[self.line_type[in_scope]]]
+            features.append(np.sort(in_scope))
+        return features
+
+    def summary_type(self, feature):
+        return self.summary_types[self.line_summary[feature]]
+
+    def line(self, feature):
+        return self.text[self.text_offset[feature] : self.text_offset[feature+1]].tobytes().decode("utf-8")
+
+
+def build_index(gff_features, fname):
+    # gff_features: scaffold, begpos, endpos, gff type, summary type and line of each usable gff line, in gff order
+    type_ix = {}; summary_ix = {}
+    scaf_features = {}; scaf_list = [] # per scaffold: begpos, endpos and index of its lines, and of its wide lines
+    line_type = []; line_summary = []; text_offset = [0]; text = []
+
+    for scaf, begpos, endpos, typ, summary_typ, ln in gff_features:
+        if not scaf in scaf_features:
+            scaf_features[scaf] = (([], [], []), ([], [], [])); scaf_list.append(scaf)
+        begs, ends, feats = scaf_features[scaf][1 if typ in WIDE_TYPES else 0]
+        begs.append(begpos); ends.append(endpos); feats.append(len(line_type))
+
+        line_type.append(type_ix.setdefault(typ, len(type_ix)))
+        line_summary.append(summary_ix.setdefault(summary_typ, len(summary_ix)))
+        text.append(ln.encode("utf-8")); text_offset.append(text_offset[-1] + len(text[-1]))
+
+    arrays = [] # name, array
+    scaffolds = []; scaf_start = 0; wide_start = 0
+    begpos_all = []; endpos_all = []; maxend_all = []; feature_all = []
+    wide_begpos_all = []; wide_endpos_all = []; wide_feature_all = []
+    for scaf in scaf_list:
+        features, wide_features = scaf_features[scaf]
+        begs, ends, feats = [np.array(col, dtype = np.int64) for col in features]
+        order = np.argsort(begs, kind = "mergesort") # stable, so lines with the same start stay in gff order
+        begpos_all.append(begs[order]); endpos_all.append(ends[order]); feature_all.append(feats[order])
+        maxend_all.append(np.maximum.accumulate(ends[order]) if len(ends) > 0 else ends)
+        wide_begs, wide_ends, wide_feats = [np.array(col, dtype = np.int64) for col in wide_features]
+        wide_begpos_all.append(wide_begs); wide_endpos_all.append(wide_ends); wide_feature_all.append(wide_feats)
+        scaffolds.append({"name": scaf, "start": scaf_start, "count": len(begs),
+                          "wide_start": wide_start, "wide_count": len(wide_begs)})
+        scaf_start += len(begs); wide_start += len(wide_begs)
+
+    def concat(cols): # 32 bit when the values fit, as they do for all but the longest chromosomes
+        col = np.concatenate(cols) if len(cols) > 0 else np.zeros(0, dtype = np.int64)
+        return col.astype(np.int32) if len(col) == 0 or col.max() < 2**31 else col
+
+    arrays.append(("begpos", concat(begpos_all)))
+    arrays.append(("endpos", concat(endpos_all)))
+    arrays.append(("maxend", concat(maxend_all)))
+    arrays.append(("feature", concat(feature_all)))
+    arrays.append(("wide_begpos", concat(wide_begpos_all)))
+    arrays.append(("wide_endpos", concat(wide_endpos_all)))
+    arrays.append(("wide_feature", concat(wide_feature_all)))
+    arrays.append(("line_type", np.array(line_type, dtype = np.int32)))
+    arrays.append(("line_summary", np.array(line_summary, dtype = np.int32)))
+    arrays.append(("text_offset", np.array(text_offset, dtype = np.int64)))
+    arrays.append(("text", np.frombuffer(b"".join(text), dtype = np.uint8)))
+
+    header = {"version": INDEX_VERSION, "scaffolds": scaffolds,
+              "type_names": sorted(type_ix, key = type_ix.get), "summary_types": sorted(summary_ix, key = summary_ix.get)}
+
+    # the header holds the offset of each array, which depends on the header length, so settle it first
+    def layout(header_len):
+        offset = len(INDEX_MAGIC) + 8 + header_len
+        offsets = {}
+        for name, arr in arrays:
+            offset += -offset % 8  # align each array
+            offsets[name] = (arr.dtype.str, offset, len(arr))
+            offset += arr.nbytes
+        return offsets
+
+    header_len = 0
+    while True:
+        header["arrays"] = layout(header_len)
+        header_bytes = json.dumps(header).encode("utf-8")
+        if len(header_bytes) <= header_len:
+            break
+        header_len = len(header_bytes) + 64 # room for the offsets to grow a digit or two
+    header_bytes += b" " * (header_len - len(header_bytes))
+
+    # write to a temporary file first, so a run that is stopped never leaves half an index behind
+    fd, tmp_name = tempfile.mkstemp(suffix = ".tmp", dir = os.path.dirname(os.path.abspath(fname)))
+    try:
+        umask = os.umask(0); os.umask(umask)
+        os.chmod(tmp_name, 0o666 & ~umask) # readable by others sharing the index directory, as an open() file would be
+        with os.fdopen(fd, "wb") as f:
+            f.write(INDEX_MAGIC + struct.pack("<Q", header_len) + header_bytes)
+            for name, arr in arrays:
+                f.write(b"\0" * (header["arrays"][name][1] - f.tell()))
+                f.write(arr.tobytes())
+        os.replace(tmp_name, fname)
+    except Exception:
+        os.remove(tmp_name)
+        raise
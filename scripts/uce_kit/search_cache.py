@@ -0,0 +1,75 @@
+# coding: utf-8
+
+# cache of the uce searches of uce_kit.py run_pipeline, shared by the runs on the same baits and genome.
+# the blat or blastn hits of Step 1 and the uce locations Step 2 filters from them are named by a hash of
+# the contents of the uces and genome files and of the settings they were made with, so a run on the same
+# files, wherever they are and whatever they are called, uses them instead of searching again.
+# the blast db of a genome is kept in the cache too, in a directory named by the hash of the genome.
+
+import os.path
+import hashlib, tempfile
+
+CACHE_VERSION = 1  # bump when what goes in a cache entry changes
+
+
+def set_mode(fname, mode = 0o666): # tempfile makes files only we can read, the cache is meant to be shared
+    umask = os.umask(0); os.umask(umask)
+    os.chmod(fname, mode & ~umask)
+
+
+def file_digest(fname, cache_dir):
+    # sha1 of the file contents. it is remembered in cache_dir by the path, size and modification time of
+    # the file so a large genome is only read again when it changes
+    st = os.stat(fname)
+    memo_key = "{}|{}|{}".format(os.path.realpath(fname), st.st_size, st.st_mtime).encode("utf-8")
+    memo = os.path.join(cache_dir, "digests", hashlib.sha1(memo_key).hexdigest())
+    if os.path.isfile(memo):
+        with open(memo, "r") as f:
+            return f.read().strip()
+
+    digest = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    digest = digest.hexdigest()
+
+    if not os.path.isdir(os.path.dirname(memo)):
+        os.makedirs(os.path.dirname(memo), exist_ok = True)
+    tmp_name = temp_name(memo)
+    with open(tmp_name, "w") as f:
+        f.write(digest + "\n")
+    store(tmp_name, memo)
+    return digest
+
+
+def search_key(cache_dir, uces, genome, settings): # names the hits of the uces in the genome found with these settings
+    key = hashlib.sha1()
+    key.update("{}|{}|".format(CACHE_VERSION, settings).encode("utf-8"))
+    key.update("{}|{}".format(file_digest(uces, cache_dir), file_digest(genome, cache_dir)).encode("ascii"))
+    return key.hexdigest()
+
+
+def filter_key(key, exclude_prefixes): # names the uce locations filtered from the hits named by key
+    return hashlib.sha1("{}|{}".format(key, "|".join(exclude_prefixes)).encode("utf-8")).hexdigest()
+
+
+def entry(cache_dir, key, suffix):
+    return os.path.join(cache_dir, key + suffix)
+
+
+def blast_db(cache_dir, genome): # prefix of the blast db files of genome, made by uce_kit.cached_blast_db
+    return os.path.join(cache_dir, "blastdb", file_digest(genome, cache_dir), os.path.basename(genome))
+
+
+def temp_name(fname):
+    # a new file next to fname to write its contents to, then store() it, so a run that is stopped or
+    # another run using the cache at the same time never sees half an entry
+    fd, tmp_name = tempfile.mkstemp(suffix = ".tmp", dir = os.path.dirname(os.path.abspath(fname)))
+    os.close(fd)
+    set_mode(tmp_name)
+    return tmp_name
+
+
+def store(tmp_name, fname):
+    os.replace(tmp_name, fname)
+
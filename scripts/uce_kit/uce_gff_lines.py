@@ -8,6 +8,10 @@
 #       uce-4323	NC_006088.4	2744945
 
 import sys, re, time, os.path
+import gzip, multiprocessing
+from bisect import bisect_left, bisect_right
+from array import array
+from add_introns_to_gff import intron_lines
 from pprint import pprint
 
 class Debug():
@@ -25,8 +29,11 @@ class Debug():
     def pprint_scaf_uces(scaf_map, scaf):
         if not Debug.debugging:
             return
-        for u in scaf_map[scaf]:
-            pprint(vars(u))
+        uces = scaf_map[scaf]
+        pprint(list(zip(uces.names, uces.positions)))
+
+
+DEFAULT_EXCLUDES = ["region", "Region", "REGION"] # gff line types always excluded by the command line
 
 
 def remove_version_suffix(name): # e.g. NC_006088.4 to NC_006088
@@ -41,11 +48,6 @@ def get_subfld(fld, sep=";", which=0): # returns first semi-colon delimited fiel
     return fld.split(sep)[which]
 
 
-def sort_scafmap_by_uce_pos(scaf_map):
-    for scaf in scaf_map:
-        scaf_map[scaf].sort(key=lambda uceinfo: uceinfo.pos)
-        
-
 class TypeUtil:  # container for the routines that map uce type string types (exon, intron, etc) to other strings for display
     type_totals = {}
     
@@ -112,11 +114,83 @@ class TypeUtil:  # container for the routines that map uce type string types (ex
     
 # end class TypeUtil
 
-def create_uce_scaf_map(ucefile, remove_version = True):
-    class Uce_info(object): pass
+class ScafUces(object): # columns of the uces of one scaffold and of their matches with the gff features in their scope
+    def __init__(self):
+        self.names = []                   # uce names
+        self.positions = array("l")       # uce start positions, parallel to names
+        self.match_uces = array("l")      # index in names of the uce of each match
+        self.match_features = array("l")  # index in the FeatureTable of the gff feature of each match
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_uce(self, name, pos):
+        self.names.append(name)
+        self.positions.append(pos)
+
+    def sort_by_pos(self): # stable, so uces at the same position stay in uce file order
+        order = sorted(range(len(self.names)), key=self.positions.__getitem__)
+        self.names = [self.names[ix] for ix in order]
+        self.positions = array("l", [self.positions[ix] for ix in order])
+
+    def add_match(self, uce_ix, feature_ix):
+        self.match_uces.append(uce_ix)
+        self.match_features.append(feature_ix)
+
+    def uce_features(self): # feature indices of each uce, in gff order since the features are added in that order
+        features = [[] for ix in range(len(self.names))]
+        for uce_ix, feature_ix in zip(self.match_uces, self.match_features):
+            features[uce_ix].append(feature_ix)
+        return features
+
+
+class FeatureTable(object): # the gff features in the scope of any uce, shared by all the scaffolds
+    def __init__(self, keep_lines = True):
+        self.types = []  # summary type of each feature, see feature_type
+        self.lines = [] if keep_lines else None  # the gff lines, only kept if they are to be shown
+
+    def __len__(self):
+        return len(self.types)
+
+    def add(self, ln, typ = None): # typ is from feature_type(ln), if it was already found
+        self.types.append(typ if typ is not None else feature_type(ln))
+        if self.lines is not None:
+            self.lines.append(ln)
+        return len(self.types) - 1
+
+
+def feature_type(ln): # type of a gff line as shown in the summary, genes with their ID, e.g.: gene(ID=gene126)
+    flds = ln.split("\t")
+    typ = flds[2]
+    if typ == "gene" and len(flds) > 8:
+        gid = get_subfld(flds[8])
+        if gid != "":
+            typ += "(" + gid + ")"
+    return typ
+
+
+def is_gzipped(fname): # gzip or bgzip, both start with the gzip magic number
+    with open(fname, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def open_text(fname): # open a plain or a gzip (or bgzip) compressed text file for reading
+    if is_gzipped(fname):
+        return gzip.open(fname, "rt")
+    return open(fname, "r")
+
+
+def open_uces(uce_file): # a uce file name, or the uce lines themselves, e.g. from uce_kit.filter_uce_matches
+    return open_text(uce_file) if isinstance(uce_file, str) else uce_file
 
-    # create dict for each scaffold (name in fld 1) and store uce info
-    #  (uce name, start pos, empty to start list of matching gff lines) for each uce in scaffold
+
+def open_gff(gff_file, add_introns = False): # the lines of a gff, with intron lines added if asked, see add_introns_to_gff.py
+    gff = open_text(gff_file)
+    return intron_lines(gff) if add_introns else gff
+
+
+def create_uce_scaf_map(ucefile, remove_version = True):
+    # create dict for each scaffold (name in fld 1) and store the name and start pos of each uce in scaffold
     scaf_map = {}  # holds info about each scaf's uces
     scaf_list = [] # scaf names in order of occurrence so we can loop in same order later
     for ln in ucefile:
@@ -129,30 +203,24 @@ def create_uce_scaf_map(ucefile, remove_version = True):
             uce_scaf = remove_version_suffix(uce_scaf) # get rid of version info in scaffold name
         
         if not uce_scaf in scaf_map:
-            scaf_map[uce_scaf] = []
+            scaf_map[uce_scaf] = ScafUces()
             scaf_list.append(uce_scaf)
             
         # store info about the use in the relevant scaffold map
-        uce_info = Uce_info()
-        uce_info.uce = uce_nm;
-        uce_info.pos = uce_pos
-        uce_info.gff_lns = []
-        
-        scaf_map[uce_scaf].append(uce_info)
+        scaf_map[uce_scaf].add_uce(uce_nm, uce_pos)
     
     # in case the ucefile was not in uce position sorted order, this will take care of that
-    sort_scafmap_by_uce_pos(scaf_map)
+    for scaf in scaf_map:
+        scaf_map[scaf].sort_by_pos()
 
     return scaf_map, scaf_list
 
 
-def map_uces_to_gff_lines(uce_file, gff_file, begpos_ix = 3, endpos_ix = 4, exclude_list = ["region"], remove_version = True):
-    ucefile = open(uce_file, "r")
-    gff = open(gff_file, "r")
-    
-    uces_by_scaf_map, scaf_list = create_uce_scaf_map(ucefile, remove_version)
-    Debug.print_scaf_counts(uces_by_scaf_map, scaf_list)
+class GffNotSorted(Exception): pass
 
+
+def gff_features(gff, begpos_ix = 3, endpos_ix = 4, exclude_list = ["region"], remove_version = True):
+    # yield scaffold, begpos, endpos and the line (without the newline) of each usable gff line
     for gff_ln in gff:
         # validate line
         if len(gff_ln) < 3 or gff_ln[0] == "#":  # ignore empty or comment lines
@@ -174,71 +242,311 @@ def map_uces_to_gff_lines(uce_file, gff_file, begpos_ix = 3, endpos_ix = 4, excl
         if begpos > endpos: # swap them so we always have smaller position followed by larger
             begpos, endpos = endpos, begpos
         
-        # line looks good, see if its extent has any of its scaffold's uce start positions in it
         scaf = cur_flds[0]
         if remove_version:
             scaf = remove_version_suffix(scaf)
             
-        if not scaf in uces_by_scaf_map:
+        yield scaf, begpos, endpos, gff_ln.rstrip("\n")
+
+
+def check_sorted(features): # pass the features through, raising GffNotSorted as soon as one is out of order
+    seen_scafs = set(); last_scaf = None; last_begpos = 0
+    for feature in features:
+        scaf, begpos = feature[0], feature[1]
+        if scaf != last_scaf:
+            if scaf in seen_scafs:
+                raise GffNotSorted("scaffold {} is not in one block of lines".format(scaf))
+            seen_scafs.add(scaf); last_scaf = scaf
+        elif begpos < last_begpos:
+            raise GffNotSorted("position {} on scaffold {} follows position {}".format(begpos, scaf, last_begpos))
+        last_begpos = begpos
+        yield feature
+
+
+def gff_matches(gff, uce_positions, gff_args, keep_lines = True):
+    # yield scaffold, range of uce indices, type and line (None if not kept) of each gff line with uces in its scope
+    for scaf, begpos, endpos, ln in gff_features(gff, *gff_args):
+        # line looks good, see if its extent has any of its scaffold's uce start positions in it
+        if not scaf in uce_positions:
             continue
         
         # there are uces on this scaffold: see if this gff line is in one of the uce's scopes.
-        # given certain assumptions about the order of the gff lines this could be done more
-        # efficiently, however since isoforms make the order a little more complicated we will
-        # do a search through all the specific scaffold's uce space for each line.
+        # the scaffold's uces are sorted by position, so binary search for the first uce at or
+        # after begpos and the first one after endpos. the uces between them are in the line's
+        # scope. this makes no assumptions about the order of the gff lines, so isoforms are fine.
+        
+        positions = uce_positions[scaf]
+        first = bisect_left(positions, begpos)
+        last = bisect_right(positions, endpos, first)
         
-        for u in uces_by_scaf_map[scaf]:
-            if begpos <= u.pos <= endpos: # this uce is the scope of this line
-                u.gff_lns.append(gff_ln.rstrip("\n"))
+        if first < last:
+            yield scaf, first, last, feature_type(ln), ln if keep_lines else None
+
+
+# what each worker process of parallel_gff_matches needs, set by init_gff_worker
+gff_worker = {}
+
+
+def init_gff_worker(uce_positions, gff_args, keep_lines):
+    gff_worker["uce_positions"] = uce_positions
+    gff_worker["gff_args"] = gff_args
+    gff_worker["keep_lines"] = keep_lines
+
+
+def match_gff_lines(lines): # run in a worker: the matches of a batch of gff lines
+    return list(gff_matches(lines, gff_worker["uce_positions"], gff_worker["gff_args"], gff_worker["keep_lines"]))
+
+
+def match_gff_byte_range(byte_range): # run in a worker: the matches of the lines starting in [start, stop) of the gff
+    gff_file, start, stop = byte_range
+    return match_gff_lines(byte_range_lines(gff_file, start, stop))
+
+
+def byte_range_lines(fname, start, stop):
+    f = open(fname, "rb")
+    if start > 0: # skip the rest of the line started before start, it belongs to the previous range
+        f.seek(start - 1)
+        f.readline()
+    pos = f.tell()
+    while pos < stop:
+        ln = f.readline()
+        if not ln:
+            break
+        pos += len(ln)
+        ln = ln.decode("utf-8", "replace")
+        if ln[-2:] == "\r\n": # as the universal newlines of a text mode open would have it
+            ln = ln[:-2] + "\n"
+        yield ln
+    f.close()
+
+
+def parallel_gff_matches(gff_file, uce_positions, gff_args, keep_lines, workers, add_introns = False, batch_lines = 100000):
+    # the matches of gff_matches, found by workers processes and yielded in gff order.
+    # a plain gff is split into byte ranges that each worker reads for itself; a compressed gff
+    # can't be split that way, nor can one that gets introns, as each intron comes from the line
+    # before it, so those are read here and handed out in batches of lines.
+    pool = multiprocessing.Pool(workers, init_gff_worker, (uce_positions, gff_args, keep_lines))
+    try:
+        if add_introns or is_gzipped(gff_file):
+            gff = open_gff(gff_file, add_introns)
+            while True:
+                # a round of batches at a time, so no more than that is ever read ahead of the workers
+                batches = []
+                for b in range(workers * 2):
+                    batch = [ln for ix, ln in zip(range(batch_lines), gff)]
+                    if len(batch) == 0:
+                        break
+                    batches.append(batch)
+                if len(batches) == 0:
+                    break
+                for matches in pool.map(match_gff_lines, batches):
+                    for match in matches:
+                        yield match
+            gff.close()
+        else:
+            size = os.path.getsize(gff_file)
+            chunk = max(size // (workers * 4) + 1, 1 << 20) # a few ranges per worker to even out the load
+            byte_ranges = [(gff_file, start, min(start + chunk, size)) for start in range(0, size, chunk)]
+            for matches in pool.imap(match_gff_byte_range, byte_ranges):
+                for match in matches:
+                    yield match
+    finally:
+        pool.terminate()
+
+
+def map_uces_to_gff_lines(uce_file, gff_file, begpos_ix = 3, endpos_ix = 4, exclude_list = ["region"], remove_version = True,
+                          keep_lines = True, workers = 1, add_introns = False):
+    ucefile = open_uces(uce_file)
+    
+    uces_by_scaf_map, scaf_list = create_uce_scaf_map(ucefile, remove_version)
+    Debug.print_scaf_counts(uces_by_scaf_map, scaf_list)
+    features = FeatureTable(keep_lines)
+    
+    uce_positions = { scaf: uces_by_scaf_map[scaf].positions for scaf in uces_by_scaf_map }
+    gff_args = (begpos_ix, endpos_ix, exclude_list, remove_version)
+    if workers > 1:
+        matches = parallel_gff_matches(gff_file, uce_positions, gff_args, keep_lines, workers, add_introns)
+    else:
+        matches = gff_matches(open_gff(gff_file, add_introns), uce_positions, gff_args, keep_lines)
+
+    for scaf, first, last, typ, ln in matches:
+        uces = uces_by_scaf_map[scaf]
+        feature_ix = features.add(ln, typ)
+        for uce_ix in range(first, last): # this uce is the scope of this line
+            uces.add_match(uce_ix, feature_ix)
                     
-    return uces_by_scaf_map, scaf_list
+    return uces_by_scaf_map, scaf_list, features
+
+
+def sweep_sorted_gff(uce_file, gff_file, begpos_ix = 3, endpos_ix = 4, exclude_list = ["region"], remove_version = True,
+                     keep_lines = True, add_introns = False):
+    # for a gff sorted by scaffold and start position, yield each uce with its gff lines as soon as no later
+    # line can be in its scope, i.e. once a line starts after it. only the lines that may still hold a uce
+    # of the scaffold are kept, so memory is bounded by how many features overlap, not by the size of the gff.
+    # scaffolds are yielded in gff order, then the ones without gff lines in uce file order.
+    # raises GffNotSorted if a line is out of order, after having yielded the uces before it.
+    ucefile = open_uces(uce_file)
+    gff = open_gff(gff_file, add_introns)
+    
+    uces_by_scaf_map, scaf_list = create_uce_scaf_map(ucefile, remove_version)
+    Debug.print_scaf_counts(uces_by_scaf_map, scaf_list)
+
+    def close_uces(scaf, uces, ix, active, begpos): # close the uces, from ix on, before begpos and drop the lines behind them
+        closed = []
+        while ix < len(uces) and uces.positions[ix] < begpos:
+            pos = uces.positions[ix]
+            active = [f for f in active if f[1] >= pos] # features are in gff order, so are the uce's lines
+            in_scope = [f for f in active if f[0] <= pos]
+            closed.append((scaf, uces.names[ix], pos, [f[2] for f in in_scope], [f[3] for f in in_scope] if keep_lines else None))
+            ix += 1
+        return closed, ix, active
+
+    swept = set()
+    cur_scaf = None; uces = ScafUces(); ix = 0; active = []
+    for scaf, begpos, endpos, ln in check_sorted(gff_features(gff, begpos_ix, endpos_ix, exclude_list, remove_version)):
+        if scaf != cur_scaf:
+            closed, ix, active = close_uces(cur_scaf, uces, ix, active, float("inf"))
+            for rec in closed:
+                yield rec
+            cur_scaf = scaf; swept.add(scaf)
+            uces = uces_by_scaf_map.get(scaf, ScafUces()); ix = 0; active = []
+        
+        if ix == len(uces): # no uces left on this scaffold
+            continue
+        
+        closed, ix, active = close_uces(cur_scaf, uces, ix, active, begpos)
+        for rec in closed:
+            yield rec
+        
+        if ix < len(uces) and endpos >= uces.positions[ix]: # may be in the scope of this or a later uce
+            active.append((begpos, endpos, feature_type(ln), ln if keep_lines else None))
+            
+    closed, ix, active = close_uces(cur_scaf, uces, ix, active, float("inf"))
+    for rec in closed:
+        yield rec
+    
+    for scaf in scaf_list: # intergenic, as there are no gff lines on them
+        if not scaf in swept:
+            uces = uces_by_scaf_map[scaf]
+            for ix in range(len(uces)):
+                yield scaf, uces.names[ix], uces.positions[ix], [], [] if keep_lines else None
+
+
+def index_features(gff, begpos_ix = 3, endpos_ix = 4, remove_version = True):
+    # what annotation_index.build_index stores of each usable gff line, none excluded by type
+    for scaf, begpos, endpos, ln in gff_features(gff, begpos_ix, endpos_ix, [], remove_version):
+        yield scaf, begpos, endpos, ln.split("\t")[2], feature_type(ln), ln
+
+
+def open_annotation_index(gff_file, index_dir, begpos_ix = 3, endpos_ix = 4, remove_version = True, add_introns = False):
+    # the index of the gff in index_dir, built first if this gff (or these options) were not indexed before
+    import annotation_index # only needed here, and it needs numpy
+    
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    key = annotation_index.index_key(gff_file, index_dir, add_introns, remove_version, begpos_ix, endpos_ix)
+    index_fname = annotation_index.index_path(index_dir, key)
+    if not os.path.isfile(index_fname):
+        sys.stderr.write("indexing {} into {}\n".format(gff_file, index_fname))
+        gff = open_gff(gff_file, add_introns)
+        annotation_index.build_index(index_features(gff, begpos_ix, endpos_ix, remove_version), index_fname)
+        
+    return annotation_index.AnnotationIndex(index_fname)
+
+
+def index_records(uce_file, index, exclude_list = ["region"], remove_version = True, keep_lines = True):
+    # the records of scafmap_records, with the gff lines of each uce looked up in an annotation index
+    uces_by_scaf_map, scaf_list = create_uce_scaf_map(open_uces(uce_file), remove_version)
+    Debug.print_scaf_counts(uces_by_scaf_map, scaf_list)
+    excluded = index.excluded_types(exclude_list)
+    
+    for scaf in scaf_list:
+        uces = uces_by_scaf_map[scaf]
+        for ix, feature_ixs in enumerate(index.features_at(scaf, uces.positions, excluded)):
+            types = [index.summary_type(f) for f in feature_ixs]
+            lines = [index.line(f) for f in feature_ixs] if keep_lines else None
+            yield scaf, uces.names[ix], uces.positions[ix], types, lines
+
+
+def scafmap_records(uces_by_scaf_map, scaf_list, features):
+    # each uce with the types and gff lines (None if not kept) of the features in its scope, in display order
+    for scaf in scaf_list:
+        uces = uces_by_scaf_map[scaf]
+        for ix, feature_ixs in enumerate(uces.uce_features()):
+            types = [features.types[f] for f in feature_ixs]
+            lines = [features.lines[f] for f in feature_ixs] if features.lines is not None else None
+            yield scaf, uces.names[ix], uces.positions[ix], types, lines
 
 
-def display_uce_gff_info(uces_by_scaf_map, scaf_list, show_summary = True, show_lines = False):
+def display_uce_gff_info(uces_by_scaf_map, scaf_list, features, show_summary = True, show_lines = False, fout = sys.stdout):
+    return display_uce_records(scafmap_records(uces_by_scaf_map, scaf_list, features), show_summary, show_lines, fout)
+
+
+def display_uce_records(uce_records, show_summary = True, show_lines = False, fout = sys.stdout):
     show_summary = show_summary or not show_lines # if both are False we still want to show the summaries
-    type_totals = {} # totals for exon_only, intron_only, exin_and_intron, or intergenic UCEs in the gff
     last_scaf = ""; last_pos = 0 # so we can output distance from last UCE as the 5th field
     
     num_uces = 0; num_gfflns = 0
-    for scaf in scaf_list:
-        for u in uces_by_scaf_map[scaf]:
-            num_uces += 1; num_gfflns += len(u.gff_lns)
-            distance = "" if scaf != last_scaf else u.pos-last_pos
-            last_scaf = scaf; last_pos = u.pos
-            uce_info = "{}\t{}\t{}\t".format(u.uce, scaf, u.pos)
-            if len(u.gff_lns) > 0:
-                if show_summary: # uce name, scaf, begpos, all the gff line types associated with this uce
-                    typ = ""
-                    for l in u.gff_lns:
-                        flds = l.split("\t")
-                        typ += flds[2]
-                        if flds[2] == "gene":
-                            gid = get_subfld(flds[8])
-                            if gid != "":
-                                typ += "(" + gid + ")"
-                        typ += " "
-                    sys.stdout.write("{}{}\t{}\t{}\n".format(uce_info, TypeUtil.shorthand_str(typ), distance, typ))
+    for scaf, uce, pos, types, lines in uce_records:
+        num_uces += 1; num_gfflns += len(types)
+        distance = "" if scaf != last_scaf else pos-last_pos
+        last_scaf = scaf; last_pos = pos
+        uce_info = "{}\t{}\t{}\t".format(uce, scaf, pos)
+        if len(types) > 0:
+            typ = "".join(t + " " for t in types) # all the gff line types associated with this uce
+            if show_summary: # uce name, scaf, begpos, types
+                fout.write("{}{}\t{}\t{}\n".format(uce_info, TypeUtil.shorthand_str(typ), distance, typ))
+        
+            if show_lines: # show uce name then gff line
+                for ln in lines:
+                    fout.write("{}\t{}\n".format(uce, ln))
+        else:
+            typ = "intergenic"
+            fout.write("{}N\t{}\t{}\n".format(uce_info, distance, typ))
             
-                if show_lines: # show uce name then gff line
-                    for ln in u.gff_lns:
-                        sys.stdout.write("{}\t{}\n".format(u.uce, ln))
-            else:
-                typ = "intergenic"
-                sys.stdout.write("{}N\t{}\t{}\n".format(uce_info, distance, typ))
-                
-            TypeUtil.inc_totals_from_types(typ)
+        TypeUtil.inc_totals_from_types(typ)
                                 
     return num_uces, num_gfflns
 
 
-def map_and_display(uce_filename, gff_filename, exclude_list, show_summary, show_lines):
+def map_and_display(uce_filename, gff_filename, exclude_list, show_summary, show_lines, sorted_gff = None, workers = 1,
+                    add_introns = False, index_dir = None, fout = sys.stdout):
     start = time.time()
     
-    # gather up a map per scaffold of the uces in that scaffold and the gff lines overlapping each such uce
-    uces_by_scaf_map, scaf_list = map_uces_to_gff_lines(uce_filename, gff_filename, exclude_list = exclude_list)
+    if index_dir is not None:
+        # look the uces up in the annotation index of the gff, made on the first run with it
+        index = open_annotation_index(gff_filename, index_dir, add_introns = add_introns)
+        uce_records = index_records(uce_filename, index, exclude_list = exclude_list, keep_lines = show_lines)
+    else:
+        uce_records = None
+        if sorted_gff is None and workers <= 1:
+            # not given, so sweep the gff as if it were sorted, holding the records until the sweep is done,
+            # and map it instead if it turns out not to be. the uces are read again then
+            if not isinstance(uce_filename, str):
+                uce_filename = list(uce_filename)
+            try:
+                uce_records = list(sweep_sorted_gff(uce_filename, gff_filename, exclude_list = exclude_list,
+                                                    keep_lines = show_lines, add_introns = add_introns))
+            except GffNotSorted:
+                sorted_gff = False
+        
+        if uce_records is None and sorted_gff:
+            # stream each uce out as soon as the sorted gff is past it
+            uce_records = sweep_sorted_gff(uce_filename, gff_filename, exclude_list = exclude_list, keep_lines = show_lines,
+                                           add_introns = add_introns)
+        elif uce_records is None:
+            # gather up a map per scaffold of the uces in that scaffold and the gff features overlapping each such uce
+            uces_by_scaf_map, scaf_list, features = map_uces_to_gff_lines(uce_filename, gff_filename, exclude_list = exclude_list,
+                                                                          keep_lines = show_lines, workers = workers,
+                                                                          add_introns = add_introns)
+            uce_records = scafmap_records(uces_by_scaf_map, scaf_list, features)
     
     # display the info based on defaults or user preferences that override them
-    num_uces, num_gfflns = display_uce_gff_info(uces_by_scaf_map, scaf_list, show_summary, show_lines)
+    try:
+        num_uces, num_gfflns = display_uce_records(uce_records, show_summary, show_lines, fout)
+    except GffNotSorted as e:
+        sys.stderr.write("\n{} is not sorted: {}. Run without -sorted.\n".format(gff_filename, e))
+        sys.exit(1)
 
     # show what was done and how long it took    
     duration = (time.time() - start) / 1000 * 1000
@@ -250,7 +558,8 @@ def map_and_display(uce_filename, gff_filename, exclude_list, show_summary, show
 
 def usage(exit_code = 1):
     msg = """
-    usage: uce_gff_lines.py <uce_name_pos_file> <gff_file> [-lines [-nosummary]] [<gff_line_type_to_exclude> ...]
+    usage: uce_gff_lines.py <uce_name_pos_file> <gff_file> [-lines [-nosummary]] [-sorted | -unsorted] [-workers <n>]
+                            [-introns] [-index <index_dir>] [<gff_line_type_to_exclude> ...]
     
     Input is a file with UCE info lines and a gff file, preferably with introns added
     (for this use you can use add_intron_to_gff.py or other programs).
@@ -270,6 +579,24 @@ def usage(exit_code = 1):
     The intergenic UCEs are shown in both cases. You can screen out any summary lines, including
     intergenic, and just retain the gff lines by piping output to: awk '! ($3~/^[0-9]+$/)' or you
     can remove gff_lines retaining only the summary by piping to: awk '($3~/^[0-9]+$/)'
+    
+    If the gff is sorted by scaffold and then start position (e.g. sort -k1,1 -k4,4n) each UCE is
+    output as soon as the gff is read past it, keeping only the gff lines that may still overlap a UCE.
+    Scaffolds are then output in gff order rather than UCE file order. The gff is checked for this
+    order first, use -sorted to skip the check (it stops with an error at the first line out of order)
+    or -unsorted to always read the whole gff before any output.
+    
+    Both files can be gzip (or bgzip) compressed. With -workers the gff is read by that many processes,
+    each matching a part of it against the UCEs, with the same output. A plain gff is split by byte
+    ranges, a compressed one is decompressed here and handed out in batches of lines. The gff is then
+    not checked for sorted order, as the sorted mode reads it in a single pass.
+    
+    -introns adds intron lines between the exon lines of the gff as it is read, as add_introns_to_gff.py
+    does, so the gff with introns does not need to be written first.
+    
+    -index keeps a binary index of the gff (with the introns, if -introns is used) in <index_dir>, named
+    by a hash of the gff contents. The first run builds it, later runs with the same gff, with this or
+    any other uce file, read the index instead of the gff. Output is that of a gff that is not sorted.
 
 """
     sys.stderr.write(msg)
@@ -290,12 +617,17 @@ def getoptions(argv, min_args, exit_code = 1):
     options.gff_filename = argv[2]; checkfile(options.gff_filename)
     options.show_summary = True
     options.show_lines = False
-    options.excludes = ["region", "Region", "REGION"]
+    options.excludes = list(DEFAULT_EXCLUDES)
+    options.sorted_gff = None # look at the gff to see if it is sorted
+    options.workers = 1
+    options.add_introns = False
+    options.index_dir = None
     
     
     # handle the options after the 2 file names. file names must be in those positions.
-    for op in range(3,len(argv)):
-        arg = argv[op]
+    op = 2
+    while op+1 < len(argv):
+        op += 1; arg = argv[op]
         if arg[:3] == "-li":
             options.show_lines = True
         elif arg[:5] == "-nosu":
@@ -304,6 +636,16 @@ def getoptions(argv, min_args, exit_code = 1):
             options.excludes.append(arg)
         elif arg == "-debug":
             Debug.debugging = True
+        elif arg in ["-sorted", "--sorted"]:
+            options.sorted_gff = True
+        elif arg in ["-unsorted", "--unsorted"]:
+            options.sorted_gff = False
+        elif arg[:4] == "-wor" and op+1 < len(argv) and argv[op+1].isdigit():
+            op += 1; options.workers = int(argv[op])
+        elif arg[:4] == "-int":
+            options.add_introns = True
+        elif arg[:4] == "-ind" and op+1 < len(argv):
+            op += 1; options.index_dir = argv[op]
         else:
             sys.stderr.write("invalid option: {}\n".format(arg))
             
@@ -312,7 +654,8 @@ def getoptions(argv, min_args, exit_code = 1):
     
 def main(argv):  # pass in argv so we can load this file and call this as uce_gff_lines.main(sys.argv) from another python file                 
     ops = getoptions(argv, 3) # need at least 3 args: prog_name, uce_filename, gff_filename
-    map_and_display(ops.uce_filename, ops.gff_filename, ops.excludes, ops.show_summary, ops.show_lines)
+    map_and_display(ops.uce_filename, ops.gff_filename, ops.excludes, ops.show_summary, ops.show_lines, ops.sorted_gff,
+                    ops.workers, ops.add_introns, ops.index_dir)
 
 
 if __name__ == '__main__':
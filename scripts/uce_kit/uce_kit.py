@@ -14,46 +14,41 @@ AATTTCCTAGTTAAAACCCTCCCTTGCTGACAAGGGACTGAAAGAGTTTTAAATCACAGATGTAGAGTATCAAATGCAAT
 
 from __future__ import print_function # only using print for test function but make sure workins in python3 and python2
 import sys, os.path
-import re, operator, subprocess
+import re, subprocess
+import shutil, tempfile, heapq
 
-# we parse the Uce fasta header line as a class method because we want to add all of the uce's probes
-# to the same Uce object instance. So we can call parse_line and check to see if the uce
-# name is already in a Uce object. That is how the UceList class uses this Uce list.
-class Uce:
+# a Uce holds the probes of one uce, in the order they are in the fasta file. the probes are merged into
+# the uce sequence the first time the sequence is asked for, not as each probe is added, so a uce
+# with many probes is merged once. the fasta header line of each probe is parsed by parse_header,
+# which returns its fields rather than keeping them in the class, so UceList objects don't share state.
+class Uce(object):
     overlap_bases = 60
+    __slots__ = ("name", "field", "comment", "probes", "_sequence", "_errormsg")
     
-    @classmethod
-    def parse_line(cls, ln): # set class variables for the Uce line, e.g.: >uce-5_p2 |source:faircloth,probes-id:2683,probes-locus:5,probes-probe:2
-        cls.init_vars()
+    @staticmethod
+    def parse_header(ln): # e.g.: >uce-5_p2 |source:faircloth,probes-id:2683,probes-locus:5,probes-probe:2
+        # returns uce name (uce-5), probe (p2), comment (|source:faircloth,...) and field (uce-5_p2)
+        uce_name = ""; uce_probe = ""; uce_comment = ""; uce_field = ""
         ln = ln.rstrip("\n")
         if len(ln) > 3:
             if ln[0] == ">":
                 ln = ln[1:]
-            flds = ln.split(" ")
-            cls.uce_field = flds[0]
-            cls.uce_comment = ln[(len(flds[0])+1) : ] # take rest of line after uce name, do this way so spaces in comment ok
-            flds = cls.uce_field.split("_")
-            cls.uce_name = flds[0]
+            uce_field = ln.split(" ", 1)[0]
+            uce_comment = ln[(len(uce_field)+1) : ] # take rest of line after uce name, do this way so spaces in comment ok
+            flds = uce_field.split("_")
+            uce_name = flds[0]
             if len(flds) > 1:
-                cls.uce_probe = flds[1]
-            # print cls.uce_field; print cls.uce_name; print cls.uce_probe; print cls.uce_comment
+                uce_probe = flds[1]
             
-        return cls.uce_name
+        return uce_name, uce_probe, uce_comment, uce_field
 
-    @classmethod
-    def init_vars(cls):
-        cls.uce_name = ""    # uce-5
-        cls.uce_probe = ""   # p2
-        cls.uce_comment = "" # |source:faircloth,probes-id:2683,probes-locus:5,probes-probe:2
-        cls.uce_field = ""   # uce-5_p2
-            
-    # these are the instance methods
-    def __init__(self, uce_name = None):  # call class method parse_line(ln) before creating object
-        self.name = Uce.uce_name if uce_name == None else uce_name
-        self.field = Uce.uce_field
-        self.comment = Uce.uce_comment
-        self.probes = [] # each entry is a list of probe name and probe sequence
-        self.errormsg = ""
+    def __init__(self, uce_name = "", field = "", comment = ""):
+        self.name = uce_name
+        self.field = field
+        self.comment = comment
+        self.probes = [] # each entry is a tuple of probe name, probe sequence and comment
+        self._sequence = None # merged probes, None until merge_probes is called
+        self._errormsg = ""
         
     def __len__(self):
         return len(self.probes)
@@ -61,18 +56,8 @@ class Uce:
     def __getitem__(self, ix_probe):  # get the probe tuple associated with ix_arg
         return self.probes[ix_probe]
     
-    # define iter and next so can do for p in uce and get the probe lists
-    def __iter__(self):
-        self.ix_probe = 0
-        return self
-    def __next__(self):
-        if self.ix_probe >= len(self.probes):
-            raise StopIteration
-        else:
-            prb = self.probes[self.ix_probe]
-            self.ix_probe += 1
-            return prb
-    next = __next__
+    def __iter__(self): # so can do for p in uce and get the probe tuples
+        return iter(self.probes)
         
     def get_probe(self, probe_number = 1): # return sequence for probe, first probe 1 by default
         num_probes = len(self.probes)
@@ -88,34 +73,47 @@ class Uce:
         else:
             return ""
         
-    def get_probe_info(self, probe_number = 1): # return the whole 3 component list of the probe
+    def get_probe_info(self, probe_number = 1): # return the whole 3 component tuple of the probe
         num_probes = len(self.probes)
         if probe_number <= num_probes:
             return self.probes[(probe_number-1)]
         else:
-            return []
+            return ()
         
-    def add_probe(self, sequence, probe = None, comment = None):
-        probe = self.uce_probe if probe == None else probe
-        comment = self.uce_comment if comment == None else comment
-        self.probes.append([probe, sequence, comment])
-        self.merge_probes() # merge them as they come in
+    def add_probe(self, sequence, probe = "", comment = None):
+        comment = self.comment if comment == None else comment
+        self.probes.append((probe, sequence, comment))
+        self._sequence = None # merged again when the sequence is next asked for
         return self
+    
+    @property
+    def sequence(self): # the probes merged into a single sequence
+        if self._sequence == None:
+            self.merge_probes()
+        return self._sequence
+    
+    @property
+    def errormsg(self): # why the probes could not all be merged, empty if they were
+        if self._sequence == None:
+            self.merge_probes()
+        return self._errormsg
         
-    def merge_probes(self, overlap = 0): # probes overlap, usually 60 bases, merge them into a single sequence and return it
+    def merge_probes(self, overlap = 0): # probes overlap, usually 60 bases, merge them into a single sequence
         overlap = self.overlap_bases if overlap == 0 else overlap
-        self.errormsg = ""
+        self._errormsg = ""
 
         num_prbs = len(self.probes)
-        self.sequence = "" if num_prbs < 1 else self.probes[0][1] # initialize with sequence of first probe
+        seq_parts = [] if num_prbs < 1 else [self.probes[0][1]] # initialize with sequence of first probe
+        overlap_seq = "" if num_prbs < 1 else self.probes[0][1][-overlap:] # last 60 bases of the sequence
         for p in range(1, num_prbs):
-            overlap_seq = self.sequence[-overlap:] # last 60 bases of the sequence
             probe_seq = self.probes[p][1]
             if probe_seq[:overlap] == overlap_seq: # probe looks good
-                self.sequence += probe_seq[overlap:]
+                seq_parts.append(probe_seq[overlap:])
+                overlap_seq = (overlap_seq + probe_seq[overlap:])[-overlap:]
             else:
-                self.errormsg = "{}: first {} bases of probe {} did not match last {} bases of probe {}.".format(self.uce_name, overlap, p+1, overlap, p)
+                self._errormsg = "{}: first {} bases of probe {} did not match last {} bases of probe {}.".format(self.name, overlap, p+1, overlap, p)
                 break 
+        self._sequence = "".join(seq_parts)
         return self
     
     def write_uce_record(self, show_errs = True):
@@ -130,10 +128,41 @@ class Uce:
 
 # end Uce class definition
 
+def fasta_records(fh, block_size = 1 << 20):
+    # yield the header line and sequence of each fasta record in fh, which is read in blocks of block_size.
+    # lines shorter than 3 characters and lines starting with # are skipped
+    header = None; seq_parts = []
+    tail = "" # partial line at the end of the last block
+    while True:
+        block = fh.read(block_size)
+        if block == "":
+            lines = [tail]
+        else:
+            block = tail + block
+            cut = block.rfind("\n") + 1
+            lines = block[:cut].split("\n"); tail = block[cut:]
+        
+        for ln in lines:
+            if len(ln) < 3 or ln[0] == "#":
+                continue
+            if ln[0] == ">": # next fasta record started
+                if header != None:
+                    yield header, "".join(seq_parts)
+                header = ln; seq_parts = []
+            else:
+                seq_parts.append(ln)
+        
+        if block == "":
+            break
+    
+    if header != None:
+        yield header, "".join(seq_parts)
+
 class UceList:
     def __init__(self):
         self.uce_map = {}
         self.uce_list = []
+        self.last_probe = ("", "", "") # uce name, probe and comment of the last header line, for add_probe_sequence
         
     def __len__(self):
         return len(self.uce_list)
@@ -145,59 +174,39 @@ class UceList:
         name = self.uce_list[arg] if str(arg).isdigit() else arg
         return self.uce_map[name]
 
-    def __iter__(self):  # implement __iter__ and __next__ to make this an iterable
-        self.ix_uce_list = 0
-        return self
-
-    def __next__(self): # Python 3, Python 2 will call next():
-        if self.ix_uce_list >= len(self.uce_list):
-            raise StopIteration
-        else:
-            uce_nm = self.uce_list[ self.ix_uce_list ]
-            self.ix_uce_list += 1
-            return self.uce_map[uce_nm] # return object associated with the next uce_nm in the list
-        
-    next = __next__ # assign Python 2's next to Python 3's __next__ function, so they'll both work
+    def __iter__(self):  # the uce objects in the order they were added
+        return (self.uce_map[uce_nm] for uce_nm in self.uce_list)
     
     def add_probe_info(self, uceln, seq = None):
-        uce_nm = Uce.parse_line(uceln) # use Uce classes to parse the line and set class variables
+        uce_nm, probe, comment, field = Uce.parse_header(uceln)
         if not uce_nm in self.uce_map and len(uce_nm) > 0: # first time we've seen this uce's probe, add it to our list and map
             self.uce_list.append(uce_nm)
-            self.uce_map[uce_nm] = Uce(uce_nm) # create a Uce object and store it in the map
+            self.uce_map[uce_nm] = Uce(uce_nm, field, comment) # create a Uce object and store it in the map
+        self.last_probe = (uce_nm, probe, comment)
             
         if seq != None: # can do it in one go if we have the seq or call add_probe_sequence later when seq is known
             self.add_probe_sequence(uce_nm, seq)
         
         return uce_nm
     
-    def add_probe_sequence(self, uce_nm, probe_seq):
+    def add_probe_sequence(self, uce_nm, probe_seq): # probe and comment are from the last add_probe_info line for uce_nm
         obj = None
         if uce_nm in self.uce_map:
             uce_obj = self.uce_map[uce_nm]
-            obj = uce_obj.add_probe(probe_seq)
+            last_nm, probe, comment = self.last_probe
+            if last_nm == uce_nm:
+                obj = uce_obj.add_probe(probe_seq, probe, comment)
+            else:
+                obj = uce_obj.add_probe(probe_seq)
         return obj
     
     def load_file(self, uce_fname):
         if not checkfile(uce_fname):
             return None # None signals a problem
             
-        ucefile = open(uce_fname, "r")
-        sequence = "" # sequence of the current fasta record
-        for ln in ucefile:
-            ln = ln.rstrip("\n")
-            if len(ln) < 3 or ln[0] == "#":
-                continue
-            if ln[0] == ">": # next fasta record started
-                if sequence != "": # add sequence for the last fasta record
-                    self.add_probe_sequence(uce_nm, sequence)
-                    
-                sequence = ""               
-                uce_nm = self.add_probe_info(ln)
-            else:
-                sequence += ln
-            
-        if uce_nm != "" and sequence != "": # add the last probe sequence
-            self.add_probe_sequence(uce_nm, sequence)
+        with open(uce_fname, "r") as ucefile:
+            for header, sequence in fasta_records(ucefile):
+                self.add_probe_info(header, sequence if sequence != "" else None)
         return self
     
     def write_uce_records(self, show_errs = True):  # output merged probe sequences as fasta records
@@ -302,56 +311,86 @@ def filter_uce_match_m8_file(m8_filename, pct_match = 99.0, len_match = 120, exc
     # for those lines where pct_match and len_match criteria are met use first probe of uce
     # in m8 file and write out uce name and first position in scaffold where the UCE starts
     # also exclude any lines where the scaffold name in fld 2 has a prefix in exclude_prefixes
-    uce_info = [] # each entry will be a 3 value tuple
-    uce_nm_map = {} # 10Jul2019 to keep track if we have already seen this uce
-    last_nm = ""
-
     fh = open(m8_filename, "r")
-    for tsv in fh:
+    for tup in filter_uce_matches(fh, pct_match, len_match, exclude_prefixes):
+        fout.write("{}\t{}\t{}\n".format(tup[0], tup[1], tup[2]))
+
+FILTER_SORT_RECORDS = 1000000 # uce locations sorted in memory by filter_uce_matches, more than this are sorted in runs on disk
+FILTER_SORT_RUNS = 64 # sorted runs merged at a time, so there are never more than this many open
+
+def filter_uce_matches(m8_lines, pct_match = 99.0, len_match = 120, exclude_prefixes = [],
+                       max_records = FILTER_SORT_RECORDS, tmp_dir = None):
+    # the filtering of filter_uce_match_m8_file, on any iterable of m8 lines, e.g. as they come out of blat or blast.
+    # yields the (uce name, scaffold, pos, pct match, match len) tuples sorted by scaffold then pos. up to max_records
+    # are sorted in memory, beyond that each max_records are sorted into a run in a temporary file in tmp_dir and
+    # the runs are merged as the tuples are yielded
+    uce_nms = set() # 10Jul2019 to keep track if we have already seen this uce
+    probe_suffix = re.compile("_p[0-9]+$")
+    exclude_res = [re.compile("^"+p) for p in exclude_prefixes]
+    scaff_ok = {} # whether each scaffold name seen is not excluded by a prefix
+    
+    uce_info = [] # each entry is a (scaffold, pos, line number, uce name, pct match, match len) tuple
+    runs = [] # temporary files with the sorted runs, when uce_info has had to be written out
+    for line_num, tsv in enumerate(m8_lines):
         flds = tsv.rstrip("\n").split("\t")
         if len(flds) < 11:
             sys.stderr.write("not enough fields in line: {}".format(len(flds)))
             break
         
-        if float(flds[2]) < pct_match or int(flds[3]) < len_match:
+        pct = float(flds[2]); match_len = int(flds[3])
+        if pct < pct_match or match_len < len_match:
             continue
 
         probe_nm = flds[0] # consists of uce name and probe number e.g. uce-501_p1 or uce-36_6
         scaff_nm = flds[1]
-        pos = flds[8] if flds[8] < flds[9] else flds[9]
+        pos = min(int(flds[8]), int(flds[9])) # start of the match on either strand
 
-        # JBH 10Jul2019 change method for determining uce to include (was based on _p1 which doesn't necessarily hold)
-        ''' # old method
-        uce_nm = re.sub("_p1$", "", probe_nm)
-        if re.search("_p[0-9]+$", uce_nm): # it's not the first probe
-            continue
-        '''
-        # new method, takes first one and ignores others with same prefix before _p[0-9]+
-        uce_nm = re.sub("_p[0-9]+$", "", probe_nm)
-        if uce_nm in uce_nm_map:
-            continue
-        uce_nm_map[ uce_nm ] = pos
-        
-        prefix_ok = True
-        for p in exclude_prefixes:
-            if re.search("^"+p, scaff_nm):
-                prefix_ok = False
-                break
-        if not prefix_ok:
+        # JBH 10Jul2019 takes first one and ignores others with same prefix before _p[0-9]+ (was based on _p1 which doesn't necessarily hold)
+        uce_nm = probe_suffix.sub("", probe_nm)
+        if uce_nm in uce_nms:
             continue
+        uce_nms.add(uce_nm)
         
-        # make sure we aren't trying to put in one that we just appended
-        if last_nm == probe_nm:
+        if not scaff_nm in scaff_ok:
+            scaff_ok[scaff_nm] = not any(rx.search(scaff_nm) for rx in exclude_res)
+        if not scaff_ok[scaff_nm]:
             continue
-        last_nm = probe_nm
         
-        tup = (uce_nm, scaff_nm, int(pos), flds[2], flds[3])
-        uce_info.append(tup)
-     
-    # sort by scaffold name in tup[1] then pos in tup[2]   
-    uce_info.sort(key = operator.itemgetter(1, 2))
+        uce_info.append( (scaff_nm, pos, line_num, uce_nm, pct, match_len) )
+        if len(uce_info) >= max_records:
+            uce_info.sort()
+            runs.append(write_sorted_run(uce_info, tmp_dir))
+            uce_info = []
+            if len(runs) >= FILTER_SORT_RUNS: # merge them into one run
+                merged = write_sorted_run(heapq.merge(*[read_sorted_run(run) for run in runs]), tmp_dir)
+                for run in runs:
+                    run.close()
+                runs = [merged]
+    
+    # sort by scaffold name then pos, the line number keeps uces at the same pos in m8 order
+    uce_info.sort()
+    try:
+        if len(runs) == 0:
+            sorted_info = uce_info
+        else:
+            sorted_info = heapq.merge(uce_info, *[read_sorted_run(run) for run in runs])
+        for scaff_nm, pos, line_num, uce_nm, pct, match_len in sorted_info:
+            yield (uce_nm, scaff_nm, pos, pct, match_len)
+    finally:
+        for run in runs:
+            run.close()
+
+def write_sorted_run(uce_info, tmp_dir = None): # for filter_uce_matches, the file is removed when it is closed
+    run = tempfile.TemporaryFile(mode = "w+", dir = tmp_dir)
     for tup in uce_info:
-        fout.write("{}\t{}\t{}\n".format(tup[0], tup[1], tup[2]))
+        run.write("{}\t{}\t{}\t{}\t{!r}\t{}\n".format(*tup))
+    run.seek(0)
+    return run
+
+def read_sorted_run(run):
+    for ln in run:
+        scaff_nm, pos, line_num, uce_nm, pct, match_len = ln.rstrip("\n").split("\t")
+        yield (scaff_nm, int(pos), int(line_num), uce_nm, float(pct), int(match_len))
 
 def cmd_exists(cmd):
     return any(
@@ -389,27 +428,43 @@ def execute_cmdline(cmdline, outfile=None, msg_to_stderr=None):
 
 # call out to blat (or blatq) to do search of uce probes in genome fasta
 # use blat setting minScore=100 to reduce cluttered hits fot the 120 base probes
+BLAT_SETTINGS = "-stepSize=5 -repMatch=100000 -out=blast8 -minScore=100"
+
 def blat_uces(uces, genome, output):
-    pgm = check_pgm_and_ops(["blat", "blatq"], uces, genome)
-    if pgm == None:
+    cmdline = blat_cmdline(uces, genome, output)
+    if cmdline == None:
         return -1
     
-    if output == "": output = "stdout"
-    settings = "-stepSize=5 -repMatch=100000 -out=blast8 -minScore=100"
-    cmdline = "{} {} {} {} {}".format(pgm, settings, genome, uces, output)
     sys.stderr.write("Searching for uces: {}\n".format(cmdline))
     retcode = subprocess.call( cmdline.split(" ") )
     return retcode
 
+def blat_cmdline(uces, genome, output = ""): # None if blat can't be found
+    pgm = check_pgm_and_ops(["blat", "blatq"], uces, genome)
+    if pgm == None:
+        return None
+    
+    if output == "": output = "stdout"
+    return "{} {} {} {} {}".format(pgm, BLAT_SETTINGS, genome, uces, output)
+
 
 # makeblastdb for the genome file in ops.filename if it does not exist.
 # makeblastdb -db galGal6.fasta -dbtype nucl
 # makes galGal6.fasta.nin galGal6.fasta.nhr & galGal6.fasta.nsq
 # blastn -query genes.ffn -subject genome.fa -outfmt 6 -evalue 1e-50
-def blast_uces(uces, genome, eVal, addtl_args = ""):
+def blast_uces(uces, genome, eVal, addtl_args = "", db = None):
+    cmdline = blast_cmdline(uces, genome, eVal, addtl_args, db)
+    if cmdline == None:
+        return -1
+    
+    sys.stderr.write("Searching for uces: {}\n".format(cmdline))
+    retcode = subprocess.call ( cmdline.rstrip(" ").split(" ") )
+    return retcode
+
+def blast_cmdline(uces, genome, eVal, addtl_args = "", db = None): # makes the blast db if needed, None if that can't be done
     pgm = check_pgm_and_ops(["blastn", "makeblastdb"], uces, genome)
     if pgm == None:
-        return -1
+        return None
 
     evalue = "-evalue " + eVal
     if addtl_args.find("-evalue ") > -1: # can't define same arg twice for blast utilities
@@ -418,19 +473,171 @@ def blast_uces(uces, genome, eVal, addtl_args = ""):
     ext = [".nin",".nhr",".nsq"] # extensions of files created by makeblastdb added to the genome fasta filename
     db_exists = os.path.isfile(genome+ext[0]) and os.path.isfile(genome+ext[1]) and os.path.isfile(genome+ext[2])
     
-    if not db_exists:
+    if not db_exists and db == None:
         cmdline = "makeblastdb -in {} -dbtype nucl".format(genome)
         sys.stderr.write(cmdline)
         retcode = subprocess.call ( cmdline.split(" "), stdout=sys.stderr )
         if retcode != 0:
             sys.stderr.write("error {} creating blast db\n".format(retcode))
-            return
+            return None
         sys.stderr.write("\n")
+    
+    db = genome if db == None else db # db made elsewhere, e.g. by cached_blast_db
+    return "blastn -query {} -db {} -outfmt 6 {} {}".format(uces, db, evalue, addtl_args).rstrip(" ")
+
+def shard_fasta(fasta, num_shards, shard_dir):
+    # split the fasta records into up to num_shards files with about the same number of bases. each shard is a run
+    # of consecutive records, so the shard results joined in shard order are in the order of the whole file.
+    # returns the shard file names
+    with open(fasta, "r") as fh:
+        records = [(header, seq) for header, seq in fasta_records(fh) if seq != ""]
+    total_bases = max(1, sum(len(seq) for header, seq in records))
+    
+    shard_names = []; fout = None
+    cur_shard = -1; bases = 0
+    for header, seq in records:
+        shard = min(num_shards-1, bases * num_shards // total_bases)
+        if shard != cur_shard:
+            if fout != None:
+                fout.close()
+            cur_shard = shard
+            shard_names.append(os.path.join(shard_dir, "shard{:04d}.fa".format(shard)))
+            fout = open(shard_names[-1], "w")
+        fout.write("{}\n{}\n".format(header, seq))
+        bases += len(seq)
+    if fout != None:
+        fout.close()
+    return shard_names
+
+def search_uces_sharded(uces, genome, m8_file, shards):
+    # blat the uces split into shards, all searched at the same time. each blat loads the whole genome, so
+    # this takes shards times the memory of one blat. the m8 results of the shards are joined in shard order
+    # so m8_file has the hits in the order of the uces file
+    shard_dir = tempfile.mkdtemp(prefix = "uce_shards.", dir = os.path.dirname(os.path.abspath(m8_file)))
+    try:
+        shard_names = shard_fasta(uces, shards, shard_dir)
+        cmdlines = []
+        for shard in shard_names:
+            cmdline = blat_cmdline(shard, genome, shard + ".m8")
+            if cmdline == None:
+                return -1
+            cmdlines.append(cmdline)
         
-    cmdline = "blastn -query {} -db {} -outfmt 6 {} {}".format(uces, genome, evalue, addtl_args)
-    sys.stderr.write("Searching for uces: {}\n".format(cmdline))
-    retcode = subprocess.call ( cmdline.rstrip(" ").split(" ") )
-    return retcode
+        sys.stderr.write("Searching for uces in {} shards:\n".format(len(shard_names)))
+        procs = []
+        for cmdline in cmdlines:
+            sys.stderr.write("    {}\n".format(cmdline))
+            procs.append( subprocess.Popen( cmdline.rstrip(" ").split(" ") ) )
+        retcodes = [proc.wait() for proc in procs]
+        for cmdline, retcode in zip(cmdlines, retcodes):
+            if retcode != 0:
+                sys.stderr.write("error {} from: {}\n".format(retcode, cmdline))
+                return retcode
+        
+        with open(m8_file, "w") as fout:
+            for shard in shard_names:
+                with open(shard + ".m8", "r") as fh:
+                    shutil.copyfileobj(fh, fout)
+        return 0
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors = True)
+
+def blast_thread_args(threads): # blastn searches with threads threads in one process, sharing the db
+    return "-num_threads {} ".format(threads) if threads > 1 else ""
+
+def search_uces(uces, genome, m8_file, threads = 1, eVal = "9e-40", db = None, shards = 1): # Step 1 of run_pipeline
+    if cmd_exists("blat") or cmd_exists("blatq"):
+        if shards > 1:
+            return search_uces_sharded(uces, genome, m8_file, shards)
+        return blat_uces(uces, genome, m8_file)
+    else: # could not find blat or blatq, run blast
+        return blast_uces(uces, genome, eVal, blast_thread_args(threads) + "-out " + m8_file, db)
+
+def search_settings(eVal): # the aligner and settings search_uces will use, these go into the search cache key
+    if cmd_exists("blat"):
+        return "blat " + BLAT_SETTINGS
+    elif cmd_exists("blatq"):
+        return "blatq " + BLAT_SETTINGS
+    return "blastn -outfmt 6 -evalue " + eVal
+
+def cached_blast_db(cache_dir, genome): # make the blast db of genome in the search cache if it isn't there yet
+    import search_cache
+    db = search_cache.blast_db(cache_dir, genome)
+    if os.path.isfile(db + ".nsq") or os.path.isfile(db + ".00.nsq"):
+        return db
+    
+    db_dir = os.path.dirname(db)
+    if not os.path.isdir(os.path.dirname(db_dir)):
+        os.makedirs(os.path.dirname(db_dir), exist_ok = True)
+    tmp_dir = tempfile.mkdtemp(suffix = ".tmp", dir = os.path.dirname(db_dir)) # moved in place once it is complete
+    search_cache.set_mode(tmp_dir, 0o777)
+    cmdline = "makeblastdb -in {} -dbtype nucl -out {}".format(genome, os.path.join(tmp_dir, os.path.basename(db)))
+    sys.stderr.write(cmdline)
+    retcode = subprocess.call ( cmdline.split(" "), stdout=sys.stderr )
+    if retcode != 0:
+        sys.stderr.write("error {} creating blast db\n".format(retcode))
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+        return None
+    sys.stderr.write("\n")
+    try:
+        os.rename(tmp_dir, db_dir)
+    except OSError: # another run made it meanwhile
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+    return db
+
+def cached_search(ops):
+    # Steps 1 and 2 of run_pipeline with their results kept in the search cache, ops.search_cache.
+    # each step is only run if its result for these uces, genome and settings isn't in the cache yet.
+    # returns the names of the m8 and uce locations files in the cache, None if the search failed
+    import search_cache
+    cache_dir = ops.search_cache; uce = ops.filename; genome = ops.genome
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok = True)
+    key = search_cache.search_key(cache_dir, uce, genome, search_settings(ops.evalue))
+    m8_file = search_cache.entry(cache_dir, key, ".m8")
+    uce_locs_name = search_cache.entry(cache_dir, search_cache.filter_key(key, ops.filter_exclude_list), ".uce_locations.tsv")
+    
+    if os.path.isfile(m8_file):
+        sys.stderr.write("\nStep 1 of 4: {} from the search cache\n".format(m8_file))
+    elif not os.path.isfile(uce_locs_name):
+        db = None
+        if not (cmd_exists("blat") or cmd_exists("blatq")):
+            db = cached_blast_db(cache_dir, genome)
+            if db == None:
+                return None
+        sys.stderr.write("\nStep 1 of 4: ")
+        tmp_m8 = search_cache.temp_name(m8_file)
+        rc = search_uces(uce, genome, tmp_m8, ops.threads, ops.evalue, db, ops.shards)
+        if rc != 0:
+            os.remove(tmp_m8)
+            return None
+        search_cache.store(tmp_m8, m8_file)
+    
+    if os.path.isfile(uce_locs_name):
+        sys.stderr.write("Step 2 of 4: {} from the search cache\n".format(uce_locs_name))
+    else:
+        sys.stderr.write("Step 2 of 4: filter_tsv {} {}>{}\n".format(m8_file, " ".join(ops.filter_exclude_list) + " " if len(ops.filter_exclude_list) > 0 else "", uce_locs_name))
+        tmp_locs = search_cache.temp_name(uce_locs_name)
+        with open(tmp_locs, "w") as fh_uce_locs:
+            filter_uce_match_m8_file(m8_filename = m8_file, exclude_prefixes = ops.filter_exclude_list, fout = fh_uce_locs)
+        search_cache.store(tmp_locs, uce_locs_name)
+    
+    return m8_file, uce_locs_name
+
+def stream_cmdline(cmdline, tee_fname = None):
+    # yield the stdout lines of cmdline as it writes them, copied to tee_fname if given.
+    # raises subprocess.CalledProcessError once the output is read if cmdline failed
+    proc = subprocess.Popen( cmdline.rstrip().split(" "), stdout=subprocess.PIPE, universal_newlines=True )
+    tee = open(tee_fname, 'w') if tee_fname != None else None
+    for ln in proc.stdout:
+        if tee != None:
+            tee.write(ln)
+        yield ln
+    if tee != None:
+        tee.close()
+    retcode = proc.wait()
+    if retcode != 0:
+        raise subprocess.CalledProcessError(retcode, cmdline)
 
 def run_pipeline(ops, output_dir):
     def remove_ext(fname):
@@ -453,36 +660,48 @@ def run_pipeline(ops, output_dir):
     wd = os.path.abspath(__file__)
     wd = wd.split("uce_kit.py")[0]
         
+    if ops.stream:
+        return stream_pipeline(ops, output_dir, remove_ext)
+    
     # Step 1 blat (or blastn) tetrapod_uces.fasta galGal4.fna >tetrapod_uces.galGal4_matches.m8
     m8_file = output_dir+"/{}.matches.m8".format(remove_ext(os.path.basename(uce)))
-    sys.stderr.write("\nStep 1 of 4: ") # blat_uces() will write rest of line
-    if cmd_exists("blat") or cmd_exists("blatq"):
-        rc = blat_uces(uce, genome, m8_file)
-    else: # could not find blat or blatq, run blast
-        rc = blast_uces(uce, genome, ops.evalue, "-out " + m8_file)
-
-    if rc != 0:
-        return
-
-    # Step 2 filter_tsv tetrapod_uces.galGal4_matches.m8 NT_ >galGal4_uce_locations.tsv
     uce_locs_name = "{}_uce_locations.tsv".format(output_dir+"/"+remove_ext(os.path.basename(genome)))
-    filt_file = uce_locs_name
-    addtl = "" if len(ops.filter_exclude_list) == 0 else " ".join(ops.filter_exclude_list) + " "
-    sys.stderr.write("Step 2 of 4: filter_tsv {} {}>{}\n".format(m8_file, addtl, filt_file))
-    fh_uce_locs = open(filt_file, 'w')
-    filter_uce_match_m8_file(m8_filename = m8_file, exclude_prefixes = ops.filter_exclude_list, fout = fh_uce_locs)
-    fh_uce_locs.close()
+    if ops.search_cache != None: # Steps 1 and 2 come from the cache, or go into it, and are copied here
+        cached = cached_search(ops)
+        if cached == None:
+            return
+        if os.path.isfile(cached[0]):
+            shutil.copyfile(cached[0], m8_file)
+        shutil.copyfile(cached[1], uce_locs_name)
+    else:
+        sys.stderr.write("\nStep 1 of 4: ") # blat_uces() will write rest of line
+        rc = search_uces(uce, genome, m8_file, ops.threads, ops.evalue, shards = ops.shards)
+        if rc != 0:
+            return
+
+        # Step 2 filter_tsv tetrapod_uces.galGal4_matches.m8 NT_ >galGal4_uce_locations.tsv
+        filt_file = uce_locs_name
+        addtl = "" if len(ops.filter_exclude_list) == 0 else " ".join(ops.filter_exclude_list) + " "
+        sys.stderr.write("Step 2 of 4: filter_tsv {} {}>{}\n".format(m8_file, addtl, filt_file))
+        fh_uce_locs = open(filt_file, 'w')
+        filter_uce_match_m8_file(m8_filename = m8_file, exclude_prefixes = ops.filter_exclude_list, fout = fh_uce_locs)
+        fh_uce_locs.close()
 
     # Step 3 add_introns_to_gff.py galGal4.gff >galGal4.with_introns.gff
     # next line modified by vhfsantos, 2021
-    new_gff_name = output_dir+"/"+os.path.basename(gff) + ".with.introns"
-    cmdline = wd+"add_introns_to_gff.py {}".format(ops.gff)
-    retcode = execute_cmdline(cmdline, new_gff_name, "Step 3 of 4: {} >{}\n".format(cmdline, new_gff_name))
+    if ops.annotation_index is None:
+        new_gff_name = output_dir+"/"+os.path.basename(gff) + ".with.introns"
+        cmdline = wd+"add_introns_to_gff.py {}".format(ops.gff)
+        retcode = execute_cmdline(cmdline, new_gff_name, "Step 3 of 4: {} >{}\n".format(cmdline, new_gff_name))
+        gff_args = new_gff_name
+    else: # the introns go into the annotation index with the rest of the gff, built in Step 4 if it isn't there yet
+        sys.stderr.write("Step 3 of 4: introns added to the annotation index in {}\n".format(ops.annotation_index))
+        gff_args = "{} -introns -index {}".format(ops.gff, ops.annotation_index)
     
     # Step 4 uce_gff_lines.py galGal4_uce_locations.tsv galGal4_with_introns.gff >galGal4_uce_type_summary.txt
     # next line modified by vhfsantos, 2021
     summary_fname = "{}.uce_kit_summary".format(output_dir+"/"+os.path.basename(genome))
-    cmdline = wd+"uce_gff_lines.py {} {}".format(uce_locs_name, new_gff_name)
+    cmdline = wd+"uce_gff_lines.py {} {}".format(uce_locs_name, gff_args)
     cmdline += " -lines" if ops.gff_lines else ""
     cmdline += " " + " ".join(ops.gff_exclude_list) if len(ops.gff_exclude_list) > 0 else ""
     retcode = execute_cmdline(cmdline, summary_fname, "Step 4 of 4: {} > {} \n\n".format(cmdline, summary_fname))
@@ -490,6 +709,94 @@ def run_pipeline(ops, output_dir):
     sys.stderr.write("\n")
     return # from run_pipeline()
 
+def stream_search(ops, m8_file, uce_locs_name, keep):
+    # Steps 1 and 2 of stream_pipeline: the blat or blast hits are filtered as they are found.
+    # returns the uce location lines, None if the search failed
+    use_blat = cmd_exists("blat") or cmd_exists("blatq")
+    sharded = use_blat and ops.shards > 1
+    if sharded: # the shards are searched at the same time, their hits are read once they are all found
+        sharded_m8 = m8_file if keep else m8_file + ".tmp"
+        sys.stderr.write("\nStep 1 of 4: ")
+        if search_uces_sharded(ops.filename, ops.genome, sharded_m8, ops.shards) != 0:
+            return None
+        m8_lines = open(sharded_m8, "r")
+    else:
+        if use_blat:
+            cmdline = blat_cmdline(ops.filename, ops.genome)
+        else: # could not find blat or blatq, run blast
+            cmdline = blast_cmdline(ops.filename, ops.genome, ops.evalue, blast_thread_args(ops.threads))
+        if cmdline == None:
+            return None
+        sys.stderr.write("\nStep 1 of 4: {}{}\n".format(cmdline, " >"+m8_file if keep else ""))
+        m8_lines = stream_cmdline(cmdline, m8_file if keep else None)
+    
+    # Step 2 filter the hits as they come
+    sys.stderr.write("Step 2 of 4: filter_tsv {}{}\n".format(" ".join(ops.filter_exclude_list), " >"+uce_locs_name if keep else ""))
+    try:
+        uce_locs = ["{}\t{}\t{}\n".format(tup[0], tup[1], tup[2])
+                    for tup in filter_uce_matches(m8_lines, exclude_prefixes = ops.filter_exclude_list)]
+    except subprocess.CalledProcessError as e:
+        sys.stderr.write("error {} from: {}\n".format(e.returncode, e.cmd))
+        return None
+    if sharded:
+        m8_lines.close()
+        if not keep:
+            os.remove(sharded_m8)
+    if keep:
+        fh_uce_locs = open(uce_locs_name, 'w')
+        fh_uce_locs.writelines(uce_locs)
+        fh_uce_locs.close()
+    
+    return uce_locs
+
+def stream_pipeline(ops, output_dir, remove_ext):
+    # the 4 steps of run_pipeline in this process, each one taking the lines of the one before as they come:
+    # the blat or blast hits are filtered as they are found and the introns are added to the gff as it is read.
+    # only the summary is written, unless ops.keep_files asks for the files of each step as well.
+    # uce_gff_lines.py is imported from the dir of this file, which is on the path when this is run as a script
+    import uce_gff_lines
+    uce = ops.filename; genome = ops.genome; gff = ops.gff
+    keep = ops.keep_files
+    
+    # Step 1 blat (or blastn) the uces, the hits go straight to Step 2
+    m8_file = output_dir+"/{}.matches.m8".format(remove_ext(os.path.basename(uce)))
+    uce_locs_name = "{}_uce_locations.tsv".format(output_dir+"/"+remove_ext(os.path.basename(genome)))
+    if ops.search_cache != None: # Steps 1 and 2 come from the cache, or go into it
+        cached = cached_search(ops)
+        if cached == None:
+            return
+        if keep:
+            if os.path.isfile(cached[0]):
+                shutil.copyfile(cached[0], m8_file)
+            shutil.copyfile(cached[1], uce_locs_name)
+        with open(cached[1], "r") as fh_uce_locs:
+            uce_locs = fh_uce_locs.readlines()
+    else:
+        uce_locs = stream_search(ops, m8_file, uce_locs_name, keep)
+        if uce_locs == None:
+            return
+    
+    # Step 3 introns are added to the gff as Step 4 reads it (or are in the annotation index already)
+    if keep and ops.annotation_index is None:
+        new_gff_name = output_dir+"/"+os.path.basename(gff) + ".with.introns"
+        sys.stderr.write("Step 3 of 4: add_introns_to_gff.py {} >{}\n".format(gff, new_gff_name))
+        with open(new_gff_name, 'w') as fh_gff:
+            fh_gff.writelines(uce_gff_lines.open_gff(gff, add_introns = True))
+    else:
+        sys.stderr.write("Step 3 of 4: introns added to {} as it is read\n".format(gff))
+    
+    # Step 4 the summary, with the gff lines if asked
+    summary_fname = "{}.uce_kit_summary".format(output_dir+"/"+os.path.basename(genome))
+    sys.stderr.write("Step 4 of 4: uce_gff_lines.py >{}\n\n".format(summary_fname))
+    fh_summary = open(summary_fname, 'w')
+    uce_gff_lines.map_and_display(uce_locs, gff, uce_gff_lines.DEFAULT_EXCLUDES + ops.gff_exclude_list,
+                                  show_summary = True, show_lines = ops.gff_lines, add_introns = True,
+                                  index_dir = ops.annotation_index, fout = fh_summary)
+    fh_summary.close()
+    
+    sys.stderr.write("\n")
+    return
+
 def test(): # testing code
     uce_container = UceList()
     uceln = ">uce-5_p1 |source:faircloth,probes-id:2682,probes-locus:5,probes-probe:1"
@@ -514,8 +821,8 @@ def test(): # testing code
     for p in uce_obj: print("{}_{}".format(uce_obj.name, p[0]))
     
     print("\nlen(uce_container):",len(uce_container))
-    print("\nIndex by int uce_container[0]: \n", vars(uce_container[0]), "\n")
-    print("Index by name uce_container[\"uce-5\"]\n", vars(uce_container["uce-5"]), "\n\n")
+    print("\nIndex by int uce_container[0]: \n", uce_container[0].name, uce_container[0].probes, "\n")
+    print("Index by name uce_container[\"uce-5\"]\n", uce_container["uce-5"].name, uce_container["uce-5"].probes, "\n\n")
     print("'missing' in uce_container: ", 'missing' in uce_container)
     print("'uce-5' in uce_container: ", 'uce-5' in uce_container)
     print("\nuce_container['missing']", uce_container['missing'])  # this should blow up with KeyError and stack trace
@@ -589,6 +896,11 @@ def usage(exit_code = 1):
     
     run_pipeline <uces> <genome> <gff>          # given these three files, run the 4 step pipeline documented by uce_kit.py pipeline_doc. -filt excludes
      [-filt <ex1>...] [-excl <ex1>...] [-lines] #  items with prefix in filter Step 2, -excl exclude terms and -lines outputs gff lines in gff Step 4.
+     [-index <index_dir>]                       #  -index keeps the gff with introns indexed in <index_dir> for later runs, instead of Step 3's copy
+     [-stream [-keep]]                          #  -stream runs the steps in this process passing lines along, -keep also writes each step's file
+     [-threads <n>] [-shards <n>]               #  -threads runs blastn with n threads in Step 1. blat has no threads, -shards splits the
+                                                #  uces in n shards searched by n blat processes, each loading the whole genome
+     [-cache <cache_dir>]                       #  -cache reuses the Step 1 and 2 results, and blast db, of the same uces and genome from <cache_dir>
 
 """
     sys.stderr.write(msg)
@@ -605,15 +917,16 @@ def getops(argv, min_args = 0, exit_code = 1):
     if options.action == "help":
         usage(exit_code)
     elif options.action == "test":
-        return options
+        return options, None
     elif options.action[:4] == "pipe":
         options.action = "pipeline_doc"
-        return options
+        return options, None
     
     if num_args < min_args+1: # need at least one more arg if this isn't calling for a test
         usage(exit_code)
 
     options.filename = argv[2]            
+    output_dir = None
     options.evalue = "9e-40"
     if options.action == "blast" or options.action == "blat":
         options.output = ""   # empty str means write to stdout
@@ -653,14 +966,31 @@ def getops(argv, min_args = 0, exit_code = 1):
         options.gff_exclude_list = []; options.filter_exclude_list = []
         excl_list = options.gff_exclude_list
         options.gff_lines = False
+        options.annotation_index = None
+        options.stream = False; options.keep_files = False
+        options.threads = 1; options.shards = 1
+        options.search_cache = None
         output_dir = argv[5]
         
-        for ix in range(6, len(argv)-1):
-            arg = argv[ix]
+        ix = 5
+        while ix+1 < len(argv)-1:
+            ix += 1; arg = argv[ix]
             sys.stderr.write("{} :: {}\n". format(ix, arg))
             if arg[0] == '-': # -filt sets up for filter prefix exclusion list else the list is for the gff type to exclude
                 if arg[:4] == "-lin": # add -lines to step 4 so gff lines included
                     options.gff_lines = True
+                elif arg[:4] == "-ind" and ix+1 < len(argv): # keep the gff, with its introns, indexed in this dir
+                    ix += 1; options.annotation_index = argv[ix]
+                elif arg[:4] == "-cac" and ix+1 < len(argv): # keep the results of Steps 1 and 2 in this dir for later runs
+                    ix += 1; options.search_cache = argv[ix]
+                elif arg[:4] == "-thr" and ix+1 < len(argv): # blastn threads to search for the uces with
+                    ix += 1; options.threads = int(argv[ix]) if argv[ix].isdigit() else 1
+                elif arg[:4] == "-sha" and ix+1 < len(argv): # search for the uces with this many blat processes
+                    ix += 1; options.shards = int(argv[ix]) if argv[ix].isdigit() else 1
+                elif arg[:4] == "-str": # run the steps in this process, connected without files
+                    options.stream = True
+                elif arg[:4] == "-kee": # with -stream, still write the files of each step
+                    options.keep_files = True
                 else:
                     excl_list = options.filter_exclude_list if arg[:5] == "-filt" else options.gff_exclude_list
             else:
@@ -683,7 +1013,7 @@ def main(argv):  # pass in argv so we can load this file and call this from anot
     elif ops.action == "blat":
         blat_uces(ops.filename, ops.file2, ops.output)
     elif ops.action == "blast":
-        blast_uces(ops.filename, ops.file2, ops.output, ops.evalue, ops.addtl_args)
+        blast_uces(ops.filename, ops.file2, ops.evalue, ops.addtl_args)
     elif ops.action == "filter_tsv":
         filter_uce_match_m8_file(ops.filename, exclude_prefixes = ops.exclude_list)
     elif ops.action == "summary_totals":